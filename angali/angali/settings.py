@@ -24,11 +24,12 @@ INSTALLED_APPS = [
     'django.contrib.contenttypes',
     'django.contrib.sessions',
     'django.contrib.messages',
-    'django.contrib.staticfiles',
+    'core.apps.StaticFilesConfig',  # django.contrib.staticfiles, see STATIC_SOURCE_MAPS
     'core',  # Your custom app
 ]
 
 MIDDLEWARE = [
+    'core.instrumentation.InstrumentationMiddleware',  # first, so it times everything below
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'core.middleware.VisitorTrackingMiddleware',  # Custom middleware for visitor tracking
@@ -107,10 +108,166 @@ USE_TZ = True
 STATIC_URL = "static/"
 STATIC_ROOT = os.path.join(BASE_DIR, "staticfiles")
 
+# Outside DEBUG, collectstatic writes content-hashed names plus .gz/.br siblings
+# (see core.storage); source maps are only collected with STATIC_SOURCE_MAPS.
+STORAGES = {
+    "default": {"BACKEND": "django.core.files.storage.FileSystemStorage"},
+    "staticfiles": {
+        "BACKEND": (
+            "django.contrib.staticfiles.storage.StaticFilesStorage" if DEBUG
+            else "core.storage.CompressedManifestStaticFilesStorage"
+        ),
+    },
+}
+STATIC_SOURCE_MAPS = DEBUG
+
+# Serve STATIC_ROOT from the app when no web server sits in front of it. Hashed
+# files get a far-future, immutable Cache-Control; anything else STATIC_MAX_AGE.
+STATIC_SERVE_FROM_APP = not DEBUG
+STATIC_IMMUTABLE_MAX_AGE = 60 * 60 * 24 * 365
+STATIC_MAX_AGE = 60 * 60
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.0/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 LOGIN_URL = "login"
 MEDIA_URL = "/media/"
-MEDIA_ROOT = BASE_DIR / "media"
\ No newline at end of file
+MEDIA_ROOT = BASE_DIR / "media"
+
+# Visitor geolocation
+# New visitors are stored with a pending location and resolved in batches by
+# background threads. Set VISITOR_GEOLOCATION_WORKERS to 0 to leave them for
+# `manage.py resolve_locations` instead.
+
+VISITOR_GEOLOCATION_WORKERS = 2
+VISITOR_GEOLOCATION_BATCH_SIZE = 100
+VISITOR_GEOLOCATION_FLUSH_INTERVAL = 1.0  # seconds to wait for a batch to fill
+VISITOR_GEOLOCATION_QUEUE_SIZE = 10000
+
+# Backends are tried in order; each only sees the IPs earlier ones left unresolved.
+# The range database is built with `manage.py compile_geoip <ranges.csv>`.
+VISITOR_GEOLOCATION_BACKENDS = [
+    'core.geoip.RangeDatabaseBackend',
+    'core.geolocation.IPApiBackend',
+]
+GEOIP_DATABASE_PATH = BASE_DIR / 'geoip' / 'ranges.bin'
+VISITOR_GEOLOCATION_IP_API_URL = 'http://ip-api.com/batch'  # batch endpoint of IPApiBackend
+
+# Resolved locations are kept in a per-process LRU and in the shared Django cache
+VISITOR_GEOLOCATION_CACHE_ALIAS = 'default'
+VISITOR_GEOLOCATION_CACHE_SIZE = 10000  # entries in the per-process LRU
+VISITOR_GEOLOCATION_CACHE_TTL = 60 * 60 * 24
+VISITOR_GEOLOCATION_NEGATIVE_CACHE_TTL = 60 * 60  # for 'Unknown' results
+
+# Visitors seen within this many seconds are not looked up again
+VISITOR_KNOWN_CACHE_TTL = 60 * 30
+
+# Visitor tracking scope. Paths are matched by prefix; INCLUDE_PATHS = None tracks
+# everything not excluded. With HTML_ONLY, only text/html responses are tracked.
+VISITOR_TRACKING_INCLUDE_PATHS = None
+VISITOR_TRACKING_EXCLUDE_PATHS = ['/admin/', MEDIA_URL, '/' + STATIC_URL, '/track/', '/metrics']
+VISITOR_TRACKING_HTML_ONLY = True
+
+
+# Write-behind tracking
+# With TRACKING_WRITE_BEHIND, /track/start/ and /track/end/ queue their events and
+# answer 202; a flusher thread writes them in batches. A full buffer makes the
+# view write synchronously instead of dropping events.
+
+TRACKING_WRITE_BEHIND = False
+TRACKING_BUFFER_SIZE = 10000
+TRACKING_BUFFER_BATCH_SIZE = 500
+TRACKING_BUFFER_FLUSH_INTERVAL = 1.0  # seconds
+TRACKING_BUFFER_PUT_TIMEOUT = 0.05  # seconds to wait for room before writing synchronously
+
+# Append-only event log
+# With TRACKING_EVENT_LOG, visitors and beacons are appended to time-cut segment
+# files instead of the database; `manage.py compact_events` loads sealed segments.
+
+TRACKING_EVENT_LOG = False
+EVENT_LOG_DIR = BASE_DIR / 'eventlog'
+EVENT_LOG_SEGMENT_SECONDS = 300
+EVENT_LOG_BUFFER_BYTES = 64 * 1024
+EVENT_LOG_FLUSH_INTERVAL = 1.0  # seconds
+EVENT_LOG_FSYNC = False
+
+# Tracking admin
+# Unfiltered Visitor, VisitorSession and PageInteraction changelists above this many
+# rows show the database's estimate (Postgres reltuples, SQLite ANALYZE statistics)
+# instead of COUNT(*). Their date drilldown reads per-day counts cached this long.
+ADMIN_ESTIMATED_COUNT_THRESHOLD = 100000
+ADMIN_DATE_HIERARCHY_TTL = 60 * 10
+
+# Analytics rollups
+# `manage.py rollup` (run it from cron) folds new sessions and interactions into
+# daily rollup tables. The last ROLLUP_SETTLE_DAYS days before today are recomputed
+# on every run, as their sessions may still get end beacons and resolved locations.
+ROLLUP_SETTLE_DAYS = 1
+ANALYTICS_DASHBOARD_TTL = 60  # seconds the staff dashboard at /admin/analytics/ is cached
+
+# Async (ASGI) tracking
+# Under an ASGI server (e.g. `uvicorn angali.asgi:application`) the tracking
+# middleware runs on the event loop. TRACKING_ASYNC_VIEWS routes the beacons to
+# async views as well; leave it off under WSGI, where async views cost a thread hop.
+# Network geolocation from the event loop goes out over httpx when it is installed,
+# at most VISITOR_GEOLOCATION_CONCURRENCY requests at a time per loop.
+TRACKING_ASYNC_VIEWS = False
+VISITOR_GEOLOCATION_CONCURRENCY = 4
+
+# Request instrumentation
+# This fraction of requests gets a Server-Timing header (total, db with its query
+# count, geo, template) and feeds the per-view angali_request_* histograms at /metrics.
+# At 0 the middleware removes itself. The header is visible to every client.
+INSTRUMENTATION_SAMPLE_RATE = 0.0
+INSTRUMENTATION_SERVER_TIMING = True
+
+# Metrics
+# Counters and histograms from core.metrics, served in the Prometheus text format
+# at /metrics. Each process writes its own memory-mapped file in METRICS_DIR and a
+# scrape sums them, so one scrape covers every gunicorn worker. Files of exited
+# processes are folded into one archive file. Every worker must share the directory.
+# Behind a reverse proxy every request arrives from loopback, so set METRICS_TOKEN
+# and have the scraper send "Authorization: Bearer <token>". Without a token only
+# direct (not proxied) requests from METRICS_ALLOWED_IPS may scrape.
+METRICS_DIR = BASE_DIR / 'metrics'
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+METRICS_ALLOWED_IPS = ['127.0.0.1', '::1']  # None lets any client scrape
+
+# Landing page
+# Each homepage section is a cached template fragment, keyed by a fingerprint of
+# the rows it renders. The fingerprints (and the page's ETag) are recomputed with
+# one query every LANDING_VERSION_TTL seconds, so with a per-process cache other
+# workers serve a change at most that late; the worker that saved it serves it at once.
+
+LANDING_FRAGMENT_TTL = 60 * 60 * 24
+LANDING_VERSION_TTL = 5
+
+# Bytes of critical CSS (files/critical.css) extract_critical_css may inline into
+# every page; the command fails above it. 14 KB is what the first round trip
+# (a 10-packet initial congestion window) carries, with room left for the HTML.
+CRITICAL_CSS_BUDGET = 14 * 1024
+
+# The fully rendered homepage, with gzip (and brotli, if installed) copies, is
+# republished here whenever a landing model changes. Run `manage.py publish_homepage`
+# after deploying template or static changes. Set to None to always render live.
+LANDING_SNAPSHOT_DIR = BASE_DIR / 'snapshots'
+
+# Responsive images
+# Uploads on the landing models and static images under the prefixes below are
+# resized to these widths as AVIF/WebP, keyed by content hash. Bulk regeneration:
+# `manage.py generate_image_derivatives`.
+
+RESPONSIVE_IMAGE_ROOT = MEDIA_ROOT / 'responsive'
+RESPONSIVE_IMAGE_URL = MEDIA_URL + 'responsive/'
+RESPONSIVE_IMAGE_WIDTHS = [320, 640, 960, 1280, 1920]
+RESPONSIVE_IMAGE_FORMATS = ['avif', 'webp']  # formats Pillow cannot write are skipped
+RESPONSIVE_IMAGE_STATIC_PREFIXES = [
+    'assets/img/hero/', 'assets/img/dest/', 'assets/img/steps/',
+    'assets/img/testimonial/', 'assets/img/partner/', 'assets/img/category/',
+]
+RESPONSIVE_IMAGE_WORKERS = None  # processes for bulk generation; None uses every core
+
+# Admin list thumbnails, generated on first display
+THUMBNAIL_ROOT = MEDIA_ROOT / 'thumbnails'
+THUMBNAIL_URL = MEDIA_URL + 'thumbnails/'
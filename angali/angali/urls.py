@@ -1,10 +1,19 @@
+import re
+
 from django.contrib import admin
-from django.urls import path, include
+from django.urls import path, include, re_path
 from django.conf import settings
 from django.conf.urls.static import static
+from core.views import analytics_dashboard, static_asset
 
 
 urlpatterns = [
+    path('admin/analytics/', analytics_dashboard, name='analytics_dashboard'),  # before the admin's catch-all
     path('admin/', admin.site.urls),# Include pwa.urls under root URL ('/')
     path('', include('core.urls')),  # Include Appjirani.urls under root URL ('/')
-] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
\ No newline at end of file
+] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
+
+if getattr(settings, 'STATIC_SERVE_FROM_APP', False):
+    urlpatterns += [
+        re_path(r'^%s(?P<path>.+)$' % re.escape(settings.STATIC_URL.lstrip('/')), static_asset, name='static_asset'),
+    ]
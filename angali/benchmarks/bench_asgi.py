@@ -0,0 +1,169 @@
+"""
+Requests per second and latency of the tracking path under WSGI and ASGI.
+
+Drives the project's middleware stack in-process, so no server is needed:
+WSGI requests come from a thread pool, ASGI requests from tasks on one event
+loop, each with at most --concurrency requests in flight. Three setups run
+back to back:
+
+    wsgi        sync handler, sync views (threads)
+    asgi-sync   ASGI handler, sync views (each view hops to a thread)
+    asgi        ASGI handler, async views and async middleware
+
+The page scenario is a first visit (a visitor insert in the middleware), the
+start scenario a /track/start/ beacon from a known visitor. Geolocation is
+left to the background queue, which is disabled here.
+
+Runs against a throwaway test database, never db.sqlite3:
+
+    cd angali && python -m benchmarks.bench_asgi --requests 2000 --concurrency 50
+
+For numbers that include the server itself, run `uvicorn angali.asgi:application`
+(with TRACKING_ASYNC_VIEWS = True) against `gunicorn angali.wsgi` under the same
+load generator.
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import tempfile
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'angali.settings')
+
+import django  # noqa: E402
+
+django.setup()
+
+from django.core.cache import cache  # noqa: E402
+from django.db import connection  # noqa: E402
+from django.http import HttpResponse  # noqa: E402
+from django.test import AsyncClient, Client, override_settings  # noqa: E402
+from django.test.utils import setup_test_environment  # noqa: E402
+from django.urls import path  # noqa: E402
+
+from core.models import Visitor, VisitorSession  # noqa: E402
+from core.views import atrack_start, track_start  # noqa: E402
+
+
+def page(request):
+    return HttpResponse('<html></html>')
+
+
+async def apage(request):
+    return HttpResponse('<html></html>')
+
+
+# Used as ROOT_URLCONF while the benchmark runs
+urlpatterns = [
+    path('sync/page/', page),
+    path('sync/track/start/', track_start),
+    path('async/page/', apage),
+    path('async/track/start/', atrack_start),
+]
+
+SETUPS = {
+    'wsgi': 'sync',
+    'asgi-sync': 'sync',
+    'asgi': 'async',
+}
+
+
+def make_request(scenario, prefix, visitor_id):
+    """Method, path, body and cookies of one request."""
+    if scenario == 'page':
+        return 'get', f'/{prefix}/page/', None, {}
+    body = json.dumps({'session_id': str(uuid.uuid4()), 'referrer': '', 'user_agent': 'bench'})
+    return 'post', f'/{prefix}/track/start/', body, {'visitor_id': visitor_id}
+
+
+def run_wsgi(scenario, prefix, visitor_id, requests, concurrency):
+    def one(_):
+        client = Client()
+        method, url, body, cookies = make_request(scenario, prefix, visitor_id)
+        client.cookies.load(cookies)
+        started = time.perf_counter()
+        if method == 'get':
+            response = client.get(url)
+        else:
+            response = client.post(url, data=body, content_type='application/json')
+        assert response.status_code < 400, response.status_code
+        return time.perf_counter() - started
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        return list(pool.map(one, range(requests)))
+
+
+async def run_asgi(scenario, prefix, visitor_id, requests, concurrency):
+    slots = asyncio.Semaphore(concurrency)
+
+    async def one():
+        async with slots:
+            client = AsyncClient()
+            method, url, body, cookies = make_request(scenario, prefix, visitor_id)
+            client.cookies.load(cookies)
+            started = time.perf_counter()
+            if method == 'get':
+                response = await client.get(url)
+            else:
+                response = await client.post(url, data=body, content_type='application/json')
+            assert response.status_code < 400, response.status_code
+            return time.perf_counter() - started
+
+    return await asyncio.gather(*(one() for _ in range(requests)))
+
+
+def measure(setup, scenario, visitor_id, requests, concurrency):
+    prefix = SETUPS[setup]
+    cache.clear()
+    Visitor.objects.exclude(uuid=visitor_id).delete()
+    VisitorSession.objects.all().delete()
+    started = time.perf_counter()
+    if setup == 'wsgi':
+        latencies = run_wsgi(scenario, prefix, visitor_id, requests, concurrency)
+    else:
+        latencies = asyncio.run(run_asgi(scenario, prefix, visitor_id, requests, concurrency))
+    elapsed = time.perf_counter() - started
+    cuts = statistics.quantiles(latencies, n=100)
+    print(
+        f"{scenario:<6} {setup:<10} {requests / elapsed:10,.0f} req/s"
+        f"  p50 {cuts[49] * 1000:7.2f}ms  p99 {cuts[98] * 1000:7.2f}ms"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--scenario', choices=['page', 'start', 'both'], default='both')
+    parser.add_argument('--write-behind', action='store_true', help="queue beacons instead of writing them")
+    args = parser.parse_args()
+
+    setup_test_environment()
+    # A file, not the default in-memory database, so the WSGI threads share it
+    workdir = tempfile.TemporaryDirectory()
+    connection.settings_dict['TEST']['NAME'] = os.path.join(workdir.name, 'bench.sqlite3')
+    old_name = connection.creation.create_test_db(verbosity=0)
+    try:
+        visitor_id = str(Visitor.objects.create(uuid=uuid.uuid4(), ip_address='127.0.0.1').uuid)
+        scenarios = ['page', 'start'] if args.scenario == 'both' else [args.scenario]
+        with override_settings(
+            ROOT_URLCONF='benchmarks.bench_asgi',
+            VISITOR_TRACKING_INCLUDE_PATHS=['/sync/page/', '/async/page/'],
+            VISITOR_GEOLOCATION_WORKERS=0,
+            TRACKING_WRITE_BEHIND=args.write_behind,
+            TRACKING_EVENT_LOG=False,
+        ):
+            for scenario in scenarios:
+                for setup in SETUPS:
+                    measure(setup, scenario, visitor_id, args.requests, args.concurrency)
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        workdir.cleanup()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""
+Throughput of track_end ingestion: the old one-INSERT-per-section loop
+against record_session_ends() with bulk_create in one transaction, for
+batched POSTs of --batch-size end events (50 by default, about what a
+busy page flushes at once). Reports end events and inserted rows per second.
+
+Runs against a throwaway test database, never db.sqlite3:
+
+    cd angali && python -m benchmarks.bench_track_end --sessions 200 --sections 30
+"""
+import argparse
+import os
+import time
+import uuid
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'angali.settings')
+
+import django  # noqa: E402
+
+django.setup()
+
+from django.db import connection  # noqa: E402
+from django.test.utils import setup_test_environment  # noqa: E402
+from django.utils import timezone  # noqa: E402
+
+from core.ingest import record_session_ends  # noqa: E402
+from core.models import PageInteraction, Visitor, VisitorSession  # noqa: E402
+
+
+def make_events(sessions, sections):
+    visitor = Visitor.objects.create(uuid=uuid.uuid4(), ip_address='127.0.0.1', location='Bench, Bench')
+    events = []
+    for _ in range(sessions):
+        session_id = str(uuid.uuid4())
+        VisitorSession.objects.create(visitor=visitor, session_id=session_id)
+        events.append({
+            'session_id': session_id,
+            'end_time': timezone.now().isoformat(),
+            'duration_seconds': 42,
+            'sections': [f'section-{i}' for i in range(sections)],
+            'max_scroll': 75,
+        })
+    return events
+
+
+def per_row(events):
+    """The track_end loop before batching, one request per event."""
+    for data in events:
+        session = VisitorSession.objects.filter(session_id=data['session_id']).first()
+        if session:
+            session.end_time = data['end_time']
+            session.duration_seconds = data['duration_seconds']
+            session.save()
+            for section_id in data['sections']:
+                PageInteraction.objects.create(
+                    session=session,
+                    section_id=section_id,
+                    scroll_depth=data['max_scroll']
+                )
+
+
+def batched(events, batch_size):
+    for start in range(0, len(events), batch_size):
+        record_session_ends(events[start:start + batch_size])
+
+
+def measure(label, func, events, sections):
+    PageInteraction.objects.all().delete()
+    started = time.perf_counter()
+    func(events)
+    elapsed = time.perf_counter() - started
+    rows = len(events) * sections
+    print(
+        f"{label:<28} {len(events):>6} events {rows:>8} rows  {elapsed:8.3f}s  "
+        f"{len(events) / elapsed:10,.0f} events/s  {rows / elapsed:12,.0f} inserts/s"
+    )
+    return len(events) / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sessions', type=int, default=200)
+    parser.add_argument('--sections', type=int, default=30)
+    parser.add_argument('--batch-size', type=int, default=50, help="end events per batched POST")
+    args = parser.parse_args()
+
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(verbosity=0)
+    try:
+        events = make_events(args.sessions, args.sections)
+        before = measure('before (per-row create)', per_row, events, args.sections)
+        after = measure(
+            f'after (bulk, {args.batch_size}/POST)',
+            lambda evs: batched(evs, args.batch_size),
+            events,
+            args.sections,
+        )
+        print(f"speedup: {after / before:.1f}x")
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+if __name__ == '__main__':
+    main()
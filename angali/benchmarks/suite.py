@@ -0,0 +1,322 @@
+"""
+Benchmark suite for the landing page and the tracking beacons.
+
+Load tests: requests per second and p50/p99 latency of `/`, `/track/start/`
+and `/track/end/`, sent from a pool of --concurrency threads through the
+in-process WSGI handler, plus the queries each request makes. Every page view
+comes from a new visitor, so geolocation runs too: IPApiBackend is pointed at
+a local stub server that answers after --geo-latency milliseconds.
+
+Micro-benchmarks: VisitorTrackingMiddleware on its own (untracked path, known
+visitor, new visitor) and the tracking admin changelists over --rows rows.
+
+Runs against a throwaway test database, never db.sqlite3, and writes the
+results as JSON. With --compare, metrics more than --tolerance worse than the
+baseline (or any extra query) are listed and the exit status is 1:
+
+    cd angali && python -m benchmarks.suite --output baseline.json
+    cd angali && python -m benchmarks.suite --compare baseline.json --output latest.json
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'angali.settings')
+
+import django  # noqa: E402
+
+django.setup()
+
+from django.contrib.auth.models import User  # noqa: E402
+from django.core.cache import cache  # noqa: E402
+from django.db import connection  # noqa: E402
+from django.http import HttpResponse  # noqa: E402
+from django.test import Client, RequestFactory, override_settings  # noqa: E402
+from django.test.utils import CaptureQueriesContext, setup_test_environment  # noqa: E402
+from django.urls import reverse  # noqa: E402
+from django.utils import timezone  # noqa: E402
+
+from core.geolocation import location_cache  # noqa: E402
+from core.middleware import VisitorTrackingMiddleware  # noqa: E402
+from core.models import FAQItem, HeroSection, PageInteraction, Testimonial, Visitor, VisitorSession  # noqa: E402
+
+# Metrics where a larger number is the better one; for the rest smaller is better
+HIGHER_IS_BETTER = {'rps'}
+
+
+class StubGeolocationHandler(BaseHTTPRequestHandler):
+    """Answers ip-api.com batch requests with a fixed location for every IP."""
+
+    def do_POST(self):
+        ip_addresses = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        time.sleep(self.server.latency)
+        self.server.requests += 1
+        body = json.dumps([
+            {'status': 'success', 'city': 'Stub', 'country': 'Bench', 'query': ip} for ip in ip_addresses
+        ]).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@contextmanager
+def stub_geolocation_server(latency):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubGeolocationHandler)
+    server.latency = latency
+    server.requests = 0
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def percentiles(latencies):
+    cuts = statistics.quantiles(latencies, n=100)
+    return round(cuts[49] * 1000, 3), round(cuts[98] * 1000, 3)
+
+
+def seed_landing():
+    HeroSection.objects.create(headline='Benchmark', subheadline='Landing page', cta_text='Go', cta_link='https://example.com')
+    FAQItem.objects.bulk_create(FAQItem(question=f'Question {i}?', answer='Answer', order=i) for i in range(10))
+    Testimonial.objects.bulk_create(Testimonial(source_name=f'Source {i}', content='Great') for i in range(6))
+
+
+def seed_tracking(rows):
+    """``rows`` sessions across ``rows // 4`` visitors, with three interactions each."""
+    now = timezone.now()
+    visitors = Visitor.objects.bulk_create(
+        Visitor(uuid=uuid.uuid4(), ip_address='10.0.0.1', location='Seed, Bench', visit_date=now)
+        for _ in range(max(rows // 4, 1))
+    )
+    sessions = VisitorSession.objects.bulk_create(
+        VisitorSession(
+            visitor=visitors[i % len(visitors)], session_id=f'seed-{i}', referrer='', user_agent='bench',
+            start_time=now - datetime.timedelta(minutes=i), duration_seconds=i % 600,
+        )
+        for i in range(rows)
+    )
+    PageInteraction.objects.bulk_create(
+        PageInteraction(session=session, section_id=section, timestamp=session.start_time, scroll_depth=50)
+        for session in sessions for section in ('hero', 'about', 'faq')
+    )
+
+
+def home_request(n, visitor_id):
+    # A new visitor from one of 4096 addresses, so the geolocation cache sees repeats
+    return 'get', '/', None, {'REMOTE_ADDR': f'198.51.{(n >> 8) % 16}.{n % 256}'}
+
+
+def start_request(n, visitor_id):
+    body = {'session_id': f'bench-{n}', 'referrer': 'https://example.com/', 'user_agent': 'bench'}
+    return 'post', reverse('track_start'), body, {'HTTP_COOKIE': f'visitor_id={visitor_id}'}
+
+
+def end_request(n, visitor_id):
+    body = {
+        'session_id': f'bench-{n}',
+        'end_time': timezone.now().isoformat(),
+        'duration_seconds': 30,
+        'sections': ['hero', 'about', 'faq'],
+        'max_scroll': 80,
+    }
+    return 'post', reverse('track_end'), body, {}
+
+
+def send(client, method, url, body, extra):
+    if method == 'get':
+        response = client.get(url, **extra)
+    else:
+        response = client.post(url, data=json.dumps(body), content_type='application/json', **extra)
+    if response.status_code >= 400:
+        raise RuntimeError(f'{method.upper()} {url} answered {response.status_code}')
+    return response
+
+
+def load(make, visitor_id, requests, concurrency, offset=0):
+    """Send ``requests`` requests from ``concurrency`` threads; returns the rate and latencies."""
+    def one(n):
+        client = Client()
+        method, url, body, extra = make(offset + n, visitor_id)
+        started = time.perf_counter()
+        send(client, method, url, body, extra)
+        return time.perf_counter() - started
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        latencies = list(pool.map(one, range(requests)))
+    elapsed = time.perf_counter() - started
+    p50, p99 = percentiles(latencies)
+    return {'rps': round(requests / elapsed, 1), 'p50_ms': p50, 'p99_ms': p99}
+
+
+def queries_per_request(make, visitor_id, samples, offset):
+    """Average queries per request over ``samples`` requests sent one at a time."""
+    total = 0
+    for n in range(samples):
+        method, url, body, extra = make(offset + n, visitor_id)
+        with CaptureQueriesContext(connection) as queries:
+            send(Client(), method, url, body, extra)
+        total += len(queries)
+    return round(total / samples, 2)
+
+
+def bench_load(args, visitor_id):
+    results = {}
+    # The end beacons close the sessions the start beacons opened
+    endpoints = [('/', home_request), ('/track/start/', start_request), ('/track/end/', end_request)]
+    for name, make in endpoints:
+        cache.clear()
+        location_cache.clear()
+        result = load(make, visitor_id, args.requests, args.concurrency)
+        result['queries'] = queries_per_request(make, visitor_id, args.query_samples, offset=args.requests)
+        results[f'load {name}'] = result
+        print(
+            f"{name:<14} {result['rps']:10,.1f} req/s  p50 {result['p50_ms']:8.2f}ms"
+            f"  p99 {result['p99_ms']:8.2f}ms  {result['queries']:5.2f} queries/request"
+        )
+    return results
+
+
+def bench_middleware(args, visitor_id):
+    """Microseconds per call of the middleware around a view that does nothing."""
+    factory = RequestFactory()
+    page = HttpResponse('<html></html>')
+    middleware = VisitorTrackingMiddleware(lambda request: page)
+    cases = {
+        'untracked path': lambda n: factory.get('/track/start/'),
+        'known visitor': lambda n: factory.get('/', HTTP_COOKIE=f'visitor_id={visitor_id}'),
+        'new visitor': lambda n: factory.get('/', REMOTE_ADDR=f'203.0.113.{n % 256}'),
+    }
+    results = {}
+    middleware(cases['known visitor'](0))  # marks the visitor as known
+    for name, make in cases.items():
+        requests = [make(n) for n in range(args.micro_iterations)]
+        started = time.perf_counter()
+        for request in requests:
+            middleware(request)
+        per_call = (time.perf_counter() - started) / len(requests) * 1e6
+        results[f'middleware {name}'] = {'us_per_call': round(per_call, 2)}
+        print(f"middleware {name:<15} {per_call:10.1f} us/call")
+    return results
+
+
+def bench_admin(args):
+    client = Client()
+    client.force_login(User.objects.create_superuser('bench', 'bench@example.com', 'bench'))
+    results = {}
+    for model in ('visitor', 'visitorsession', 'pageinteraction'):
+        url = reverse(f'admin:core_{model}_changelist')
+        cache.clear()
+        latencies = []
+        for _ in range(args.admin_iterations):
+            with CaptureQueriesContext(connection) as queries:
+                started = time.perf_counter()
+                send(client, 'get', url, None, {})
+                latencies.append(time.perf_counter() - started)
+        p50, p99 = percentiles(latencies)
+        # Counted on the last, warm request
+        results[f'admin {model}'] = {'p50_ms': p50, 'p99_ms': p99, 'queries': len(queries)}
+        print(f"admin {model:<15} p50 {p50:8.2f}ms  p99 {p99:8.2f}ms  {len(queries)} queries")
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Lines describing each metric that got worse than ``baseline`` allows."""
+    regressions = []
+    for name, metrics in results.items():
+        for metric, value in metrics.items():
+            before = baseline.get(name, {}).get(metric)
+            if not before:
+                continue
+            if metric == 'queries':
+                worse = value > before
+            elif metric in HIGHER_IS_BETTER:
+                worse = value < before * (1 - tolerance)
+            else:
+                worse = value > before * (1 + tolerance)
+            if worse:
+                regressions.append(f"{name} {metric}: {before} -> {value}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=500, help="requests per endpoint in the load tests")
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--query-samples', type=int, default=20, help="requests per endpoint whose queries are counted")
+    parser.add_argument('--geo-latency', type=float, default=50, help="stub geolocation server latency, ms")
+    parser.add_argument('--micro-iterations', type=int, default=2000)
+    parser.add_argument('--admin-iterations', type=int, default=20)
+    parser.add_argument('--rows', type=int, default=20000, help="sessions seeded for the admin changelists")
+    parser.add_argument('--output', help="write the results to this JSON file")
+    parser.add_argument('--compare', help="baseline JSON file from an earlier run")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="allowed slowdown against the baseline")
+    args = parser.parse_args()
+
+    setup_test_environment()
+    # A file, not the default in-memory database, so the load test threads share it
+    workdir = tempfile.TemporaryDirectory()
+    connection.settings_dict['TEST']['NAME'] = os.path.join(workdir.name, 'bench.sqlite3')
+    old_name = connection.creation.create_test_db(verbosity=0)
+    try:
+        with stub_geolocation_server(args.geo_latency / 1000) as server, override_settings(
+            VISITOR_GEOLOCATION_BACKENDS=['core.geolocation.IPApiBackend'],
+            VISITOR_GEOLOCATION_IP_API_URL=f'http://127.0.0.1:{server.server_port}/batch',
+            LANDING_SNAPSHOT_DIR=os.path.join(workdir.name, 'snapshots'),
+            TRACKING_WRITE_BEHIND=False,
+            TRACKING_EVENT_LOG=False,
+        ):
+            seed_landing()
+            visitor_id = str(Visitor.objects.create(uuid=uuid.uuid4(), ip_address='127.0.0.1').uuid)
+            results = bench_load(args, visitor_id)
+            results.update(bench_middleware(args, visitor_id))
+            seed_tracking(args.rows)
+            results.update(bench_admin(args))
+            print(f"stub geolocation server answered {server.requests} batch requests")
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        workdir.cleanup()
+
+    report = {
+        'meta': {
+            'date': timezone.now().isoformat(),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'database': connection.vendor,
+            'arguments': vars(args),
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f)['results'], args.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
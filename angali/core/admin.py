@@ -1,9 +1,9 @@
 from django.contrib import admin
 from django.utils.html import format_html
 from django.utils.timesince import timesince
-from django.utils import timezone
 from .models import *
-import datetime
+from .images import thumbnail
+from .changelist import EstimatedCountPaginator, KeysetChangeList, related_count
 
 # Inline for VisitorSession to display within Visitor admin
 class VisitorSessionInline(admin.TabularInline):
@@ -30,15 +30,28 @@ class PageInteractionInline(admin.TabularInline):
         # Optimize query by selecting related session
         return super().get_queryset(request).select_related('session')
 
+class TrackingAdmin(admin.ModelAdmin):
+    """Changelists for the large tracking tables: estimated counts, cursor paging, cached date drilldown."""
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False  # no second COUNT(*) for the "N total" link
+    change_list_template = 'admin/core/tracking_change_list.html'
+    keyset_field = None  # indexed timestamp the default ordering pages on
+
+    def get_changelist(self, request, **kwargs):
+        return KeysetChangeList
+
 @admin.register(Visitor)
-class VisitorAdmin(admin.ModelAdmin):
+class VisitorAdmin(TrackingAdmin):
     list_display = ('uuid', 'ip_address', 'location', 'formatted_visit_date', 'session_count')
     list_filter = ('visit_date', 'location')
     search_fields = ('uuid__exact', 'ip_address', 'location')
     inlines = [VisitorSessionInline]
     readonly_fields = ('uuid', 'visit_date')
     list_per_page = 25
-    date_hierarchy = 'visit_date'
+    # No date drilldown: no rollup counts visitors per day, so it would group the
+    # whole table on every load. The visit_date list filter covers the common ranges.
+    keyset_field = 'visit_date'
+    ordering = ('-visit_date',)
 
     def formatted_visit_date(self, obj):
         """Display visit date in a human-readable format."""
@@ -48,17 +61,18 @@ class VisitorAdmin(admin.ModelAdmin):
 
     def session_count(self, obj):
         """Display the number of sessions for this visitor."""
-        count = obj.visitorsession_set.count()
+        count = obj.visitorsession__count
         return format_html('<b style="color: {};">{}</b>', 'green' if count > 0 else 'red', count)
     session_count.short_description = 'Sessions'
     session_count.admin_order_field = 'visitorsession__count'
 
     def get_queryset(self, request):
-        # Optimize query by prefetching related sessions
-        return super().get_queryset(request).prefetch_related('visitorsession_set')
+        # Count sessions in the changelist query itself; also makes the column sortable.
+        # A subquery rather than Count() over a join, so the list's COUNT(*) needs no GROUP BY
+        return super().get_queryset(request).annotate(visitorsession__count=related_count(VisitorSession, 'visitor'))
 
 @admin.register(VisitorSession)
-class VisitorSessionAdmin(admin.ModelAdmin):
+class VisitorSessionAdmin(TrackingAdmin):
     list_display = ('session_id', 'visitor_ip', 'start_time', 'formatted_duration', 'referrer_short', 'user_agent_short', 'interaction_count')
     list_filter = ('start_time', 'visitor__location')
     search_fields = ('session_id', 'visitor__ip_address', 'referrer', 'user_agent')
@@ -66,6 +80,8 @@ class VisitorSessionAdmin(admin.ModelAdmin):
     readonly_fields = ('start_time', 'duration_seconds')
     list_per_page = 25
     date_hierarchy = 'start_time'
+    keyset_field = 'start_time'
+    ordering = ('-start_time',)
     actions = ['reset_duration']
 
     def visitor_ip(self, obj):
@@ -96,7 +112,7 @@ class VisitorSessionAdmin(admin.ModelAdmin):
 
     def interaction_count(self, obj):
         """Display the number of page interactions."""
-        count = obj.pageinteraction_set.count()
+        count = obj.pageinteraction__count
         return format_html('<b>{}</b>', count)
     interaction_count.short_description = 'Interactions'
     interaction_count.admin_order_field = 'pageinteraction__count'
@@ -108,17 +124,21 @@ class VisitorSessionAdmin(admin.ModelAdmin):
     reset_duration.short_description = "Reset session duration to 0"
 
     def get_queryset(self, request):
-        # Optimize query by selecting related visitor and prefetching interactions
-        return super().get_queryset(request).select_related('visitor').prefetch_related('pageinteraction_set')
+        # Select the visitor and count interactions in the changelist query itself
+        return super().get_queryset(request).select_related('visitor').annotate(
+            pageinteraction__count=related_count(PageInteraction, 'session'),
+        )
 
 @admin.register(PageInteraction)
-class PageInteractionAdmin(admin.ModelAdmin):
+class PageInteractionAdmin(TrackingAdmin):
     list_display = ('section_id', 'session_id_short', 'timestamp', 'scroll_depth_percent')
     list_filter = ('timestamp', 'section_id')
     search_fields = ('section_id', 'session__session_id')
     readonly_fields = ('timestamp',)
     list_per_page = 25
     date_hierarchy = 'timestamp'
+    keyset_field = 'timestamp'
+    ordering = ('-timestamp',)
 
     def session_id_short(self, obj):
         """Display a shortened session ID."""
@@ -135,7 +155,42 @@ class PageInteractionAdmin(admin.ModelAdmin):
     def get_queryset(self, request):
         # Optimize query by selecting related session and visitor
         return super().get_queryset(request).select_related('session__visitor')
-    
+
+class RollupAdmin(admin.ModelAdmin):
+    """Read-only: the rollups are rewritten by `manage.py rollup`."""
+    date_hierarchy = 'day'
+    list_per_page = 50
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+@admin.register(DailySessionRollup)
+class DailySessionRollupAdmin(RollupAdmin):
+    list_display = ('day', 'location', 'referrer_host', 'sessions', 'visitors', 'formatted_average_duration')
+    list_filter = ('location',)
+    search_fields = ('location', 'referrer_host')
+    ordering = ('-day', '-sessions')
+
+    def formatted_average_duration(self, obj):
+        """Display the average session duration in seconds."""
+        return f"{obj.average_duration:.0f}s"
+    formatted_average_duration.short_description = 'Avg. duration'
+
+@admin.register(DailySectionRollup)
+class DailySectionRollupAdmin(RollupAdmin):
+    list_display = ('day', 'section_id', 'interactions', 'sessions', 'formatted_average_scroll_depth')
+    list_filter = ('section_id',)
+    search_fields = ('section_id',)
+    ordering = ('-day', 'section_id')
+
+    def formatted_average_scroll_depth(self, obj):
+        """Display the average scroll depth with a percentage sign."""
+        return f"{obj.average_scroll_depth:.0f}%"
+    formatted_average_scroll_depth.short_description = 'Avg. scroll depth'
+
 
 # Start of Website or Landing Page Dynamic Content Models Admins 👇 ###############################################################################################################
     
@@ -174,8 +229,9 @@ class HeroSectionAdmin(admin.ModelAdmin):
     )
 
     def background_image_preview(self, obj):
+        # Thumbnails are made on first display and cached on disk (see core.images.thumbnail)
         if obj.background_image:
-            return format_html('<img src="{}" style="max-height:80px; max-width:200px;" />', obj.background_image.url)
+            return format_html('<img src="{}" loading="lazy" style="max-height:80px; max-width:200px;" />', thumbnail(obj.background_image, 200, 80))
         return "-"
     background_image_preview.short_description = "Background Preview"
 
@@ -196,7 +252,7 @@ class SectionContentAdmin(admin.ModelAdmin):
 
     def image_preview(self, obj):
         if obj.image:
-            return format_html('<img src="{}" style="max-height:60px; max-width:120px;" />', obj.image.url)
+            return format_html('<img src="{}" loading="lazy" style="max-height:60px; max-width:120px;" />', thumbnail(obj.image, 120, 60))
         return "-"
     image_preview.short_description = "Image Preview"
 
@@ -249,7 +305,7 @@ class TestimonialAdmin(admin.ModelAdmin):
 
     def profile_image_preview(self, obj):
         if obj.profile_image:
-            return format_html('<img src="{}" style="max-height:50px; max-width:50px; border-radius:50%;" />', obj.profile_image.url)
+            return format_html('<img src="{}" loading="lazy" style="max-height:50px; max-width:50px; border-radius:50%;" />', thumbnail(obj.profile_image, 50, 50))
         return "-"
     profile_image_preview.short_description = "Profile Image"
 
@@ -269,7 +325,7 @@ class PartnerAdmin(admin.ModelAdmin):
 
     def logo_preview(self, obj):
         if obj.logo:
-            return format_html('<img src="{}" style="max-height:40px; max-width:100px;" />', obj.logo.url)
+            return format_html('<img src="{}" loading="lazy" style="max-height:40px; max-width:100px;" />', thumbnail(obj.logo, 100, 40))
         return "-"
     logo_preview.short_description = "Logo"
 
@@ -0,0 +1,133 @@
+"""
+The staff analytics dashboard.
+
+Every figure comes from GROUP BY queries over the daily rollups written by
+``manage.py rollup``, never from the raw tracking tables, and is cached for
+``ANALYTICS_DASHBOARD_TTL`` seconds. Today only shows up once the rollup has
+run today. Visitor figures add up each rollup row's distinct visitors, so a
+visitor seen on several days, or from several referrers, counts more than once.
+"""
+import datetime
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Sum
+from django.utils import timezone
+
+from .models import DailySectionRollup, DailySessionRollup
+from .rollup import DURATION_EDGES, HISTOGRAM_BUCKETS
+
+CACHE_KEY = 'analytics:dashboard'
+PERIODS = (7, 30, 90, 365)  # days the dashboard can cover
+PERCENTILES = (25, 50, 75, 90)
+TOP_LOCATIONS = 10
+
+
+def sum_histograms(histograms, size):
+    """Element-wise sum of rollup histograms; rows written before a histogram existed are empty."""
+    totals = [0] * size
+    for histogram in histograms:
+        for bucket, count in enumerate(histogram[:size]):
+            totals[bucket] += count
+    return totals
+
+
+def histogram_percentile(histogram, percentile):
+    """Scroll depth at ``percentile`` of a decile histogram, interpolated within its bucket."""
+    total = sum(histogram)
+    if not total:
+        return None
+    rank, seen = total * percentile / 100, 0
+    for bucket, count in enumerate(histogram):
+        if count and seen + count >= rank:
+            if bucket == HISTOGRAM_BUCKETS - 1:
+                return 100
+            return round(10 * bucket + 10 * (rank - seen) / count)
+        seen += count
+    return 100
+
+
+def duration_labels():
+    def label(seconds):
+        return f'{seconds // 60}m' if seconds >= 60 else f'{seconds}s'
+    edges = [label(edge) for edge in DURATION_EDGES]
+    return [f'< {edges[0]}'] + [f'{low}–{high}' for low, high in zip(edges, edges[1:])] + [f'≥ {edges[-1]}']
+
+
+def with_shares(rows, key):
+    """Adds each row's ``share`` of the largest ``key``, in percent, for the bar widths."""
+    largest = max((row[key] for row in rows), default=0)
+    for row in rows:
+        row['share'] = round(100 * row[key] / largest) if largest else 0
+    return rows
+
+
+def compute_dashboard(days):
+    today = timezone.localdate()
+    since = today - datetime.timedelta(days=days - 1)
+    sessions = DailySessionRollup.objects.filter(day__gte=since, day__lte=today).order_by()
+    sections = DailySectionRollup.objects.filter(day__gte=since, day__lte=today).order_by()
+
+    per_day = {
+        row['day']: row
+        for row in sessions.values('day').annotate(sessions=Sum('sessions'), visitors=Sum('visitors'))
+    }
+    daily = with_shares([
+        {
+            'day': day,
+            'sessions': per_day.get(day, {}).get('sessions', 0),
+            'visitors': per_day.get(day, {}).get('visitors', 0),
+        }
+        for day in (since + datetime.timedelta(days=n) for n in range(days))
+    ], 'sessions')
+    totals = sessions.aggregate(sessions=Sum('sessions'), visitors=Sum('visitors'), duration=Sum('total_duration'))
+    total_sessions = totals['sessions'] or 0
+
+    locations = with_shares(list(
+        sessions.values('location').annotate(sessions=Sum('sessions'), visitors=Sum('visitors'))
+        .order_by('-sessions', 'location')[:TOP_LOCATIONS]
+    ), 'sessions')
+
+    durations = sum_histograms(sessions.values_list('duration_histogram', flat=True), len(DURATION_EDGES) + 1)
+    duration_rows = with_shares(
+        [{'label': label, 'sessions': count} for label, count in zip(duration_labels(), durations)], 'sessions',
+    )
+
+    histograms = {}
+    for section_id, histogram in sections.values_list('section_id', 'scroll_histogram'):
+        histograms.setdefault(section_id, []).append(histogram)
+    funnel = list(
+        sections.values('section_id')
+        .annotate(sessions=Sum('sessions'), interactions=Sum('interactions'), scroll=Sum('total_scroll_depth'))
+        .order_by('-sessions', 'section_id')
+    )
+    for row in funnel:
+        histogram = sum_histograms(histograms.get(row['section_id'], []), HISTOGRAM_BUCKETS)
+        row['reach'] = round(100 * row['sessions'] / total_sessions, 1) if total_sessions else None
+        row['average_scroll'] = round(row['scroll'] / row['interactions']) if row['interactions'] else None
+        row['percentiles'] = [histogram_percentile(histogram, p) for p in PERCENTILES]
+    with_shares(funnel, 'sessions')
+
+    return {
+        'since': since,
+        'until': today,
+        'days': days,
+        'total_sessions': total_sessions,
+        'total_visitors': totals['visitors'] or 0,
+        'average_duration': round(totals['duration'] / total_sessions) if total_sessions else 0,
+        'daily': daily,
+        'locations': locations,
+        'durations': duration_rows,
+        'funnel': funnel,
+        'percentiles': PERCENTILES,
+    }
+
+
+def dashboard(days):
+    """The dashboard figures for the last ``days`` days, cached for ``ANALYTICS_DASHBOARD_TTL`` seconds."""
+    key = f'{CACHE_KEY}:{days}:{timezone.localdate().isoformat()}'
+    data = cache.get(key)
+    if data is None:
+        data = compute_dashboard(days)
+        cache.set(key, data, getattr(settings, 'ANALYTICS_DASHBOARD_TTL', 60))
+    return data
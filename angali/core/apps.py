@@ -1,6 +1,23 @@
 from django.apps import AppConfig
+from django.conf import settings
+from django.contrib.staticfiles.apps import StaticFilesConfig as BaseStaticFilesConfig
 
 
 class CoreConfig(AppConfig):
+    default = True  # the app config for 'core'; StaticFilesConfig below replaces staticfiles'
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'core'
+
+    def ready(self):
+        from . import signals  # noqa: F401
+
+
+class StaticFilesConfig(BaseStaticFilesConfig):
+    """staticfiles, with source maps left out of collectstatic unless STATIC_SOURCE_MAPS is set."""
+
+    @property
+    def ignore_patterns(self):
+        patterns = BaseStaticFilesConfig.ignore_patterns
+        if not getattr(settings, 'STATIC_SOURCE_MAPS', False):
+            patterns = [*patterns, '*.map']
+        return patterns
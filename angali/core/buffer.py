@@ -0,0 +1,153 @@
+import atexit
+import logging
+import queue
+import threading
+import time
+
+from django.conf import settings
+from django.db import OperationalError, close_old_connections
+
+from .ingest import write_events
+
+logger = logging.getLogger(__name__)
+
+RETRY_DELAY = 0.1  # first wait after the database refused a batch, doubled up to MAX_RETRY_DELAY
+MAX_RETRY_DELAY = 5.0
+SHUTDOWN_ATTEMPTS = 5
+
+class EventBuffer:
+    """
+    Write-behind buffer for tracking beacons.
+
+    Views ``offer`` events to a bounded in-process queue and answer 202
+    straight away; a flusher thread drains it to the database in large
+    transactions. When the queue stays full for longer than
+    ``TRACKING_BUFFER_PUT_TIMEOUT`` the offer is refused and the view writes
+    synchronously, so a spike slows beacons down instead of losing them.
+    A batch the database refuses with an ``OperationalError`` (SQLite's
+    "database is locked") is held and retried with backoff; only events that
+    fail validation are dropped. Whatever is still queued at interpreter exit
+    is flushed by an atexit hook.
+    """
+
+    def __init__(self):
+        self._queue = None
+        self._thread = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stopping = False
+        self._held = []  # batch to retry before draining more
+        self._backoff = 0
+
+    @property
+    def enabled(self):
+        return getattr(settings, 'TRACKING_WRITE_BEHIND', False)
+
+    @property
+    def batch_size(self):
+        return getattr(settings, 'TRACKING_BUFFER_BATCH_SIZE', 500)
+
+    @property
+    def flush_interval(self):
+        return getattr(settings, 'TRACKING_BUFFER_FLUSH_INTERVAL', 1.0)
+
+    def offer(self, kind, event, block=True):
+        """
+        Queue an event; returns False when the caller must write it itself.
+
+        Async callers pass ``block=False``: waiting for room would stall the event loop.
+        """
+        if not self.enabled or self._stopping:
+            return False
+        self._ensure_started()
+        try:
+            self._queue.put((kind, event), block=block, timeout=getattr(settings, 'TRACKING_BUFFER_PUT_TIMEOUT', 0.05))
+        except queue.Full:
+            logger.warning("Tracking buffer full, writing %s event synchronously", kind)
+            return False
+        return True
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._queue = queue.Queue(maxsize=getattr(settings, 'TRACKING_BUFFER_SIZE', 10000))
+            self._thread = self._start_flusher()
+            atexit.register(self.close)
+
+    def _start_flusher(self):
+        thread = threading.Thread(target=self._run, name='tracking-flusher', daemon=True)
+        thread.start()
+        return thread
+
+    def _drain(self, wait):
+        """Take up to one batch off the queue, waiting at most ``wait`` seconds for it to fill."""
+        events = []
+        deadline = time.monotonic() + wait
+        while len(events) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0:
+                    events.append(self._queue.get(timeout=remaining))
+                else:
+                    events.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return events
+
+    def flush(self, wait=0):
+        """
+        Write everything currently queued. Returns the number of events written.
+
+        Stops at the first batch the database refuses; that batch is held and
+        is the first one the next flush writes.
+        """
+        if self._queue is None:
+            return 0
+        written = 0
+        with self._flush_lock:
+            while True:
+                events, self._held = self._held or self._drain(wait), []
+                wait = 0
+                if not events:
+                    return written
+                try:
+                    # A bad event is logged and dropped by write_events on its own
+                    written += len(events) - len(write_events(events))
+                    self._backoff = 0
+                except OperationalError:
+                    self._held = events
+                    self._backoff = min(max(self._backoff * 2, RETRY_DELAY), MAX_RETRY_DELAY)
+                    logger.warning(
+                        "Database refused %d buffered tracking events, retrying in %.1fs",
+                        len(events), self._backoff, exc_info=True,
+                    )
+                    return written
+                except Exception:
+                    logger.exception("Failed to write %d buffered tracking events", len(events))
+                finally:
+                    close_old_connections()
+
+    def _run(self):
+        while not self._stopping:
+            self.flush(wait=self.flush_interval)
+            if self._held:
+                time.sleep(self._backoff)
+
+    def close(self):
+        """Stop accepting events and flush what is left (graceful shutdown)."""
+        self._stopping = True
+        for _ in range(SHUTDOWN_ATTEMPTS):
+            self.flush()
+            if not self._held:
+                return
+            time.sleep(self._backoff)
+        logger.error(
+            "Database still refusing writes at shutdown, %d buffered tracking events lost",
+            len(self._held) + self._queue.qsize(),
+        )
+
+
+event_buffer = EventBuffer()
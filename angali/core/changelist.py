@@ -0,0 +1,223 @@
+"""
+Admin changelists for the tracking tables.
+
+``COUNT(*)``, ``OFFSET`` and ``SELECT DISTINCT`` date scans all read the
+whole table, which stops being acceptable at tens of millions of rows:
+
+* ``EstimatedCountPaginator`` reports the planner's row estimate for an
+  unfiltered list above ``ADMIN_ESTIMATED_COUNT_THRESHOLD`` rows. SQLite
+  only keeps one once ANALYZE has run; ``manage.py rollup`` runs it through
+  ``analyze_tables``.
+* ``KeysetChangeList`` pages the default newest-first ordering with
+  ``after``/``before`` cursors on the indexed timestamp, so every page is an
+  index range scan. Sorting by another column falls back to numbered pages.
+* ``day_counts`` feeds the date drilldown from per-day counts cached for
+  ``ADMIN_DATE_HIERARCHY_TTL`` seconds. Sessions and interactions read them
+  from the daily rollups and only scan the rows not rolled up yet. Nothing
+  rolls visitors up by day, so their changelist has no date drilldown.
+* ``related_count`` counts child rows for a list column without the
+  ``GROUP BY`` a ``Count()`` join would add to the changelist's count.
+"""
+import datetime
+
+from django.conf import settings
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.contrib.admin.views.main import ORDER_VAR, PAGE_VAR, ChangeList
+from django.core.cache import cache
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Count, Min, OuterRef, Q, Subquery, Sum
+from django.db.models.functions import Coalesce, TruncDate
+from django.utils import timezone
+from django.utils.functional import cached_property
+
+from .models import RollupWatermark
+from .rollup import ROLLUPS
+
+AFTER_VAR = 'after'  # older than the cursor
+BEFORE_VAR = 'before'  # newer than the cursor
+DAYS_CACHE_KEY = 'admin:days'
+
+
+def table_estimate(model, using):
+    """The database's own estimate of a table's row count, or None when it keeps none."""
+    connection = connections[using]
+    table = model._meta.db_table
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            # reltuples is -1 until the table has been analyzed
+            cursor.execute('SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass', [table])
+        elif connection.vendor == 'sqlite':
+            # Written by ANALYZE; the first number of each row is the table's row count
+            cursor.execute("SELECT name FROM sqlite_master WHERE name = 'sqlite_stat1'")
+            if cursor.fetchone() is None:
+                return None
+            cursor.execute('SELECT stat FROM sqlite_stat1 WHERE tbl = %s LIMIT 1', [table])
+        else:
+            return None
+        row = cursor.fetchone()
+    if row is None:
+        return None
+    estimate = int(str(row[0]).split()[0])
+    return estimate if estimate >= 0 else None
+
+
+def analyze_tables(models, using='default'):
+    """Refresh the statistics ``table_estimate`` reads."""
+    connection = connections[using]
+    if connection.vendor not in ('postgresql', 'sqlite'):
+        return
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            # Samples each index instead of reading it whole (SQLite 3.32+, ignored by older versions)
+            cursor.execute('PRAGMA analysis_limit = 1000')
+        for model in models:
+            cursor.execute(f'ANALYZE {connection.ops.quote_name(model._meta.db_table)}')
+
+
+class EstimatedCountPaginator(Paginator):
+    """Counts unfiltered lists from the table estimate once they are larger than the threshold."""
+
+    estimated = False
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if not queryset.query.where and not queryset.query.distinct:
+            estimate = table_estimate(queryset.model, queryset.db)
+            if estimate is not None and estimate > getattr(settings, 'ADMIN_ESTIMATED_COUNT_THRESHOLD', 100000):
+                self.estimated = True
+                return estimate
+        return super().count
+
+
+def encode_cursor(obj, field):
+    return f'{getattr(obj, field).isoformat()}_{obj.pk}'
+
+
+def decode_cursor(value):
+    timestamp, _, pk = value.rpartition('_')
+    try:
+        return datetime.datetime.fromisoformat(timestamp), int(pk)
+    except ValueError:
+        raise IncorrectLookupParameters(f"Invalid cursor {value!r}")
+
+
+class KeysetChangeList(ChangeList):
+    """
+    Pages the admin's default ordering, newest first on ``keyset_field``, by seeking.
+
+    The rows after the cursor ``(timestamp, pk)`` are found by an index range
+    scan however deep the page is. Rows without a timestamp are only listed
+    when sorting by another column.
+    """
+
+    def __init__(self, request, *args, **kwargs):
+        self.after = request.GET.get(AFTER_VAR)
+        self.before = request.GET.get(BEFORE_VAR)
+        super().__init__(request, *args, **kwargs)
+
+    def get_filters_params(self, params=None):
+        lookup_params = super().get_filters_params(params)
+        lookup_params.pop(AFTER_VAR, None)
+        lookup_params.pop(BEFORE_VAR, None)
+        return lookup_params
+
+    def get_query_string(self, new_params=None, remove=None):
+        # Sorting, filtering and searching links start again from the newest rows
+        new_params = dict(new_params or {})
+        for var in (AFTER_VAR, BEFORE_VAR):
+            new_params.setdefault(var, None)
+        return super().get_query_string(new_params, remove)
+
+    def get_results(self, request):
+        self.keyset = ORDER_VAR not in self.params and PAGE_VAR not in request.GET and not self.show_all
+        if not self.keyset:
+            return super().get_results(request)
+        # The base class would count the rows and then fetch the page with an OFFSET
+        self.paginator = self.model_admin.get_paginator(request, self.queryset, self.list_per_page)
+        self.result_count = self.paginator.count
+        self.show_full_result_count = self.model_admin.show_full_result_count
+        self.full_result_count = self.root_queryset.count() if self.show_full_result_count else None
+        self.show_admin_actions = not self.show_full_result_count or bool(self.full_result_count)
+        self.can_show_all = self.result_count <= self.list_max_show_all
+
+        field = self.model_admin.keyset_field
+        queryset = self.queryset.filter(**{f'{field}__isnull': False})
+        per_page = self.list_per_page
+        rows = None
+        if self.before:
+            newer = list(
+                queryset.filter(seek(field, *decode_cursor(self.before), newer=True)).order_by(field, 'pk')[:per_page + 1]
+            )
+            # Close to the top the page would come up short, so show the newest page instead
+            if len(newer) > per_page:
+                rows, has_newer, has_older = newer[per_page - 1::-1], True, True
+        if rows is None:
+            if self.after:
+                queryset = queryset.filter(seek(field, *decode_cursor(self.after), newer=False))
+            rows = list(queryset.order_by(f'-{field}', '-pk')[:per_page + 1])
+            has_newer, has_older, rows = bool(self.after), len(rows) > per_page, rows[:per_page]
+        self.result_list = rows
+        self.multi_page = has_newer or has_older
+        self.newest_url = self.get_query_string() if has_newer else None
+        self.newer_url = self.get_query_string({BEFORE_VAR: encode_cursor(rows[0], field)}) if has_newer and rows else None
+        self.older_url = self.get_query_string({AFTER_VAR: encode_cursor(rows[-1], field)}) if has_older else None
+
+
+def seek(field, timestamp, pk, newer):
+    """Rows after ``(timestamp, pk)`` in newest-first order, or before it with ``newer``."""
+    op = 'gt' if newer else 'lt'
+    return Q(**{f'{field}__{op}': timestamp}) | Q(**{field: timestamp, f'pk__{op}': pk})
+
+
+def related_count(model, field):
+    """Rows of ``model`` whose ``field`` points at the outer row, as a correlated subquery."""
+    rows = model.objects.filter(**{field: OuterRef('pk')}).order_by().values(field).annotate(rows=Count('pk'))
+    return Coalesce(Subquery(rows.values('rows')), 0)
+
+
+def scan_day_counts(queryset, field):
+    rows = (
+        queryset.filter(**{f'{field}__isnull': False})
+        .annotate(day=TruncDate(field)).values('day').annotate(rows=Count('pk')).order_by('day')
+    )
+    return {row['day']: row['rows'] for row in rows}
+
+
+def rolled_up_day_counts(model, field):
+    """
+    ``{date: rows}`` from the daily rollups plus the rows above their watermark.
+
+    None when no rollup covers ``model`` by ``field``. Rollup days before the
+    oldest remaining row have been pruned and are left out.
+    """
+    for name, (rollup_model, raw_model, raw_field, _) in ROLLUPS.items():
+        if raw_model is model and raw_field == field:
+            break
+    else:
+        return None
+    first = model._base_manager.aggregate(first=Min(field))['first']
+    if first is None:
+        return {}
+    last_id = RollupWatermark.objects.filter(name=name).values_list('last_id', flat=True).first() or 0
+    # The rollup's row count column is named after the rollup: sessions, interactions
+    days = dict(
+        rollup_model.objects.filter(day__gte=timezone.localdate(first))
+        .values('day').annotate(rows=Sum(name)).order_by().values_list('day', 'rows')
+    )
+    for day, rows in scan_day_counts(model._base_manager.filter(pk__gt=last_id), field).items():
+        days[day] = days.get(day, 0) + rows
+    return {day: rows for day, rows in days.items() if rows}
+
+
+def day_counts(model, field):
+    """``{date: rows}`` for every local day with rows, cached for ``ADMIN_DATE_HIERARCHY_TTL`` seconds."""
+    key = f'{DAYS_CACHE_KEY}:{model._meta.label_lower}:{field}'
+    days = cache.get(key)
+    if days is None:
+        days = rolled_up_day_counts(model, field)
+        if days is None:
+            days = scan_day_counts(model._base_manager.all(), field)
+        cache.set(key, days, getattr(settings, 'ADMIN_DATE_HIERARCHY_TTL', 60 * 10))
+    return days
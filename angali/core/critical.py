@@ -0,0 +1,277 @@
+"""
+Critical CSS for the landing page.
+
+``build_critical_css`` keeps the rules of the theme stylesheet whose
+selectors can match an element above the fold: the navbar in
+files/index.html and the hero partial. Matching is judged by the tag names,
+classes and ids written in those templates. Rules for interaction states
+(``:hover``, ``:focus``...) and for the inside of components hidden at first
+paint (modals, dropdown menus) are left to the full stylesheet, and so are
+declarations that only matter once the page is used (transitions, cursors)
+and custom properties nothing kept reads. The result is committed as the
+files/critical.css template, which index.html inlines in ``<head>`` while
+the full stylesheet loads asynchronously. It is inlined into every page, so
+it has to stay within ``CRITICAL_CSS_BUDGET`` bytes, by default the 14 KB
+that fit the first round trip. Regenerate it with
+``manage.py extract_critical_css`` after changing the templates or the theme.
+"""
+import os
+import posixpath
+import re
+from html.parser import HTMLParser
+
+from django.conf import settings
+from django.contrib.staticfiles import finders
+
+from .landing import landing_template_paths
+
+SOURCE_STYLESHEET = 'assets/css/theme.css'
+OUTPUT_TEMPLATE = 'critical.css'  # next to files/index.html
+ABOVE_THE_FOLD_PARTIALS = ['hero.html']  # under files/landing/
+
+TEMPLATE_SYNTAX_RE = re.compile(r'{%.*?%}|{{.*?}}|{#.*?#}', re.S)
+COMMENT_RE = re.compile(r'/\*.*?\*/', re.S)
+PSEUDO_RE = re.compile(r'::?[a-zA-Z-]+(\((?:[^()]|\([^()]*\))*\))?')
+ATTRIBUTE_RE = re.compile(r'\[[^\]]*\]')
+CLASS_RE = re.compile(r'\.(-?[_a-zA-Z][\w-]*)')
+ID_RE = re.compile(r'#(-?[_a-zA-Z][\w-]*)')
+TAG_RE = re.compile(r'(?:^|[\s>+~])([a-zA-Z][\w-]*)')
+URL_RE = re.compile(r'url\(\s*([\'"]?)([^\'")]+)\1\s*\)')
+KEYFRAMES_RE = re.compile(r'@(?:-webkit-)?keyframes\s+([\w-]+)')
+NAV_END_RE = re.compile(r'</nav\s*>', re.I)
+STATE_RE = re.compile(
+    r':(?:hover|focus|focus-visible|focus-within|active|visited|disabled|checked|indeterminate|valid|invalid)\b'
+    r'|::?-(?:webkit|moz|ms)-|::(?:placeholder|selection|file-selector-button)'
+)
+# Only these elements themselves are matched, so their display:none still applies
+HIDDEN_CLASSES = {'modal', 'dropdown-menu'}
+# Properties with no effect on the first paint
+AFTER_PAINT_RE = re.compile(
+    r'^(?:-(?:webkit|moz|ms|o)-)?(?:transition(?:-[\w-]+)?|cursor|user-select|pointer-events|will-change|scroll-behavior)$'
+)
+VAR_RE = re.compile(r'var\(\s*(--[\w-]+)')
+
+
+class _UsedSelectors(HTMLParser):
+    def __init__(self):
+        super().__init__()
+        self.tags = {'html', 'body'}
+        self.classes = set()
+        self.ids = set()
+        self._hidden = None  # [tag, open count] of the hidden element being skipped
+
+    def handle_starttag(self, tag, attrs):
+        if self._hidden:
+            if tag == self._hidden[0]:
+                self._hidden[1] += 1
+            return
+        self.tags.add(tag)
+        for name, value in attrs:
+            if name == 'class' and value:
+                self.classes.update(value.split())
+                if HIDDEN_CLASSES.intersection(value.split()):
+                    self._hidden = [tag, 1]
+            elif name == 'id' and value:
+                self.ids.add(value.strip())
+
+    def handle_endtag(self, tag):
+        if self._hidden and tag == self._hidden[0]:
+            self._hidden[1] -= 1
+            if not self._hidden[1]:
+                self._hidden = None
+
+
+def used_selectors(sources):
+    """Tag names, classes and ids written in template sources, with template syntax removed."""
+    parser = _UsedSelectors()
+    for source in sources:
+        parser.feed(TEMPLATE_SYNTAX_RE.sub(' ', source))
+    parser.close()
+    return parser
+
+
+def split_top_level(text, separator=','):
+    """Split on ``separator`` outside parentheses, e.g. selector lists containing :not(a, b)."""
+    parts, depth, start = [], 0, 0
+    for index, char in enumerate(text):
+        if char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        elif char == separator and depth == 0:
+            parts.append(text[start:index])
+            start = index + 1
+    parts.append(text[start:])
+    return parts
+
+
+def parse_blocks(css):
+    """Yield ``(prelude, body)`` for each top-level block; bodies may hold nested blocks."""
+    index, length = 0, len(css)
+    while index < length:
+        brace = css.find('{', index)
+        if brace == -1:
+            return
+        depth, end, quote = 1, brace + 1, None
+        while end < length and depth:
+            char = css[end]
+            if quote:
+                if char == '\\':
+                    end += 1
+                elif char == quote:
+                    quote = None
+            elif char in '"\'':
+                quote = char
+            elif char == '{':
+                depth += 1
+            elif char == '}':
+                depth -= 1
+            end += 1
+        # Statements like @charset end in a semicolon before the next block starts
+        prelude = css[index:brace].rsplit(';', 1)[-1].strip()
+        yield prelude, css[brace + 1:end - 1]
+        index = end
+
+
+def selector_used(selector, used):
+    """True when every tag, class and id in ``selector`` appears in the templates."""
+    simple = ATTRIBUTE_RE.sub('', PSEUDO_RE.sub('', selector))
+    return (
+        all(name in used.classes for name in CLASS_RE.findall(simple))
+        and all(name in used.ids for name in ID_RE.findall(simple))
+        and all(name.lower() in used.tags for name in TAG_RE.findall(CLASS_RE.sub('', ID_RE.sub('', simple))))
+    )
+
+
+def property_name(declaration):
+    return declaration.split(':', 1)[0].strip().lower()
+
+
+def compact(body):
+    declarations = (declaration.strip() for declaration in body.split(';'))
+    return ';'.join(
+        ' '.join(declaration.split()) for declaration in declarations
+        if declaration and not AFTER_PAINT_RE.match(property_name(declaration))
+    )
+
+
+def _declarations(rules):
+    for _, body in rules:
+        if isinstance(body, list):
+            yield from _declarations(body)
+        elif '{' not in body:  # not a keyframe
+            yield from body.split(';')
+
+
+def drop_unused_custom_properties(rules):
+    """Leave out the ``--name`` declarations that no kept declaration reads, directly or through another."""
+    declarations = list(_declarations(rules))
+    read = set()
+    while True:
+        found = {
+            name for declaration in declarations
+            if not declaration.startswith('--') or property_name(declaration) in read
+            for name in VAR_RE.findall(declaration)
+        }
+        if found <= read:
+            break
+        read |= found
+
+    def keep(rules):
+        kept = []
+        for prelude, body in rules:
+            if isinstance(body, list):
+                body = keep(body)
+            elif '{' not in body:
+                body = ';'.join(
+                    declaration for declaration in body.split(';')
+                    if not declaration.startswith('--') or property_name(declaration) in read
+                )
+            if body:
+                kept.append((prelude, body))
+        return kept
+    return keep(rules)
+
+
+def rewrite_urls(body):
+    """Relative url()s would resolve against the page once inlined, so point them at the static file."""
+    def replace(match):
+        url = match.group(2).strip()
+        if url.startswith(('data:', '/', 'http:', 'https:', '#')):
+            return match.group(0)
+        path = posixpath.normpath(posixpath.join(posixpath.dirname(SOURCE_STYLESHEET), url))
+        return "url({%% static '%s' %%})" % path
+    return URL_RE.sub(replace, body)
+
+
+def extract_rules(css, used):
+    """The rules of ``css`` that can match, plus the @keyframes they name, as (prelude, body) lines."""
+    kept = []
+    keyframes = {}
+    for prelude, body in parse_blocks(css):
+        keyframe = KEYFRAMES_RE.match(prelude)
+        if keyframe:
+            keyframes.setdefault(keyframe.group(1), []).append((prelude, body))
+        elif prelude.startswith(('@media', '@supports')):
+            nested = extract_rules(body, used)
+            if nested:
+                kept.append((' '.join(prelude.split()), nested))
+        elif prelude.startswith('@'):
+            continue
+        else:
+            selectors = [
+                ' '.join(s.split()) for s in split_top_level(prelude)
+                if not STATE_RE.search(s) and selector_used(s, used)
+            ]
+            if selectors and compact(body):
+                kept.append((','.join(selectors), compact(body)))
+    text = repr(kept)
+    for name, blocks in keyframes.items():
+        if re.search(r'\b%s\b' % re.escape(name), text):
+            kept.extend((' '.join(prelude.split()), ' '.join(body.split())) for prelude, body in blocks)
+    return kept
+
+
+def render_rules(rules):
+    lines = []
+    for prelude, body in rules:
+        if isinstance(body, list):
+            # The newline after "{" keeps a nested "#id" selector from reading as a {# comment
+            lines.append(prelude + '{\n' + render_rules(body) + '}')
+        else:
+            lines.append(prelude + '{' + body + '}')
+    return '\n'.join(lines) + '\n'
+
+
+def above_the_fold_sources():
+    """files/index.html up to the end of its navbar, then the partials shown with it."""
+    index_path, *partial_paths = landing_template_paths()
+    with open(index_path, encoding='utf-8') as f:
+        index = f.read()
+    nav_end = NAV_END_RE.search(index)
+    sources = [index[:nav_end.end()] if nav_end else index]
+    for path in partial_paths:
+        if os.path.basename(path) in ABOVE_THE_FOLD_PARTIALS:
+            with open(path, encoding='utf-8') as f:
+                sources.append(f.read())
+    return sources
+
+
+def build_critical_css():
+    """The files/critical.css template for the current templates and theme."""
+    with open(finders.find(SOURCE_STYLESHEET), encoding='utf-8') as f:
+        css = COMMENT_RE.sub('', f.read())
+    rules = drop_unused_custom_properties(extract_rules(css, used_selectors(above_the_fold_sources())))
+    header = (
+        '{% load static %}{# Generated by manage.py extract_critical_css from '
+        + SOURCE_STYLESHEET + '; do not edit. #}'
+    )
+    return header + rewrite_urls(render_rules(rules))
+
+
+def size_budget():
+    return getattr(settings, 'CRITICAL_CSS_BUDGET', 14 * 1024)
+
+
+def output_path():
+    return os.path.join(os.path.dirname(landing_template_paths()[0]), OUTPUT_TEMPLATE)
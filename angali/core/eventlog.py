@@ -0,0 +1,188 @@
+"""
+Append-only event log for tracking events.
+
+Records are ``(length, crc32)`` headers (big-endian ``>II``) followed by a
+JSON payload ``{"kind": ..., "event": ...}``. Each process buffers records in
+memory and appends them to the current segment with a single ``write`` on an
+``O_APPEND`` descriptor, so records from several gunicorn workers never
+interleave. Segments are cut by time (``EVENT_LOG_SEGMENT_SECONDS``): a segment
+only receives writes during its own period, after which it is sealed and can
+be compacted into the database by ``manage.py compact_events``.
+"""
+import atexit
+import json
+import logging
+import os
+import struct
+import threading
+import time
+import zlib
+
+from django.conf import settings
+
+from .ingest import check_event
+
+logger = logging.getLogger(__name__)
+
+RECORD_HEADER = struct.Struct('>II')
+SEGMENT_PREFIX = 'segment-'
+SEGMENT_SUFFIX = '.log'
+QUARANTINE_NAME = 'quarantine.log'  # records compaction could not write, in segment format
+SEAL_GRACE_SECONDS = 5  # allow in-flight appends to land before a segment is read
+
+
+def log_dir():
+    return str(getattr(settings, 'EVENT_LOG_DIR'))
+
+
+def segment_seconds():
+    return getattr(settings, 'EVENT_LOG_SEGMENT_SECONDS', 300)
+
+
+def segment_name(at=None):
+    """Segment names sort in time order: segment-<period start, epoch seconds>.log"""
+    period = segment_seconds()
+    start = int((time.time() if at is None else at) // period * period)
+    return f'{SEGMENT_PREFIX}{start:012d}{SEGMENT_SUFFIX}'
+
+
+def encode_record(kind, event):
+    payload = json.dumps({'kind': kind, 'event': event}, separators=(',', ':')).encode('utf-8')
+    return RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def read_segment(path, offset=0):
+    """
+    Yield ``(next_offset, kind, event)`` for each complete record from ``offset``.
+
+    Stops at the first truncated or corrupt record, which is what a torn
+    write at a crash leaves behind.
+    """
+    with open(path, 'rb', buffering=1024 * 1024) as f:
+        f.seek(offset)
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            length, checksum = RECORD_HEADER.unpack(header)
+            payload = f.read(length)
+            if len(payload) < length or zlib.crc32(payload) != checksum:
+                logger.warning("Stopping at corrupt record in %s at offset %d", path, offset)
+                return
+            offset += RECORD_HEADER.size + length
+            record = json.loads(payload)
+            yield offset, record.get('kind'), record.get('event')
+
+
+def quarantine(records):
+    """Append ``(kind, event)`` records to the quarantine file, where they can be inspected or replayed."""
+    if not records:
+        return
+    with open(os.path.join(log_dir(), QUARANTINE_NAME), 'ab') as f:
+        f.write(b''.join(encode_record(kind, event) for kind, event in records))
+
+
+def sealed_segments():
+    """Segment file names, oldest first, that no writer will append to any more."""
+    try:
+        names = os.listdir(log_dir())
+    except FileNotFoundError:
+        return []
+    current = segment_name(time.time() - SEAL_GRACE_SECONDS)
+    return sorted(
+        name for name in names
+        if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX) and name < current
+    )
+
+
+class EventLogWriter:
+    """
+    Per-process buffered appender.
+
+    Records collect in memory until ``EVENT_LOG_BUFFER_BYTES`` is reached or
+    ``EVENT_LOG_FLUSH_INTERVAL`` passes (checked on append and by a daemon
+    thread), and are flushed at interpreter exit.
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._lock = threading.Lock()
+        self._last_flush = time.monotonic()
+        self._thread = None
+
+    @property
+    def enabled(self):
+        return getattr(settings, 'TRACKING_EVENT_LOG', False)
+
+    @property
+    def flush_interval(self):
+        return getattr(settings, 'EVENT_LOG_FLUSH_INTERVAL', 1.0)
+
+    def append(self, kind, event):
+        """
+        Buffer an event; returns False when the event log is disabled.
+
+        Raises ``ValueError`` for an event that could not be compacted.
+        """
+        if not self.enabled:
+            return False
+        check_event(kind, event)
+        self._ensure_started()
+        record = encode_record(kind, event)
+        with self._lock:
+            self._buffer += record
+            if (len(self._buffer) >= getattr(settings, 'EVENT_LOG_BUFFER_BYTES', 64 * 1024)
+                    or time.monotonic() - self._last_flush >= self.flush_interval):
+                self._flush_locked()
+        return True
+
+    def flush(self):
+        with self._lock:
+            self._flush_locked()
+
+    def _flush_locked(self):
+        self._last_flush = time.monotonic()
+        if not self._buffer:
+            return
+        data, self._buffer = self._buffer, bytearray()
+        try:
+            os.makedirs(log_dir(), exist_ok=True)
+            fd = os.open(os.path.join(log_dir(), segment_name()), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                # One write per flush keeps whole records contiguous between processes
+                written = os.write(fd, data)
+                while written < len(data):
+                    written += os.write(fd, data[written:])
+                if getattr(settings, 'EVENT_LOG_FSYNC', False):
+                    os.fsync(fd)
+            finally:
+                os.close(fd)
+        except OSError:
+            # Keep the records for the next attempt
+            self._buffer[:0] = data
+            raise
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = self._start_flusher()
+            atexit.register(self.flush)
+
+    def _start_flusher(self):
+        thread = threading.Thread(target=self._run, name='event-log-flusher', daemon=True)
+        thread.start()
+        return thread
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except OSError:
+                logger.exception("Failed to flush the tracking event log")
+
+
+event_log = EventLogWriter()
@@ -0,0 +1,244 @@
+"""
+Offline IP → location lookups from a compiled, memory-mapped range database.
+
+File layout (all integers big-endian)::
+
+    header   magic b'AGEO', version (H), reserved (H),
+             ipv4 record count (I), ipv6 record count (I), location count (I)
+    ipv4     records of (start I, end I, location index I), sorted by start
+    ipv6     records of (start 16s, end 16s, location index I), sorted by start
+    offsets  location count + 1 offsets (I) into the string blob
+    strings  UTF-8 'City, Country' strings
+
+The file is opened with ``mmap`` so every worker process shares the same
+page-cache pages, and lookups are a binary search over fixed-size records.
+Build it with ``manage.py compile_geoip``.
+"""
+import csv
+import ipaddress
+import mmap
+import os
+import struct
+import tempfile
+import threading
+
+from django.conf import settings
+
+MAGIC = b'AGEO'
+VERSION = 1
+HEADER = struct.Struct('>4sHHIII')
+IPV4_RECORD = struct.Struct('>III')
+IPV6_RECORD = struct.Struct('>16s16sI')
+OFFSET = struct.Struct('>I')
+
+
+class RangeDatabaseError(Exception):
+    pass
+
+
+def parse_address(ip_address):
+    """Return an ``ipaddress`` object, unwrapping IPv4-mapped IPv6 addresses."""
+    address = ipaddress.ip_address(ip_address)
+    if address.version == 6 and address.ipv4_mapped:
+        return address.ipv4_mapped
+    return address
+
+
+def read_ranges(csv_file):
+    """
+    Yield ``(first, last, location)`` from a CSV range dump.
+
+    Either a ``network`` column with CIDR blocks or ``start_ip``/``end_ip``
+    columns are accepted, alongside ``city`` and ``country``.
+    """
+    for row in csv.DictReader(csv_file):
+        if row.get('network'):
+            network = ipaddress.ip_network(row['network'].strip(), strict=False)
+            first, last = network.network_address, network.broadcast_address
+        else:
+            first = ipaddress.ip_address(row['start_ip'].strip())
+            last = ipaddress.ip_address(row['end_ip'].strip())
+        if first.version != last.version or first > last:
+            raise RangeDatabaseError(f"Invalid range {first} - {last}")
+        location = f"{row.get('city', '').strip()}, {row.get('country', '').strip()}"
+        yield first, last, location
+
+
+def flatten_ranges(records):
+    """
+    Turn ``(first, last, location index)`` records into sorted, disjoint ones.
+
+    A range nested inside a broader one wins over it: the enclosing range is
+    split around it. Returns ``(records, skipped)`` where ``skipped`` counts
+    duplicates and ranges that only partly overlap an earlier one.
+    """
+    # Enclosing ranges sort before the ranges nested in them
+    records = sorted(records, key=lambda record: (record[0], -record[1]))
+    flat = []
+    open_ranges = []  # enclosing chain; the innermost range is last
+    cursor = None  # first address not written yet
+    skipped = 0
+
+    def write_up_to(last):
+        nonlocal cursor
+        if open_ranges and cursor <= last:
+            flat.append((cursor, last, open_ranges[-1][2]))
+        cursor = last + 1
+
+    for record in records:
+        first, last, _ = record
+        while open_ranges and open_ranges[-1][1] < first:
+            write_up_to(open_ranges[-1][1])
+            open_ranges.pop()
+        if open_ranges:
+            enclosing = open_ranges[-1]
+            if last > enclosing[1] or (first, last) == enclosing[:2]:
+                skipped += 1
+                continue
+            write_up_to(first - 1)
+        else:
+            cursor = first
+        open_ranges.append(record)
+    while open_ranges:
+        write_up_to(open_ranges[-1][1])
+        open_ranges.pop()
+    return flat, skipped
+
+
+def compile_ranges(ranges, path):
+    """
+    Write ``(first, last, location)`` ranges to ``path`` atomically.
+
+    Returns ``(ipv4_count, ipv6_count, skipped)``; see ``flatten_ranges`` for
+    how nested and overlapping ranges are handled.
+    """
+    locations = {}
+    tables = {4: [], 6: []}
+    for first, last, location in ranges:
+        index = locations.setdefault(location, len(locations))
+        tables[first.version].append((int(first), int(last), index))
+
+    skipped = 0
+    for version, records in tables.items():
+        tables[version], dropped = flatten_ranges(records)
+        skipped += dropped
+
+    strings = [location.encode('utf-8') for location in locations]
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            out.write(HEADER.pack(MAGIC, VERSION, 0, len(tables[4]), len(tables[6]), len(strings)))
+            for first, last, index in tables[4]:
+                out.write(IPV4_RECORD.pack(first, last, index))
+            for first, last, index in tables[6]:
+                out.write(IPV6_RECORD.pack(first.to_bytes(16, 'big'), last.to_bytes(16, 'big'), index))
+            offset = 0
+            for string in strings:
+                out.write(OFFSET.pack(offset))
+                offset += len(string)
+            out.write(OFFSET.pack(offset))
+            for string in strings:
+                out.write(string)
+        # mkstemp creates the file 0600; workers may run as another user
+        os.chmod(tmp_path, 0o644)
+        # Replacing the file keeps mappings held by running workers valid
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return len(tables[4]), len(tables[6]), skipped
+
+
+class RangeDatabase:
+    """Read-only view over a compiled range database file."""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, _, self.ipv4_count, self.ipv6_count, self.location_count = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != VERSION:
+            self._map.close()
+            raise RangeDatabaseError(f"{path} is not a version {VERSION} range database")
+        self._ipv4_start = HEADER.size
+        self._ipv6_start = self._ipv4_start + self.ipv4_count * IPV4_RECORD.size
+        self._offsets_start = self._ipv6_start + self.ipv6_count * IPV6_RECORD.size
+        self._strings_start = self._offsets_start + (self.location_count + 1) * OFFSET.size
+
+    def close(self):
+        self._map.close()
+
+    def _search(self, key, table_start, count, record):
+        """Binary search for the last record starting at or before ``key``."""
+        low, high = 0, count
+        while low < high:
+            mid = (low + high) // 2
+            if record.unpack_from(self._map, table_start + mid * record.size)[0] <= key:
+                low = mid + 1
+            else:
+                high = mid
+        if low == 0:
+            return None
+        first, last, index = record.unpack_from(self._map, table_start + (low - 1) * record.size)
+        return index if key <= last else None
+
+    def _location(self, index):
+        start, end = struct.unpack_from('>II', self._map, self._offsets_start + index * OFFSET.size)
+        return self._map[self._strings_start + start:self._strings_start + end].decode('utf-8')
+
+    def lookup(self, ip_address):
+        """Return the location string for ``ip_address`` or ``None`` when no range matches."""
+        try:
+            address = parse_address(ip_address)
+        except ValueError:
+            return None
+        if address.version == 4:
+            index = self._search(int(address), self._ipv4_start, self.ipv4_count, IPV4_RECORD)
+        else:
+            index = self._search(address.packed, self._ipv6_start, self.ipv6_count, IPV6_RECORD)
+        return None if index is None else self._location(index)
+
+
+class RangeDatabaseBackend:
+    """
+    Geolocation backend reading ``settings.GEOIP_DATABASE_PATH``.
+
+    The file is mapped lazily (after gunicorn forks) and re-mapped when
+    ``compile_geoip`` replaces it. A missing file resolves nothing, so the
+    next backend in ``VISITOR_GEOLOCATION_BACKENDS`` takes over.
+    """
+    network = False
+
+    def __init__(self, path=None):
+        self.path = path or getattr(settings, 'GEOIP_DATABASE_PATH', None)
+        self._database = None
+        self._mtime = None
+        self._lock = threading.Lock()
+
+    def _get_database(self):
+        if not self.path:
+            return None
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            return None
+        if mtime != self._mtime:
+            with self._lock:
+                if mtime != self._mtime:
+                    # The old mapping is left for the garbage collector so that
+                    # concurrent lookups holding it keep working.
+                    self._database = RangeDatabase(self.path)
+                    self._mtime = mtime
+        return self._database
+
+    def lookup_many(self, ip_addresses):
+        database = self._get_database()
+        if database is None:
+            return {}
+        locations = {}
+        for ip_address in ip_addresses:
+            location = database.lookup(ip_address)
+            if location is not None:
+                locations[ip_address] = location
+        return locations
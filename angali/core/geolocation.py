@@ -0,0 +1,568 @@
+import asyncio
+import functools
+import logging
+import queue
+import threading
+import time
+from collections import OrderedDict
+
+import requests
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.db import close_old_connections, connection
+from django.db.models import Case, F, Value, When
+from django.utils.module_loading import import_string
+
+from .instrumentation import timed
+from .metrics import CACHE_LOOKUPS, GEOLOCATION_FAILURES, GEOLOCATION_SECONDS
+from .models import Visitor
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+logger = logging.getLogger(__name__)
+
+# Placeholder stored on new visitors until the background workers resolve them.
+PENDING_LOCATION = 'Pending'
+UNKNOWN_LOCATION = 'Unknown'
+
+IP_API_BATCH_URL = 'http://ip-api.com/batch'
+IP_API_BATCH_LIMIT = 100  # ip-api.com rejects batches larger than this
+IP_API_FIELDS = 'status,city,country,query'
+IP_API_RATE_LIMIT_WINDOW = 60  # seconds to back off when a refusal has no X-Ttl
+APPLY_CHUNK_SIZE = 500  # IPs per UPDATE, where the database has no bound parameter limit
+
+# Local lookups first, the HTTP API for whatever they cannot answer
+DEFAULT_BACKENDS = [
+    'core.geoip.RangeDatabaseBackend',
+    'core.geolocation.IPApiBackend',
+]
+
+
+def format_location(data):
+    """Turn an ip-api.com response object into our 'City, Country' string."""
+    if not data or data.get('status') == 'fail':
+        return UNKNOWN_LOCATION
+    return f"{data.get('city')}, {data.get('country')}"
+
+
+class IPApiBackend:
+    """
+    Geolocation backend calling the ip-api.com HTTP API.
+
+    Only addresses the API answered are returned; a batch that failed or was
+    refused leaves its addresses out, so their visitors stay pending and are
+    retried later. ip-api.com reports its rate limit in the ``X-Rl`` (requests
+    left) and ``X-Ttl`` (seconds until the window resets) headers: once no
+    requests are left the next batch waits for the reset, and a 429 ends the
+    lookup.
+    """
+    network = True
+
+    def __init__(self):
+        # One instance per process, shared by every thread and event loop
+        self._resume_at = 0.0
+
+    @property
+    def batch_url(self):
+        return getattr(settings, 'VISITOR_GEOLOCATION_IP_API_URL', IP_API_BATCH_URL)
+
+    def _note_rate_limit(self, response):
+        """Record when requests may resume; returns True if the response was refused for the rate limit."""
+        refused = response.status_code == 429
+        if refused or response.headers.get('X-Rl') == '0':
+            try:
+                ttl = int(response.headers.get('X-Ttl'))
+            except (TypeError, ValueError):
+                ttl = IP_API_RATE_LIMIT_WINDOW
+            self._resume_at = max(self._resume_at, time.monotonic() + ttl)
+        return refused
+
+    def _wait(self):
+        return max(0.0, self._resume_at - time.monotonic())
+
+    def _failed(self, reason, chunk):
+        GEOLOCATION_FAILURES.inc(backend=type(self).__name__)
+        logger.warning("ip-api.com lookup failed (%s), leaving %d IPs pending", reason, len(chunk))
+
+    def lookup_many(self, ip_addresses):
+        """Resolve many IP addresses with as few ip-api.com round-trips as possible."""
+        ip_addresses = list(ip_addresses)
+        locations = {}
+        for start in range(0, len(ip_addresses), IP_API_BATCH_LIMIT):
+            chunk = ip_addresses[start:start + IP_API_BATCH_LIMIT]
+            delay = self._wait()
+            if delay:
+                time.sleep(delay)
+            try:
+                response = requests.post(
+                    self.batch_url,
+                    json=chunk,
+                    params={'fields': IP_API_FIELDS},
+                    timeout=5,
+                )
+                if self._note_rate_limit(response):
+                    self._failed('rate limited', ip_addresses[start:])
+                    break
+                response.raise_for_status()
+                results = response.json()
+            except (requests.exceptions.RequestException, ValueError) as exc:
+                self._failed(repr(exc), chunk)
+                continue
+            locations.update(answered_locations(results))
+        return locations
+
+    async def alookup_many(self, ip_addresses):
+        """
+        ``lookup_many`` for the event loop: the batches go out concurrently over
+        httpx, at most ``VISITOR_GEOLOCATION_CONCURRENCY`` at a time. Without
+        httpx installed the blocking client runs in a worker thread instead.
+        """
+        if httpx is None:
+            return await sync_to_async(self.lookup_many, thread_sensitive=False)(ip_addresses)
+        ip_addresses = list(ip_addresses)
+        slots = request_slots()
+        refused = False
+
+        async def fetch(client, chunk):
+            nonlocal refused
+            async with slots:
+                delay = self._wait()
+                if delay:
+                    await asyncio.sleep(delay)
+                if refused:
+                    return []
+                try:
+                    response = await client.post(self.batch_url, json=chunk, params={'fields': IP_API_FIELDS})
+                    if self._note_rate_limit(response):
+                        refused = True
+                        self._failed('rate limited', chunk)
+                        return []
+                    response.raise_for_status()
+                    return response.json()
+                except (httpx.HTTPError, ValueError) as exc:
+                    self._failed(repr(exc), chunk)
+                    return []
+
+        async with httpx.AsyncClient(timeout=5) as client:
+            batches = await asyncio.gather(*(
+                fetch(client, ip_addresses[start:start + IP_API_BATCH_LIMIT])
+                for start in range(0, len(ip_addresses), IP_API_BATCH_LIMIT)
+            ))
+        locations = {}
+        for results in batches:
+            locations.update(answered_locations(results))
+        return locations
+
+
+def answered_locations(results):
+    """``{ip: location}`` for the entries of an ip-api.com batch response; 'fail' answers map to 'Unknown'."""
+    if not isinstance(results, list):
+        return {}
+    return {
+        data['query']: format_location(data)
+        for data in results
+        if isinstance(data, dict) and data.get('query')
+    }
+
+
+def for_running_loop(registry, factory):
+    """``registry``'s entry for the running event loop, created by ``factory(loop)`` on first use."""
+    loop = asyncio.get_running_loop()
+    if loop not in registry:
+        # Entries hold their loop strongly, so closed loops are dropped by hand
+        for closed in [other for other in registry if other.is_closed()]:
+            del registry[closed]
+        registry[loop] = factory(loop)
+    return registry[loop]
+
+
+_request_slots = {}  # event loop -> asyncio.Semaphore
+
+
+def request_slots():
+    """Semaphore capping the running event loop's concurrent geolocation requests."""
+    return for_running_loop(
+        _request_slots, lambda loop: asyncio.Semaphore(getattr(settings, 'VISITOR_GEOLOCATION_CONCURRENCY', 4)),
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def _load_backends(paths):
+    return [import_string(path)() for path in paths]
+
+
+def get_backends(network=True):
+    """Instantiate ``settings.VISITOR_GEOLOCATION_BACKENDS`` once per process, in order."""
+    paths = tuple(getattr(settings, 'VISITOR_GEOLOCATION_BACKENDS', DEFAULT_BACKENDS))
+    backends = _load_backends(paths)
+    return backends if network else [backend for backend in backends if not backend.network]
+
+
+class LocationCache:
+    """
+    Two-tier cache of IP → location results.
+
+    The first tier is a per-process LRU bounded by size and TTL; the second
+    goes through Django's cache framework so every worker shares results.
+    'Unknown' answers are cached too, for a shorter time. Lookups that failed
+    are never stored.
+    """
+    KEY_PREFIX = 'geolocation:'
+
+    def __init__(self):
+        self._entries = OrderedDict()  # ip -> (location, expires_at)
+        self._lock = threading.Lock()
+        self.local_hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+
+    @property
+    def max_size(self):
+        return getattr(settings, 'VISITOR_GEOLOCATION_CACHE_SIZE', 10000)
+
+    def _ttl(self, location):
+        if location == UNKNOWN_LOCATION:
+            return getattr(settings, 'VISITOR_GEOLOCATION_NEGATIVE_CACHE_TTL', 3600)
+        return getattr(settings, 'VISITOR_GEOLOCATION_CACHE_TTL', 86400)
+
+    def _shared(self):
+        return caches[getattr(settings, 'VISITOR_GEOLOCATION_CACHE_ALIAS', 'default')]
+
+    def _remember(self, ip_address, location, now):
+        """Store in the local tier. Caller must hold the lock."""
+        self._entries[ip_address] = (location, now + self._ttl(location))
+        self._entries.move_to_end(ip_address)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def _get_local(self, ip_addresses):
+        """Split into ``(found, missing)`` using the local tier alone."""
+        found = {}
+        missing = []
+        now = time.monotonic()
+        with self._lock:
+            for ip_address in ip_addresses:
+                entry = self._entries.get(ip_address)
+                if entry and entry[1] > now:
+                    self._entries.move_to_end(ip_address)
+                    found[ip_address] = entry[0]
+                else:
+                    if entry:
+                        del self._entries[ip_address]
+                    missing.append(ip_address)
+            self.local_hits += len(found)
+        CACHE_LOOKUPS.inc(len(found), cache='location', result='local_hit')
+        return found, missing
+
+    def _take_shared(self, keys, shared, found):
+        """Copy shared-tier hits into the local tier and ``found``."""
+        now = time.monotonic()
+        with self._lock:
+            for key, location in shared.items():
+                self._remember(keys[key], location, now)
+                found[keys[key]] = location
+            self.shared_hits += len(shared)
+            self.misses += len(keys) - len(shared)
+        CACHE_LOOKUPS.inc(len(shared), cache='location', result='shared_hit')
+        CACHE_LOOKUPS.inc(len(keys) - len(shared), cache='location', result='miss')
+        return found
+
+    def get_many(self, ip_addresses):
+        found, missing = self._get_local(ip_addresses)
+        if not missing:
+            return found
+        keys = {self.KEY_PREFIX + ip_address: ip_address for ip_address in missing}
+        return self._take_shared(keys, self._shared().get_many(list(keys)), found)
+
+    async def aget_many(self, ip_addresses):
+        found, missing = self._get_local(ip_addresses)
+        if not missing:
+            return found
+        keys = {self.KEY_PREFIX + ip_address: ip_address for ip_address in missing}
+        return self._take_shared(keys, await self._shared().aget_many(list(keys)), found)
+
+    def _remember_many(self, locations):
+        """Store in the local tier; returns the shared-tier entries grouped by TTL."""
+        now = time.monotonic()
+        by_ttl = {}
+        with self._lock:
+            for ip_address, location in locations.items():
+                self._remember(ip_address, location, now)
+                by_ttl.setdefault(self._ttl(location), {})[self.KEY_PREFIX + ip_address] = location
+        return by_ttl
+
+    def set_many(self, locations):
+        for ttl, entries in self._remember_many(locations).items():
+            self._shared().set_many(entries, timeout=ttl)
+
+    async def aset_many(self, locations):
+        for ttl, entries in self._remember_many(locations).items():
+            await self._shared().aset_many(entries, timeout=ttl)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.local_hits + self.shared_hits + self.misses
+            return {
+                'size': len(self._entries),
+                'local_hits': self.local_hits,
+                'shared_hits': self.shared_hits,
+                'misses': self.misses,
+                'hit_rate': (self.local_hits + self.shared_hits) / lookups if lookups else 0.0,
+            }
+
+    def clear(self):
+        """Empty the local tier and reset the counters. The shared tier expires on its own."""
+        with self._lock:
+            self._entries.clear()
+            self.local_hits = self.shared_hits = self.misses = 0
+
+
+location_cache = LocationCache()
+
+
+def lookup_locations(ip_addresses, network=True):
+    """
+    Resolve IP addresses through the location cache, then each backend in turn.
+
+    Backends only see the addresses earlier ones could not resolve. With
+    ``network=False`` only local backends are consulted. Addresses no backend
+    answered, because a lookup failed or nothing knows them, are left out of
+    the result, so their visitors stay pending for ``resolve_locations``.
+    """
+    locations = location_cache.get_many(set(ip_addresses))
+    pending = set(ip_addresses).difference(locations)
+    resolved = {}
+    with timed('geo'):
+        for backend in get_backends(network=network):
+            if not pending:
+                break
+            with GEOLOCATION_SECONDS.time(backend=type(backend).__name__):
+                found = backend.lookup_many(pending)
+            resolved.update(found)
+            pending.difference_update(found)
+    # Only backend answers are cached, never a lookup that failed
+    location_cache.set_many(resolved)
+    locations.update(resolved)
+    return locations
+
+
+async def alookup_locations(ip_addresses, network=True):
+    """
+    ``lookup_locations`` for the event loop.
+
+    Local backends answer from memory and are called directly; network
+    backends are awaited through their ``alookup_many``, or run in a worker
+    thread when they only have the blocking ``lookup_many``.
+    """
+    locations = await location_cache.aget_many(set(ip_addresses))
+    pending = set(ip_addresses).difference(locations)
+    resolved = {}
+    with timed('geo'):
+        for backend in get_backends(network=network):
+            if not pending:
+                break
+            with GEOLOCATION_SECONDS.time(backend=type(backend).__name__):
+                if hasattr(backend, 'alookup_many'):
+                    found = await backend.alookup_many(pending)
+                elif backend.network:
+                    found = await sync_to_async(backend.lookup_many, thread_sensitive=False)(pending)
+                else:
+                    found = backend.lookup_many(pending)
+            resolved.update(found)
+            pending.difference_update(found)
+    await location_cache.aset_many(resolved)
+    locations.update(resolved)
+    return locations
+
+
+def lookup_location(ip_address, network=True):
+    """Resolve a single IP address. May block on the network unless ``network=False``."""
+    return lookup_locations([ip_address], network=network).get(ip_address)
+
+
+def apply_chunk_size():
+    """IPs per UPDATE within the database's bound parameter limit (999 on older SQLite)."""
+    max_params = connection.features.max_query_params
+    if max_params is None:
+        return APPLY_CHUNK_SIZE
+    # Two parameters per IP in the CASE, one in the IN list, and location = 'Pending'
+    return min(APPLY_CHUNK_SIZE, (max_params - 1) // 3)
+
+
+def _location_updates(locations):
+    """One UPDATE per chunk of IPs, with the location picked per row by a CASE on ip_address."""
+    ip_addresses = list(locations)
+    chunk_size = apply_chunk_size()
+    for start in range(0, len(ip_addresses), chunk_size):
+        chunk = ip_addresses[start:start + chunk_size]
+        # location = 'Pending' is served by the (location, visit_date) index
+        yield Visitor.objects.filter(ip_address__in=chunk, location=PENDING_LOCATION), Case(
+            *(When(ip_address=ip_address, then=Value(locations[ip_address])) for ip_address in chunk),
+            default=F('location'),
+        )
+
+
+def apply_locations(locations):
+    """Store resolved locations on every visitor still pending for that IP."""
+    return sum(pending.update(location=location) for pending, location in _location_updates(locations))
+
+
+async def aapply_locations(locations):
+    updated = 0
+    for pending, location in _location_updates(locations):
+        updated += await pending.aupdate(location=location)
+    return updated
+
+
+def resolve_batch(ip_addresses):
+    """Look up a batch of IPs and write the results back to the visitors table."""
+    ip_addresses = {ip for ip in ip_addresses if ip}
+    if not ip_addresses:
+        return 0
+    return apply_locations(lookup_locations(ip_addresses))
+
+
+async def aresolve_batch(ip_addresses):
+    ip_addresses = {ip for ip in ip_addresses if ip}
+    if not ip_addresses:
+        return 0
+    return await aapply_locations(await alookup_locations(ip_addresses))
+
+
+class GeolocationQueue:
+    """
+    Bounded queue of IP addresses drained by a small pool of daemon threads.
+
+    The middleware only calls ``submit``, which never blocks: when the queue is
+    full the IP is dropped and the visitor stays pending until the
+    ``resolve_locations`` management command sweeps it up.
+    """
+
+    def __init__(self):
+        self._queue = None
+        self._threads = []
+        self._lock = threading.Lock()
+
+    @property
+    def workers(self):
+        return getattr(settings, 'VISITOR_GEOLOCATION_WORKERS', 2)
+
+    @property
+    def batch_size(self):
+        return getattr(settings, 'VISITOR_GEOLOCATION_BATCH_SIZE', IP_API_BATCH_LIMIT)
+
+    @property
+    def flush_interval(self):
+        return getattr(settings, 'VISITOR_GEOLOCATION_FLUSH_INTERVAL', 1.0)
+
+    def submit(self, ip_address):
+        if not ip_address or self.workers <= 0:
+            return False
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(ip_address)
+        except queue.Full:
+            logger.warning("Geolocation queue full, leaving %s pending", ip_address)
+            return False
+        return True
+
+    def _ensure_started(self):
+        if self._threads:
+            return
+        with self._lock:
+            if self._threads:
+                return
+            self._queue = queue.Queue(maxsize=getattr(settings, 'VISITOR_GEOLOCATION_QUEUE_SIZE', 10000))
+            for index in range(self.workers):
+                thread = threading.Thread(
+                    target=self._run,
+                    name=f'geolocation-{index}',
+                    daemon=True,
+                )
+                thread.start()
+                self._threads.append(thread)
+
+    def _next_batch(self):
+        """Block for the first IP, then keep collecting until the batch is full or the interval passes."""
+        batch = {self._queue.get()}
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.add(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                resolve_batch(batch)
+            except Exception:
+                logger.exception("Failed to resolve locations for %d IPs", len(batch))
+            finally:
+                close_old_connections()
+
+
+geolocation_queue = GeolocationQueue()
+
+
+class AsyncGeolocationQueue:
+    """
+    ``GeolocationQueue`` for the async middleware: batches are collected and
+    resolved by tasks on the event loop instead of by threads.
+
+    Each event loop gets its own ``asyncio.Queue`` and
+    ``VISITOR_GEOLOCATION_WORKERS`` consumer tasks, started on first use.
+    """
+
+    def __init__(self):
+        self._queues = {}  # event loop -> (asyncio.Queue, consumer tasks)
+
+    def submit(self, ip_address):
+        workers = geolocation_queue.workers
+        if not ip_address or workers <= 0:
+            return False
+        pending, _ = for_running_loop(self._queues, functools.partial(self._start, workers=workers))
+        try:
+            pending.put_nowait(ip_address)
+        except asyncio.QueueFull:
+            logger.warning("Geolocation queue full, leaving %s pending", ip_address)
+            return False
+        return True
+
+    def _start(self, loop, workers):
+        pending = asyncio.Queue(maxsize=getattr(settings, 'VISITOR_GEOLOCATION_QUEUE_SIZE', 10000))
+        # The tasks are held here: the loop itself only keeps weak references to them
+        return pending, [loop.create_task(self._run(pending)) for _ in range(workers)]
+
+    async def _next_batch(self, pending):
+        batch = {await pending.get()}
+        deadline = time.monotonic() + geolocation_queue.flush_interval
+        while len(batch) < geolocation_queue.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.add(await asyncio.wait_for(pending.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self, pending):
+        while True:
+            batch = await self._next_batch(pending)
+            try:
+                await aresolve_batch(batch)
+            except Exception:
+                logger.exception("Failed to resolve locations for %d IPs", len(batch))
+
+
+async_geolocation_queue = AsyncGeolocationQueue()
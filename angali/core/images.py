@@ -0,0 +1,288 @@
+"""
+Responsive image derivatives.
+
+Every source image (an ImageField upload or a static file) is resized to the
+``RESPONSIVE_IMAGE_WIDTHS`` breakpoints narrower than itself, plus its own
+width, in each of ``RESPONSIVE_IMAGE_FORMATS`` that Pillow can encode. The
+results live in ``RESPONSIVE_IMAGE_ROOT/<source digest>/<width>.<format>``:
+they are keyed by the source's content hash, so they never need invalidating
+and are regenerated only for new content. The ``responsive_sources``
+template tag emits ``<source srcset>`` elements for whatever has been
+generated; pages render the plain ``<img>`` until then.
+
+Derivatives are generated after an upload is saved, by collectstatic for the
+static images under ``RESPONSIVE_IMAGE_STATIC_PREFIXES`` and in bulk by
+``manage.py generate_image_derivatives``, which fans out over a process pool.
+
+Admin thumbnails are generated lazily on first display instead, under
+``THUMBNAIL_ROOT/<digest of the file name>/``, and removed by signals when
+the field's file changes or its row is deleted.
+"""
+import functools
+import hashlib
+import logging
+import os
+import shutil
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from django.contrib.staticfiles import finders
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.db import models, transaction
+from PIL import Image, ImageOps, features
+
+logger = logging.getLogger(__name__)
+
+# Formats in order of preference, with their MIME type and encoder options.
+# WebP method 6 and AVIF's slowest speeds cost 10-50x the time for a few % in size.
+FORMATS = {
+    'avif': ('image/avif', {'quality': 60, 'speed': 6}),
+    'webp': ('image/webp', {'quality': 80, 'method': 4}),
+}
+ORIENTATION_TAG = 0x0112
+RASTER_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp', '.gif', '.bmp', '.tif', '.tiff')
+
+_sources = {}  # (path, mtime_ns, size) -> (digest, width), per process
+_sources_lock = threading.Lock()
+
+
+def image_root():
+    return str(getattr(settings, 'RESPONSIVE_IMAGE_ROOT', os.path.join(settings.MEDIA_ROOT, 'responsive')))
+
+
+def image_url():
+    return getattr(settings, 'RESPONSIVE_IMAGE_URL', settings.MEDIA_URL + 'responsive/')
+
+
+def image_widths():
+    return tuple(sorted(getattr(settings, 'RESPONSIVE_IMAGE_WIDTHS', (320, 640, 960, 1280, 1920))))
+
+
+def image_formats():
+    """The configured formats this Pillow build can write, most preferred first."""
+    configured = getattr(settings, 'RESPONSIVE_IMAGE_FORMATS', list(FORMATS))
+    return tuple(name for name in FORMATS if name in configured and features.check(name))
+
+
+def is_raster(path):
+    return path.lower().endswith(RASTER_EXTENSIONS)
+
+
+def file_digest(path):
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()[:20]
+
+
+def oriented_width(image):
+    """Width once the EXIF orientation is applied, without decoding the pixels."""
+    return image.height if image.getexif().get(ORIENTATION_TAG) in (5, 6, 7, 8) else image.width
+
+
+def source_info(path):
+    """``(digest, width)`` of a source image, read once per process for each version of the file."""
+    stat = os.stat(path)
+    key = (path, stat.st_mtime_ns, stat.st_size)
+    info = _sources.get(key)
+    if info is None:
+        with Image.open(path) as image:
+            info = (file_digest(path), oriented_width(image))
+        with _sources_lock:
+            _sources[key] = info
+    return info
+
+
+def target_widths(width, widths):
+    """Breakpoints narrower than the source, and the source's own width; never upscaled."""
+    return sorted({w for w in widths if w < width} | {width})
+
+
+def generate_derivatives(path, root, widths, formats):
+    """
+    Write the missing derivatives of one source image. Returns how many were written.
+
+    Takes its configuration as arguments rather than reading settings so it
+    can run in a worker process.
+    """
+    digest = file_digest(path)
+    directory = os.path.join(root, digest)
+    written = 0
+    with Image.open(path) as source:
+        image = ImageOps.exif_transpose(source)
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA' if image.has_transparency_data else 'RGB')
+        os.makedirs(directory, exist_ok=True)
+        for width in target_widths(image.width, widths):
+            resized = None
+            for name in formats:
+                target = os.path.join(directory, f'{width}.{name}')
+                if os.path.exists(target):
+                    continue
+                if resized is None:
+                    height = max(1, round(image.height * width / image.width))
+                    resized = image if width == image.width else image.resize((width, height), Image.Resampling.LANCZOS)
+                # Saved under a temporary name so a half-written file is never served
+                tmp_path = f'{target}.{os.getpid()}.tmp'
+                resized.save(tmp_path, format=name.upper(), **FORMATS[name][1])
+                os.replace(tmp_path, target)
+                written += 1
+    return written
+
+
+def _generate(path, root, widths, formats):
+    try:
+        return generate_derivatives(path, root, widths, formats)
+    except Exception:
+        logger.exception("Failed to generate image derivatives for %s", path)
+        return 0
+
+
+def generate_many(paths, workers=None):
+    """Generate derivatives for many source images over a process pool. Returns how many were written."""
+    paths = [path for path in paths if is_raster(path)]
+    formats = image_formats()
+    if not paths or not formats:
+        return 0
+    root, widths = image_root(), image_widths()
+    workers = workers or getattr(settings, 'RESPONSIVE_IMAGE_WORKERS', None) or os.cpu_count()
+    if workers <= 1 or len(paths) == 1:
+        return sum(_generate(path, root, widths, formats) for path in paths)
+    with ProcessPoolExecutor(max_workers=min(workers, len(paths))) as pool:
+        return sum(pool.map(functools.partial(_generate, root=root, widths=widths, formats=formats), paths))
+
+
+def generate_after_commit(paths, on_done=None):
+    """Generate derivatives in a background thread once the current transaction commits."""
+    paths = [path for path in paths if is_raster(path)]
+    if not paths:
+        return
+
+    def run():
+        if generate_many(paths, workers=1) and on_done is not None:
+            on_done()
+
+    def start():
+        threading.Thread(target=run, name='image-derivatives', daemon=True).start()
+
+    transaction.on_commit(start)
+
+
+def static_source_path(name):
+    """The file behind a static path: the collected copy if there is one, otherwise the finders' match."""
+    try:
+        path = staticfiles_storage.path(name)
+        if os.path.exists(path):
+            return path
+    except NotImplementedError:
+        pass
+    return finders.find(name)
+
+
+def image_path(image):
+    """File system path of an ImageField file or a static path, or None."""
+    if not image:
+        return None
+    if isinstance(image, str):
+        return static_source_path(image)
+    try:
+        return image.path
+    except (NotImplementedError, ValueError):
+        return None
+
+
+def derivatives(image):
+    """
+    ``{format: [(width, url), ...]}`` of the derivatives generated for ``image``.
+
+    Only formats written in every width appear, so a srcset never points at a
+    file that is still being generated.
+    """
+    path = image_path(image)
+    if not path or not is_raster(path) or not os.path.exists(path):
+        return {}
+    digest, width = source_info(path)
+    try:
+        names = set(os.listdir(os.path.join(image_root(), digest)))
+    except FileNotFoundError:
+        return {}
+    widths = target_widths(width, image_widths())
+    found = {}
+    for name in image_formats():
+        if all(f'{w}.{name}' in names for w in widths):
+            found[name] = [(w, f'{image_url()}{digest}/{w}.{name}') for w in widths]
+    return found
+
+
+def static_sources():
+    """Paths of the static images under ``RESPONSIVE_IMAGE_STATIC_PREFIXES``, from the finders."""
+    prefixes = tuple(getattr(settings, 'RESPONSIVE_IMAGE_STATIC_PREFIXES', ()))
+    paths = set()
+    for finder in finders.get_finders():
+        for name, storage in finder.list([]):
+            if name.replace(os.sep, '/').startswith(prefixes) and is_raster(name):
+                paths.add(storage.path(name))
+    return sorted(paths)
+
+
+def model_image_fields(model):
+    return [field for field in model._meta.concrete_fields if isinstance(field, models.ImageField)]
+
+
+def instance_sources(instance):
+    """Paths of the files in an instance's ImageFields."""
+    return [path for path in (image_path(getattr(instance, field.attname)) for field in model_image_fields(type(instance))) if path]
+
+
+def thumbnail_root():
+    return str(getattr(settings, 'THUMBNAIL_ROOT', os.path.join(settings.MEDIA_ROOT, 'thumbnails')))
+
+
+def thumbnail_url_prefix():
+    return getattr(settings, 'THUMBNAIL_URL', settings.MEDIA_URL + 'thumbnails/')
+
+
+def thumbnail_dir(name):
+    """Every thumbnail of the stored file ``name`` lives in one directory, so they go together."""
+    return hashlib.md5(name.encode('utf-8'), usedforsecurity=False).hexdigest()
+
+
+def thumbnail(image, width, height):
+    """
+    URL of a WebP thumbnail of an ImageField file fitting ``width`` x ``height``.
+
+    Rendered at twice the box for high-density screens, on first use, and
+    reused while the file's name, size and mtime stay the same. Falls back to
+    the original's URL when the file cannot be thumbnailed.
+    """
+    path = image_path(image)
+    try:
+        stat = os.stat(path)
+    except (OSError, TypeError):
+        return image.url
+    directory = thumbnail_dir(image.name)
+    filename = f'{stat.st_mtime_ns:x}-{stat.st_size:x}-{width}x{height}.webp'
+    target = os.path.join(thumbnail_root(), directory, filename)
+    if not os.path.exists(target):
+        try:
+            with Image.open(path) as source:
+                source.draft('RGB', (width * 2, height * 2))  # JPEGs decode at reduced size
+                resized = ImageOps.exif_transpose(source)
+                resized.thumbnail((width * 2, height * 2), Image.Resampling.LANCZOS)
+                if resized.mode not in ('RGB', 'RGBA'):
+                    resized = resized.convert('RGBA' if resized.has_transparency_data else 'RGB')
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                tmp_path = f'{target}.{os.getpid()}.{threading.get_ident()}.tmp'
+                resized.save(tmp_path, format='WEBP', quality=80)
+                os.replace(tmp_path, target)
+        except (OSError, ValueError):
+            logger.warning("Could not thumbnail %s", path, exc_info=True)
+            return image.url
+    return f'{thumbnail_url_prefix()}{directory}/{filename}'
+
+
+def delete_thumbnails(name):
+    if name:
+        shutil.rmtree(os.path.join(thumbnail_root(), thumbnail_dir(name)), ignore_errors=True)
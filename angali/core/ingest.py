@@ -0,0 +1,371 @@
+import logging
+import uuid
+
+from asgiref.sync import sync_to_async
+from django.db import DataError, IntegrityError, connections, router, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .geolocation import PENDING_LOCATION, async_geolocation_queue, geolocation_queue
+from .metrics import INTERACTIONS_INSERTED, VISITORS_CREATED
+from .models import PageInteraction, Visitor, VisitorSession
+
+logger = logging.getLogger(__name__)
+
+# Event kinds, as queued by the write-behind buffer and stored in the event log
+VISITOR = 'visitor'
+START = 'start'
+END = 'end'
+
+# What a malformed event raises on its way into the database, as opposed to
+# the database being unavailable
+BAD_EVENT_ERRORS = (AttributeError, KeyError, TypeError, ValueError, DataError, IntegrityError)
+
+
+def event_time(value):
+    """Timestamps travel as ISO strings so events can be queued or logged as JSON."""
+    if isinstance(value, str):
+        return parse_datetime(value) or timezone.now()
+    return value or timezone.now()
+
+
+def visitor_event(visitor_uuid, ip_address, location):
+    """Build a visitor event for the tracking middleware."""
+    return {
+        'uuid': str(visitor_uuid),
+        'ip_address': ip_address,
+        'location': location,
+        'received_at': timezone.now().isoformat(),
+    }
+
+
+def client_ip(request):
+    x_forwarded_for = request.META.get('HTTP_X_FORWARDED_FOR')
+    return x_forwarded_for.split(',')[0] if x_forwarded_for else request.META.get('REMOTE_ADDR')
+
+
+def _text(data, name, max_length, required=False):
+    value = data.get(name)
+    if value in (None, ''):
+        if required:
+            raise ValueError(f"Missing {name}")
+        return ''
+    if not isinstance(value, str):
+        raise ValueError(f"{name} must be a string")
+    return value[:max_length]
+
+
+def _count(data, name):
+    value = data.get(name)
+    if value is None:
+        return 0
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0:
+        raise ValueError(f"{name} must be a non-negative number")
+    return int(value)
+
+
+def _payload(data):
+    if not isinstance(data, dict):
+        raise ValueError("Expected a JSON object")
+    return data
+
+
+def _visitor_id(value):
+    try:
+        return str(uuid.UUID(value))
+    except (TypeError, ValueError, AttributeError):
+        raise ValueError("Invalid visitor ID") from None
+
+
+def start_event(data, visitor_id, ip_address=None):
+    """
+    Build a session start event from a track_start payload.
+
+    Raises ``ValueError`` for a payload, or a ``visitor_id`` cookie, that could
+    not be written, so the view can refuse it before it is queued.
+    """
+    data = _payload(data)
+    return {
+        'visitor_id': _visitor_id(visitor_id),
+        'ip_address': ip_address,
+        'session_id': _text(data, 'session_id', 100, required=True),
+        'referrer': _text(data, 'referrer', 200),
+        'user_agent': _text(data, 'user_agent', 10000),
+        'received_at': timezone.now().isoformat(),
+    }
+
+
+def end_event(data):
+    """
+    Validate a track_end payload and stamp it with the time it was received.
+
+    Only the fields ``record_session_ends`` reads are kept. Raises ``ValueError``
+    as ``start_event`` does.
+    """
+    data = _payload(data)
+    end_time = data.get('end_time')
+    if end_time is not None and (not isinstance(end_time, str) or parse_datetime(end_time) is None):
+        raise ValueError("end_time must be an ISO 8601 datetime")
+    sections = data.get('sections') or []
+    if not isinstance(sections, list) or not all(isinstance(section, str) for section in sections):
+        raise ValueError("sections must be a list of strings")
+    return {
+        'session_id': _text(data, 'session_id', 100, required=True),
+        'end_time': end_time,
+        'duration_seconds': _count(data, 'duration_seconds'),
+        'max_scroll': _count(data, 'max_scroll'),
+        'sections': [section[:255] for section in sections],
+        'received_at': timezone.now().isoformat(),
+    }
+
+
+def end_events(data):
+    """The end events in a track_end payload, batched (``{"events": [...]}``) or not."""
+    if isinstance(data, dict) and 'events' in data:
+        if not isinstance(data['events'], list):
+            raise ValueError("events must be a list")
+        return [end_event(event) for event in data['events']]
+    return [end_event(data)]
+
+
+def check_event(kind, event):
+    """Raise ``ValueError`` unless ``event`` is a ``kind`` event ``write_events`` can write."""
+    if not isinstance(event, dict):
+        raise ValueError(f"Expected an event object, got {type(event).__name__}")
+    if kind == VISITOR:
+        uuid.UUID(str(event.get('uuid')))
+    elif kind == START:
+        uuid.UUID(str(event.get('visitor_id')))
+        _text(event, 'session_id', 100, required=True)
+    elif kind == END:
+        for name in ('duration_seconds', 'max_scroll', 'sections'):
+            if name not in event:
+                raise ValueError(f"Missing {name}")
+        end_event(event)
+    else:
+        raise ValueError(f"Unknown event kind {kind!r}")
+
+
+def insert_visitors(visitors):
+    """
+    ``bulk_create`` in one INSERT ... ON CONFLICT DO NOTHING on the unique uuid.
+
+    Returns how many rows were actually inserted, read from the cursor's
+    rowcount, as the conflicts are skipped by the database.
+    """
+    inserted = []
+
+    def count_rows(execute, sql, params, many, context):
+        result = execute(sql, params, many, context)
+        inserted.append(max(context['cursor'].rowcount, 0))
+        return result
+
+    with connections[router.db_for_write(Visitor)].execute_wrapper(count_rows):
+        Visitor.objects.bulk_create(visitors, ignore_conflicts=True)
+    return sum(inserted)
+
+
+def record_visitors(events):
+    """Insert visitors that do not exist yet; visitor events only come from the event log."""
+    inserted = insert_visitors([
+        Visitor(
+            uuid=event['uuid'],
+            ip_address=event.get('ip_address'),
+            location=event.get('location'),
+            visit_date=event_time(event.get('received_at'))
+        )
+        for event in events
+    ])
+    VISITORS_CREATED.inc(inserted, write='event_log')
+    return len(events)
+
+
+def _visitor_uuids(events):
+    visitor_ids = set()
+    for event in events:
+        try:
+            visitor_ids.add(uuid.UUID(str(event['visitor_id'])))
+        except ValueError:
+            continue
+    return visitor_ids
+
+
+def _missing_visitors(events, visitors):
+    """
+    Visitor rows for starts whose visitor does not exist, one per uuid.
+
+    The known-visitor cache can outlive the row (pruned, or never written),
+    and then the middleware does not insert it again; /track/ is not tracked.
+    """
+    missing = {}
+    for event in events:
+        try:
+            visitor_uuid = str(uuid.UUID(str(event['visitor_id'])))
+        except ValueError:
+            continue
+        if visitor_uuid not in visitors and visitor_uuid not in missing:
+            missing[visitor_uuid] = Visitor(
+                uuid=visitor_uuid,
+                ip_address=event.get('ip_address'),
+                location=PENDING_LOCATION,
+                visit_date=event_time(event.get('received_at'))
+            )
+    return list(missing.values())
+
+
+def _new_sessions(events, visitors):
+    sessions = []
+    for event in events:
+        try:
+            visitor = visitors.get(str(uuid.UUID(str(event['visitor_id']))))
+        except ValueError:
+            continue
+        if visitor is None:
+            continue
+        sessions.append(VisitorSession(
+            visitor=visitor,
+            session_id=event['session_id'],
+            referrer=event.get('referrer', ''),
+            user_agent=event.get('user_agent', ''),
+            start_time=event_time(event.get('received_at'))
+        ))
+    return sessions
+
+
+def record_session_starts(events):
+    """
+    Open sessions with one SELECT and one INSERT.
+
+    A visitor that does not exist is created from its start event, with a
+    pending location, at the cost of an INSERT and a SELECT more. Events with
+    a malformed visitor id are dropped, and so are starts for a session_id
+    that already exists. Returns the number of sessions submitted.
+    """
+    visitors = {
+        str(visitor.uuid): visitor
+        for visitor in Visitor.objects.filter(uuid__in=_visitor_uuids(events)).only('id', 'uuid')
+    }
+    missing = _missing_visitors(events, visitors)
+    if missing:
+        Visitor.objects.bulk_create(missing, ignore_conflicts=True)
+        visitors.update(
+            (str(visitor.uuid), visitor)
+            for visitor in Visitor.objects.filter(uuid__in=[v.uuid for v in missing]).only('id', 'uuid')
+        )
+        for visitor in missing:
+            geolocation_queue.submit(visitor.ip_address)
+    sessions = _new_sessions(events, visitors)
+    # session_id is unique: a retried start beacon must not fail the batch
+    VisitorSession.objects.bulk_create(sessions, ignore_conflicts=True)
+    return len(sessions)
+
+
+async def arecord_session_starts(events):
+    """``record_session_starts`` with the async ORM."""
+    visitors = {
+        str(visitor.uuid): visitor
+        async for visitor in Visitor.objects.filter(uuid__in=_visitor_uuids(events)).only('id', 'uuid')
+    }
+    missing = _missing_visitors(events, visitors)
+    if missing:
+        await Visitor.objects.abulk_create(missing, ignore_conflicts=True)
+        visitors.update([
+            (str(visitor.uuid), visitor)
+            async for visitor in Visitor.objects.filter(uuid__in=[v.uuid for v in missing]).only('id', 'uuid')
+        ])
+        for visitor in missing:
+            async_geolocation_queue.submit(visitor.ip_address)
+    sessions = _new_sessions(events, visitors)
+    await VisitorSession.objects.abulk_create(sessions, ignore_conflicts=True)
+    return len(sessions)
+
+
+def record_session_ends(events):
+    """
+    Close sessions and store their section interactions.
+
+    All sessions are fetched in one query, updated with one ``bulk_update``
+    and their interactions written with one ``bulk_create``, inside a single
+    transaction. A session ended more than once in the batch keeps its last
+    event only. Returns the number of sessions that were found.
+    """
+    latest = {event['session_id']: event for event in events}
+    sessions = {
+        session.session_id: session
+        for session in VisitorSession.objects.filter(session_id__in=latest)
+    }
+
+    interactions = []
+    for event in latest.values():
+        session = sessions.get(event['session_id'])
+        if session is None:
+            continue
+        end_time = event.get('end_time')
+        session.end_time = parse_datetime(end_time) if isinstance(end_time, str) else end_time
+        session.duration_seconds = event['duration_seconds']
+        received_at = event_time(event.get('received_at'))
+        interactions.extend(
+            PageInteraction(
+                session=session,
+                section_id=section_id,
+                scroll_depth=event['max_scroll'],
+                timestamp=received_at
+            )
+            for section_id in event['sections']
+        )
+
+    if not sessions:
+        return 0
+    with transaction.atomic():
+        VisitorSession.objects.bulk_update(sessions.values(), ['end_time', 'duration_seconds'])
+        PageInteraction.objects.bulk_create(interactions)
+    INTERACTIONS_INSERTED.inc(len(interactions))
+    return len(sessions)
+
+
+async def arecord_session_ends(events):
+    """``record_session_ends`` from async code; Django has no async transactions, so it runs in a thread."""
+    return await sync_to_async(record_session_ends)(events)
+
+
+def _write_batch(events):
+    by_kind = {VISITOR: [], START: [], END: []}
+    for kind, event in events:
+        by_kind[kind].append(event)
+    if by_kind[VISITOR]:
+        record_visitors(by_kind[VISITOR])
+    if by_kind[START]:
+        record_session_starts(by_kind[START])
+    if by_kind[END]:
+        record_session_ends(by_kind[END])
+
+
+def write_events(events):
+    """
+    Write a batch of ``(kind, event)`` pairs.
+
+    Visitors go first, then session starts, then ends, so a single batch can
+    create a visitor, open its session and close it again. When an event
+    cannot be written the batch is rolled back and retried one event at a
+    time, so only the bad events are lost; they are logged and returned.
+    Database outages still raise.
+    """
+    try:
+        with transaction.atomic():
+            _write_batch(events)
+        return []
+    except BAD_EVENT_ERRORS:
+        if len(events) == 1:
+            logger.exception("Dropping tracking event that could not be written: %r", events[0])
+            return list(events)
+
+    order = {VISITOR: 0, START: 1, END: 2}
+    failed = []
+    for kind, event in sorted(events, key=lambda pair: order.get(pair[0], len(order))):
+        try:
+            with transaction.atomic():
+                _write_batch([(kind, event)])
+        except BAD_EVENT_ERRORS:
+            logger.exception("Dropping tracking %s event that could not be written: %r", kind, event)
+            failed.append((kind, event))
+    return failed
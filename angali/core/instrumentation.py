@@ -0,0 +1,142 @@
+"""
+Per-request timing instrumentation.
+
+``InstrumentationMiddleware`` times a sampled ``INSTRUMENTATION_SAMPLE_RATE``
+fraction of requests. For each sampled request it records:
+- every query, through an execute wrapper on the connection
+- the time spent in blocks wrapped in ``timed(name)``: geolocation lookups
+  and template rendering
+
+The figures go out in a ``Server-Timing`` header and into the
+``angali_request_seconds`` and ``angali_request_queries`` histograms of
+``core.metrics``, labelled by view. With a sample rate of 0 the middleware
+removes itself, and ``timed`` only costs a context variable read.
+"""
+import contextvars
+import random
+import time
+from collections import defaultdict
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+
+from .metrics import REQUEST_QUERIES, REQUEST_SECONDS
+
+_current = contextvars.ContextVar('request_timings', default=None)
+
+
+class RequestTimings:
+    """Seconds spent per category, and the number of queries, for one sampled request."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.durations = defaultdict(float)
+        self.queries = 0
+
+    def add(self, name, seconds):
+        self.durations[name] += seconds
+
+    def record_query(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries += 1
+            self.add('db', time.perf_counter() - started)
+
+    def server_timing(self, total):
+        entries = [f'total;dur={total * 1000:.1f}']
+        for name, seconds in sorted(self.durations.items()):
+            entry = f'{name};dur={seconds * 1000:.1f}'
+            if name == 'db':
+                entry += f';desc="{self.queries} queries"'
+            entries.append(entry)
+        return ', '.join(entries)
+
+
+class timed:
+    """Adds the time spent in the block to the current request's timings under ``name``, if it is sampled."""
+    __slots__ = ('name', 'timings', 'started')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.timings = _current.get()
+        if self.timings is not None:
+            self.started = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        if self.timings is not None:
+            self.timings.add(self.name, time.perf_counter() - self.started)
+
+
+def observe(view, timings, total):
+    REQUEST_SECONDS.observe(total, view=view, phase='total')
+    REQUEST_QUERIES.observe(timings.queries, view=view)
+    for name, seconds in timings.durations.items():
+        REQUEST_SECONDS.observe(seconds, view=view, phase=name)
+
+
+def _add_query_wrapper(wrapper):
+    connection.execute_wrappers.append(wrapper)
+
+
+def _remove_query_wrapper(wrapper):
+    connection.execute_wrappers.remove(wrapper)
+
+
+class InstrumentationMiddleware:
+    """Times a sample of requests; list it first in MIDDLEWARE so the rest of the stack is included."""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.sample_rate = getattr(settings, 'INSTRUMENTATION_SAMPLE_RATE', 0)
+        if self.sample_rate <= 0:
+            raise MiddlewareNotUsed
+        self.server_timing = getattr(settings, 'INSTRUMENTATION_SERVER_TIMING', True)
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if random.random() >= self.sample_rate:
+            return self.get_response(request)
+        timings = RequestTimings()
+        token = _current.set(timings)
+        try:
+            with connection.execute_wrapper(timings.record_query):
+                response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.finish(request, response, timings)
+
+    async def __acall__(self, request):
+        if random.random() >= self.sample_rate:
+            return await self.get_response(request)
+        timings = RequestTimings()
+        token = _current.set(timings)
+        # The request's queries run in its thread-sensitive worker thread, on
+        # that thread's connection, so the wrapper is installed over there
+        await sync_to_async(_add_query_wrapper)(timings.record_query)
+        try:
+            response = await self.get_response(request)
+        finally:
+            await sync_to_async(_remove_query_wrapper)(timings.record_query)
+            _current.reset(token)
+        return self.finish(request, response, timings)
+
+    def finish(self, request, response, timings):
+        total = time.perf_counter() - timings.started
+        match = getattr(request, 'resolver_match', None)
+        observe(match.view_name if match else 'unresolved', timings, total)
+        if self.server_timing:
+            existing = response.get('Server-Timing')
+            header = timings.server_timing(total)
+            response['Server-Timing'] = f'{existing}, {header}' if existing else header
+        return response
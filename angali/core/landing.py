@@ -0,0 +1,157 @@
+import datetime
+import functools
+import hashlib
+import os
+
+from django.conf import settings
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.core.cache import InvalidCacheBackendError, caches
+from django.core.cache.utils import make_template_fragment_key
+from django.db.models import Count, Max, Prefetch, Value
+from django.template.loader import get_template
+
+from .models import (
+    CallToActionBlock, FAQItem, Footer, FooterLink, FooterSection, HeroSection,
+    Partner, SectionContent, Testimonial,
+)
+
+# Cached fragment names in files/index.html, and the models each one renders
+FRAGMENT_MODELS = {
+    'landing_hero': [HeroSection],
+    'landing_services': [SectionContent],
+    'landing_testimonials': [Testimonial],
+    'landing_partners': [Partner],
+    'landing_faq': [FAQItem],
+    'landing_cta': [CallToActionBlock],
+    'landing_footer': [Footer, FooterSection, FooterLink],
+}
+
+VERSION_CACHE_KEY = 'landing:version'
+
+
+def landing_context():
+    """
+    Querysets for the landing page sections.
+
+    They are lazy: each one only runs when its ``{% cache %}`` fragment
+    misses, so a warm page costs no queries and a cold one a fixed handful.
+    Fragments are keyed by a fingerprint of the rows they render, so a
+    change made through another process is picked up once this process
+    recomputes the content version.
+    """
+    return {
+        'fragment_ttl': getattr(settings, 'LANDING_FRAGMENT_TTL', 60 * 60 * 24),
+        'fragment_versions': content_version()[2],
+        'hero_sections': HeroSection.objects.filter(is_active=True).order_by('-pk')[:1],
+        'content_sections': SectionContent.objects.order_by('pk'),
+        'testimonials': Testimonial.objects.filter(show_on_homepage=True).order_by('pk'),
+        'partners': Partner.objects.order_by('pk'),
+        'faq_items': FAQItem.objects.all(),
+        'cta_blocks': CallToActionBlock.objects.filter(is_active=True).order_by('pk')[:1],
+        'footers': Footer.objects.prefetch_related(
+            Prefetch('sections', queryset=FooterSection.objects.order_by('pk').prefetch_related('links'))
+        ).order_by('pk')[:1],
+    }
+
+
+def fragment_cache():
+    """The cache the ``{% cache %}`` tag writes to."""
+    try:
+        return caches['template_fragments']
+    except InvalidCacheBackendError:
+        return caches['default']
+
+
+def fragments_for_model(model):
+    return [name for name, models in FRAGMENT_MODELS.items() if model in models]
+
+
+def fragment_key(name):
+    return make_template_fragment_key(name, [content_version()[2][name]])
+
+
+def invalidate_fragments(names):
+    """Drop the current renderings of the named fragments, e.g. once their image derivatives exist."""
+    fragment_cache().delete_many([fragment_key(name) for name in names])
+
+
+def landing_template_paths():
+    """files/index.html followed by the section partials it includes."""
+    origin = get_template('files/index.html').origin.name
+    landing_dir = os.path.join(os.path.dirname(origin), 'landing')
+    return [origin] + sorted(
+        os.path.join(landing_dir, name) for name in os.listdir(landing_dir) if name.endswith('.html')
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def template_fingerprint():
+    """
+    Digest and newest modification time of the homepage templates, read once per process.
+
+    Deploys restart the workers, so a template change (or new hashed static
+    names in the staticfiles manifest) gives the page a new version even though
+    no model changed.
+    """
+    paths = landing_template_paths()
+    paths.append(os.path.join(os.path.dirname(paths[0]), 'critical.css'))  # inlined stylesheet
+    mtimes = {os.path.basename(path): os.stat(path).st_mtime for path in paths}
+    manifest = getattr(staticfiles_storage, 'manifest_hash', '')
+    digest = hashlib.md5(f'{sorted(mtimes.items())}{manifest}'.encode('utf-8'), usedforsecurity=False).hexdigest()[:12]
+    return digest, datetime.datetime.fromtimestamp(max(mtimes.values()), tz=datetime.timezone.utc)
+
+
+def compute_content_version():
+    """
+    Fingerprint the landing models from their row counts and latest ``updated_at``.
+
+    Counts catch deletions, which leave no timestamp behind. Returns
+    ``(etag, last_modified, {fragment name: fingerprint})``; the templates
+    count as modified when they were.
+    """
+    digest, last_modified = template_fingerprint()
+    models = sorted({model for models in FRAGMENT_MODELS.values() for model in models}, key=lambda m: m.__name__)
+    # All nine aggregates in a single UNION ALL query
+    querysets = [
+        model.objects.order_by().values(model_name=Value(model.__name__))
+        .annotate(count=Count('pk'), latest=Max('updated_at'))
+        for model in models
+    ]
+    stats = {row['model_name']: row for row in querysets[0].union(*querysets[1:], all=True)}
+    parts = {}
+    for model in models:
+        row = stats.get(model.__name__, {'count': 0, 'latest': None})
+        parts[model] = f"{model.__name__}:{row['count']}:{row['latest'] and row['latest'].isoformat()}"
+        if row['latest'] and row['latest'] > last_modified:
+            last_modified = row['latest']
+    # Weak: the gzip and brotli variants of the page share it
+    etag = 'W/"%s"' % _digest('|'.join([digest, *parts.values()]))
+    fragments = {
+        name: _digest('|'.join([digest, *(parts[model] for model in fragment_models)]))[:12]
+        for name, fragment_models in FRAGMENT_MODELS.items()
+    }
+    return etag, last_modified, fragments
+
+
+def _digest(text):
+    return hashlib.md5(text.encode('utf-8'), usedforsecurity=False).hexdigest()
+
+
+def content_version():
+    """
+    The ``(etag, last_modified, fragment fingerprints)`` of the landing page.
+
+    Each process keeps it for ``LANDING_VERSION_TTL`` seconds. The signals
+    drop it at once in the process that saved the change. Other workers
+    with a per-process cache see the change when their copy expires.
+    """
+    key = f'{VERSION_CACHE_KEY}:{template_fingerprint()[0]}'
+    version = fragment_cache().get(key)
+    if version is None:
+        version = compute_content_version()
+        fragment_cache().set(key, version, getattr(settings, 'LANDING_VERSION_TTL', 5))
+    return version
+
+
+def invalidate_content_version():
+    fragment_cache().delete(f'{VERSION_CACHE_KEY}:{template_fingerprint()[0]}')
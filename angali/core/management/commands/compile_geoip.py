@@ -0,0 +1,33 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from core.geoip import RangeDatabaseError, compile_ranges, read_ranges
+
+
+class Command(BaseCommand):
+    help = "Compile a CSV range dump (network or start_ip/end_ip, city, country) into the memory-mapped GeoIP database."
+
+    def add_arguments(self, parser):
+        parser.add_argument('csv_path')
+        parser.add_argument(
+            '--output',
+            default=None,
+            help="Defaults to settings.GEOIP_DATABASE_PATH.",
+        )
+
+    def handle(self, *args, **options):
+        output = options['output'] or getattr(settings, 'GEOIP_DATABASE_PATH', None)
+        if not output:
+            raise CommandError("Pass --output or set GEOIP_DATABASE_PATH.")
+
+        try:
+            with open(options['csv_path'], newline='', encoding='utf-8') as csv_file:
+                ipv4_count, ipv6_count, skipped = compile_ranges(read_ranges(csv_file), output)
+        except (OSError, ValueError, KeyError, RangeDatabaseError) as exc:
+            raise CommandError(f"Could not compile {options['csv_path']}: {exc}")
+
+        if skipped:
+            self.stdout.write(self.style.WARNING(f"Skipped {skipped} duplicate or partly overlapping range(s)."))
+        self.stdout.write(self.style.SUCCESS(
+            f"Wrote {ipv4_count} IPv4 and {ipv6_count} IPv6 range(s) to {output}."
+        ))
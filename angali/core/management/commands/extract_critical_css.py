@@ -0,0 +1,42 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from core.critical import SOURCE_STYLESHEET, build_critical_css, output_path, size_budget
+
+
+class Command(BaseCommand):
+    help = (
+        "Extract the rules of the theme stylesheet used above the fold of the landing page into "
+        "files/critical.css. Fails when the result is larger than CRITICAL_CSS_BUDGET bytes."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--check', action='store_true',
+            help="Only report whether files/critical.css is up to date (exit status 1 if not).",
+        )
+
+    def handle(self, *args, **options):
+        css = build_critical_css()
+        path = output_path()
+        size = len(css.encode('utf-8'))
+        if size > size_budget():
+            raise CommandError(
+                f"Critical CSS is {size} bytes, over the {size_budget()} byte budget (CRITICAL_CSS_BUDGET). "
+                "It is inlined into every page: keep the templates above the fold lean."
+            )
+        if options['check']:
+            try:
+                with open(path, encoding='utf-8') as f:
+                    current = f.read()
+            except FileNotFoundError:
+                current = None
+            if current != css:
+                raise CommandError(f"{path} is out of date; run manage.py extract_critical_css.")
+            self.stdout.write("Critical CSS is up to date.")
+            return
+
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(css)
+        self.stdout.write(self.style.SUCCESS(
+            f"Wrote {size // 1024} KB of critical CSS from {SOURCE_STYLESHEET} to {path}."
+        ))
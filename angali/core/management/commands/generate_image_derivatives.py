@@ -0,0 +1,28 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from core.images import generate_many, image_formats, instance_sources, model_image_fields, static_sources
+from core.signals import LANDING_MODELS
+
+
+class Command(BaseCommand):
+    help = "Generate responsive AVIF/WebP derivatives for landing page uploads and static images."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=None, help="Worker processes (default: every core).")
+
+    def handle(self, *args, **options):
+        paths = set(static_sources())
+        for model in LANDING_MODELS:
+            fields = [field.name for field in model_image_fields(model)]
+            if fields:
+                for instance in model.objects.only(*fields):
+                    paths.update(instance_sources(instance))
+
+        started = time.monotonic()
+        written = generate_many(sorted(paths), workers=options['workers'])
+        self.stdout.write(self.style.SUCCESS(
+            f"Wrote {written} derivative(s) in {', '.join(image_formats()) or 'no supported format'} "
+            f"for {len(paths)} image(s) in {time.monotonic() - started:.1f}s."
+        ))
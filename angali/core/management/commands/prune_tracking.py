@@ -0,0 +1,55 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from core.models import RollupWatermark
+from core.retention import cutoff_for, prune
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete PageInteraction, VisitorSession and Visitor rows older than --older-than days, "
+        "children first, in small batches that each commit on their own. Interrupt it at any "
+        "time and run it again to continue. Rows not yet folded into the daily rollups are "
+        "kept, so run `manage.py rollup` first; the rollups themselves are never pruned."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than', type=int, required=True, help="Age in days of the rows to delete.")
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument(
+            '--sleep',
+            type=float,
+            default=0.1,
+            help="Seconds to pause between batches, so live traffic gets the locks in between.",
+        )
+        parser.add_argument(
+            '--archive',
+            metavar='DIR',
+            help="Write each batch to DIR/<table>/<first pk>-<last pk>.jsonl.gz before deleting it.",
+        )
+
+    def handle(self, *args, **options):
+        older_than = options['older_than']
+        settle_days = getattr(settings, 'ROLLUP_SETTLE_DAYS', 1)
+        # Those days are still recomputed from their raw rows on every rollup
+        if older_than <= settle_days:
+            raise CommandError(f"--older-than must be more than ROLLUP_SETTLE_DAYS ({settle_days}).")
+        if not RollupWatermark.objects.exists():
+            self.stdout.write(self.style.WARNING("No rollups have run yet, so nothing can be pruned."))
+
+        cutoff = cutoff_for(older_than)
+        progress = None
+        if options['verbosity'] >= 2:
+            progress = lambda deleted: self.stdout.write(  # noqa: E731
+                ', '.join(f"{count} {label}" for label, count in deleted.items())
+            )
+        deleted = prune(
+            cutoff,
+            batch_size=options['batch_size'],
+            sleep=options['sleep'],
+            archive_dir=options['archive'],
+            progress=progress,
+        )
+        for label, count in deleted.items():
+            self.stdout.write(f"Deleted {count} {label} row(s)")
+        self.stdout.write(self.style.SUCCESS(f"Pruned tracking rows from before {cutoff:%Y-%m-%d}."))
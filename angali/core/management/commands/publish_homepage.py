@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from core.snapshot import publish
+
+
+class Command(BaseCommand):
+    help = "Render the homepage snapshot served by the home view (it is also rebuilt once a deploy changes templates or static files)."
+
+    def handle(self, *args, **options):
+        path = publish()
+        if path is None:
+            self.stdout.write("LANDING_SNAPSHOT_DIR is not set; the homepage is rendered live.")
+            return
+        self.stdout.write(self.style.SUCCESS(f"Published the homepage snapshot to {path}."))
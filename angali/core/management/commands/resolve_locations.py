@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+
+from core.geolocation import PENDING_LOCATION, resolve_batch
+from core.models import Visitor
+
+
+class Command(BaseCommand):
+    help = "Resolve the location of visitors still pending geolocation (e.g. after a restart or a full queue)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        pending = (
+            Visitor.objects.filter(location=PENDING_LOCATION)
+            .exclude(ip_address__isnull=True)
+            .values_list('ip_address', flat=True)
+            .distinct()
+        )
+        ip_addresses = list(pending)
+        updated = 0
+        for start in range(0, len(ip_addresses), batch_size):
+            updated += resolve_batch(ip_addresses[start:start + batch_size])
+        self.stdout.write(self.style.SUCCESS(
+            f"Resolved {updated} visitor(s) across {len(ip_addresses)} IP address(es)."
+        ))
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+
+from core.changelist import analyze_tables
+from core.models import PageInteraction, Visitor, VisitorSession
+from core.rollup import refresh
+
+
+class Command(BaseCommand):
+    help = (
+        "Fold new VisitorSession and PageInteraction rows into the daily rollup tables. "
+        "Only days holding rows added since the last run, and the last ROLLUP_SETTLE_DAYS "
+        "days, are recomputed. Also refreshes the table statistics the admin's estimated "
+        "counts read. Run it from cron, e.g. every 15 minutes."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--full',
+            action='store_true',
+            help="Ignore the watermarks and recompute every day that still has raw rows.",
+        )
+
+    def handle(self, *args, **options):
+        recomputed = refresh(full=options['full'])
+        for name, days in recomputed.items():
+            self.stdout.write(f"Recomputed {days} day(s) of {name}")
+        analyze_tables([Visitor, VisitorSession, PageInteraction])
+        self.stdout.write(self.style.SUCCESS("Rollups are up to date."))
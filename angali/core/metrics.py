@@ -0,0 +1,313 @@
+"""
+Counters and histograms for the tracking and rendering hot paths.
+
+Every process writes its samples to its own memory-mapped file,
+``metrics-<pid>.db`` in ``METRICS_DIR``. A scrape of ``/metrics`` reads and
+sums all of them, so it covers every gunicorn worker and never touches the
+database. Every sample is a counter (histograms are bucket counters and a
+sum), so when a process opens its file it folds the files of processes that
+have exited into ``metrics-archive.db`` and deletes them. Counts from
+restarted workers are kept without the directory growing.
+"""
+import bisect
+import fcntl
+import functools
+import glob
+import json
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100)
+
+INITIAL_FILE_SIZE = 64 * 1024
+ARCHIVE_NAME = 'metrics-archive.db'
+LOCK_NAME = 'metrics.lock'
+HEADER = struct.Struct('Q')  # bytes of the file in use
+KEY_LENGTH = struct.Struct('I')
+VALUE = struct.Struct('d')
+
+
+def _entry_size(encoded_key):
+    """Key length, key padded so the value is 8-byte aligned, value."""
+    keyed = KEY_LENGTH.size + len(encoded_key)
+    return keyed + (-keyed % 8) + VALUE.size
+
+
+def _read_entries(data, used):
+    """``(key, value, value offset)`` for each entry of a metrics file's contents."""
+    position = HEADER.size
+    while position < used:
+        (length,) = KEY_LENGTH.unpack_from(data, position)
+        encoded_key = bytes(data[position + KEY_LENGTH.size:position + KEY_LENGTH.size + length])
+        offset = position + _entry_size(encoded_key) - VALUE.size
+        yield encoded_key.decode(), VALUE.unpack_from(data, offset)[0], offset
+        position = offset + VALUE.size
+
+
+def read_file(path):
+    """The samples in one process's metrics file."""
+    with open(path, 'rb') as f:
+        data = f.read()
+    if len(data) < HEADER.size:
+        return {}
+    (used,) = HEADER.unpack_from(data, 0)
+    return {key: value for key, value, _ in _read_entries(data, min(used, len(data)))}
+
+
+class MmapValues:
+    """
+    One process's samples in a memory-mapped file.
+
+    Only the owning process writes. A new key is written before the header
+    that makes it visible, so a concurrent reader never sees half an entry.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'a+b')
+        size = os.fstat(self._file.fileno()).st_size
+        if size < INITIAL_FILE_SIZE:
+            self._file.truncate(INITIAL_FILE_SIZE)
+            size = INITIAL_FILE_SIZE
+        self._map = mmap.mmap(self._file.fileno(), size)
+        self._used = HEADER.unpack_from(self._map, 0)[0] or HEADER.size
+        # A worker that got a dead worker's pid carries on from its values
+        self._offsets = {key: offset for key, _, offset in _read_entries(self._map, self._used)}
+
+    def _grow(self, needed):
+        size = len(self._map)
+        while size < needed:
+            size *= 2
+        self._map.close()
+        self._file.truncate(size)
+        self._map = mmap.mmap(self._file.fileno(), size)
+
+    def _add(self, key):
+        encoded_key = key.encode()
+        end = self._used + _entry_size(encoded_key)
+        if end > len(self._map):
+            self._grow(end)
+        KEY_LENGTH.pack_into(self._map, self._used, len(encoded_key))
+        self._map[self._used + KEY_LENGTH.size:self._used + KEY_LENGTH.size + len(encoded_key)] = encoded_key
+        offset = end - VALUE.size
+        VALUE.pack_into(self._map, offset, 0.0)
+        HEADER.pack_into(self._map, 0, end)
+        self._used = end
+        self._offsets[key] = offset
+        return offset
+
+    def inc(self, key, amount):
+        offset = self._offsets.get(key) or self._add(key)
+        VALUE.pack_into(self._map, offset, VALUE.unpack_from(self._map, offset)[0] + amount)
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+
+def _process_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True  # someone else's process
+    return True
+
+
+def fold_dead_files(directory):
+    """Add the samples of exited processes into the archive file and delete their files. Returns how many."""
+    folded = 0
+    with open(os.path.join(directory, LOCK_NAME), 'a') as lock:
+        # Two workers starting together must not both add the same file
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        archive = None
+        try:
+            for path in glob.glob(os.path.join(directory, 'metrics-*.db')):
+                pid = os.path.basename(path)[len('metrics-'):-len('.db')]
+                if not pid.isdigit() or _process_exists(int(pid)):
+                    continue
+                archive = archive or MmapValues(os.path.join(directory, ARCHIVE_NAME))
+                for key, value in read_file(path).items():
+                    archive.inc(key, value)
+                os.unlink(path)
+                folded += 1
+        finally:
+            if archive is not None:
+                archive.close()
+    return folded
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = {}
+        self._lock = threading.Lock()
+        self._values = None
+        self._owner = None  # (pid, directory) the open file belongs to
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def directory(self):
+        directory = getattr(settings, 'METRICS_DIR', None)
+        return str(directory) if directory else os.path.join(tempfile.gettempdir(), 'angali-metrics')
+
+    def _store(self):
+        """This process's file; a forked worker, or a changed METRICS_DIR, opens a new one."""
+        owner = (os.getpid(), self.directory())
+        if self._owner != owner:
+            os.makedirs(owner[1], exist_ok=True)
+            try:
+                fold_dead_files(owner[1])
+            except OSError:
+                logger.exception("Could not fold the metrics files of exited processes in %s", owner[1])
+            self._values = MmapValues(os.path.join(owner[1], f'metrics-{owner[0]}.db'))
+            self._owner = owner
+        return self._values
+
+    def inc(self, key, amount):
+        with self._lock:
+            self._store().inc(key, amount)
+
+    def collect(self):
+        """Samples summed over every process's file: ``{(sample name, labels): value}``."""
+        totals = {}
+        for path in glob.glob(os.path.join(self.directory(), 'metrics-*.db')):
+            for key, value in read_file(path).items():
+                name, labels = json.loads(key)
+                key = (name, tuple(map(tuple, labels)))
+                totals[key] = totals.get(key, 0.0) + value
+        return totals
+
+    def render(self):
+        """The Prometheus text exposition format."""
+        samples = {}
+        for (name, labels), value in self.collect().items():
+            samples.setdefault(name, {})[labels] = value
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            lines.extend(metric.render(samples))
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
+
+
+def sample_key(name, labels):
+    return _sample_key(name, tuple(sorted(labels.items())))
+
+
+@functools.lru_cache(maxsize=4096)
+def _sample_key(name, labels):
+    return json.dumps([name, labels], separators=(',', ':'))
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (
+        (name, str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+        for name, value in labels
+    )
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+
+class Counter:
+    type = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        registry.register(self)
+
+    def inc(self, amount=1, **labels):
+        if amount:
+            registry.inc(sample_key(self.name, labels), amount)
+
+    def render(self, samples):
+        for labels, value in sorted(samples.get(self.name, {}).items()):
+            yield f'{self.name}{format_labels(labels)} {value!r}'
+
+
+class Histogram:
+    """Counts per bucket are stored as they are and made cumulative when rendered."""
+    type = 'histogram'
+
+    def __init__(self, name, documentation, buckets=LATENCY_BUCKETS, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        self.labelnames = tuple(labelnames)
+        registry.register(self)
+
+    def observe(self, value, **labels):
+        index = bisect.bisect_left(self.buckets, value)
+        bound = repr(float(self.buckets[index])) if index < len(self.buckets) else '+Inf'
+        registry.inc(sample_key(f'{self.name}_bucket', {**labels, 'le': bound}), 1)
+        registry.inc(sample_key(f'{self.name}_sum', labels), value)
+        registry.inc(sample_key(f'{self.name}_count', labels), 1)
+
+    def time(self, **labels):
+        return _Timer(self, labels)
+
+    def render(self, samples):
+        buckets = samples.get(f'{self.name}_bucket', {})
+        for labels, count in sorted(samples.get(f'{self.name}_count', {}).items()):
+            cumulative = 0.0
+            for bound in [repr(float(bucket)) for bucket in self.buckets] + ['+Inf']:
+                cumulative += buckets.get(tuple(sorted(labels + (('le', bound),))), 0.0)
+                yield f'{self.name}_bucket{format_labels(labels + (("le", bound),))} {cumulative!r}'
+            yield f'{self.name}_sum{format_labels(labels)} {samples[f"{self.name}_sum"].get(labels, 0.0)!r}'
+            yield f'{self.name}_count{format_labels(labels)} {count!r}'
+
+
+class _Timer:
+    __slots__ = ('histogram', 'labels', 'started')
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+
+
+VISITORS_CREATED = Counter(
+    'angali_visitors_created_total', 'New visitors recorded by the tracking middleware.', ['write'],
+)
+SESSIONS_STARTED = Counter('angali_sessions_started_total', 'Session start beacons accepted.', ['write'])
+SESSIONS_ENDED = Counter('angali_sessions_ended_total', 'Session end events accepted.', ['write'])
+INTERACTIONS_INSERTED = Counter('angali_interactions_inserted_total', 'Page interaction rows inserted.')
+GEOLOCATION_SECONDS = Histogram(
+    'angali_geolocation_seconds', 'Time spent in a geolocation backend lookup.', labelnames=['backend'],
+)
+GEOLOCATION_FAILURES = Counter(
+    'angali_geolocation_failures_total', 'Geolocation backend requests that failed.', ['backend'],
+)
+CACHE_LOOKUPS = Counter('angali_cache_lookups_total', 'Cache lookups by cache and result.', ['cache', 'result'])
+RENDER_SECONDS = Histogram('angali_render_seconds', 'Time spent rendering a page live.', labelnames=['view'])
+REQUEST_SECONDS = Histogram(
+    'angali_request_seconds', 'Time spent in sampled requests, in total and per phase (db, geo, template).',
+    labelnames=['view', 'phase'],
+)
+REQUEST_QUERIES = Histogram(
+    'angali_request_queries', 'Database queries run by sampled requests.', buckets=QUERY_BUCKETS, labelnames=['view'],
+)
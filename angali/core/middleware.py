@@ -1,49 +1,165 @@
 import uuid
-import requests
-from django.utils.deprecation import MiddlewareMixin
-from django.utils import timezone
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core.cache import cache
 from .models import Visitor
+from .geolocation import (
+    PENDING_LOCATION, alookup_locations, async_geolocation_queue, geolocation_queue, lookup_location,
+)
+from .eventlog import event_log
+from .metrics import CACHE_LOOKUPS, VISITORS_CREATED
+from .ingest import VISITOR, client_ip, insert_visitors, visitor_event
+
+class VisitorTrackingMiddleware:
+    # Runs natively under both WSGI and ASGI, so an ASGI server does not
+    # push every request through a thread for this middleware
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+        # Prefix tuples let str.startswith do the matching in a single C call
+        include = getattr(settings, 'VISITOR_TRACKING_INCLUDE_PATHS', None)
+        self.include_paths = tuple(include) if include is not None else None
+        self.exclude_paths = tuple(getattr(settings, 'VISITOR_TRACKING_EXCLUDE_PATHS', ()))
+        self.html_only = getattr(settings, 'VISITOR_TRACKING_HTML_ONLY', False)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        self.process_request(request)
+        response = self.get_response(request)
+        return self.process_response(request, response)
+
+    async def __acall__(self, request):
+        self.prepare(request)
+        if request.track_visitor and not self.html_only:
+            await self.atrack_visitor(request)
+        response = await self.get_response(request)
+        if request.track_visitor and self.html_only and self.is_page_view(response):
+            await self.atrack_visitor(request)
+        return self.set_cookie(request, response)
+
+    def prepare(self, request):
+        request.visitor_id = self.parse_visitor_id(request.COOKIES.get('visitor_id'))  # We'll use this in views later
+        request.track_visitor = self.should_track_path(request.path_info)
 
-class VisitorTrackingMiddleware(MiddlewareMixin):
     def process_request(self, request):
-        ip_address = self.get_client_ip(request)
-        location = self.get_location(ip_address)
+        self.prepare(request)
+        if request.track_visitor and not self.html_only:
+            self.track_visitor(request)
 
-        visitor_uuid = request.COOKIES.get('visitor_id')
-        request.visitor_id = visitor_uuid  # We'll use this in views later
+    def process_response(self, request, response):
+        if getattr(request, 'track_visitor', False) and self.html_only and self.is_page_view(response):
+            self.track_visitor(request)
+        return self.set_cookie(request, response)
+
+    def set_cookie(self, request, response):
+        if hasattr(request, 'new_visitor_uuid'):
+            response.set_cookie('visitor_id', request.new_visitor_uuid, max_age=31536000)  # 1 year
+        return response
+
+    def should_track_path(self, path):
+        if self.include_paths is not None and not path.startswith(self.include_paths):
+            return False
+        return not (self.exclude_paths and path.startswith(self.exclude_paths))
+
+    def is_page_view(self, response):
+        # A 304 is a revisit of a page the browser already has; error pages are not visits
+        if response.status_code == 304:
+            return True
+        return 200 <= response.status_code < 300 and response.get('Content-Type', '').startswith('text/html')
+
+    def track_visitor(self, request):
+        ip_address = self.get_client_ip(request)
+        visitor_uuid = request.visitor_id
 
         if visitor_uuid:
-            visitor = Visitor.objects.filter(uuid=visitor_uuid).first()
-            if not visitor:
-                visitor = Visitor.objects.create(
-                    uuid=visitor_uuid,
-                    ip_address=ip_address,
-                    location=location
-                )
+            # Repeat hits within the known-visitor TTL skip the database entirely
+            known = cache.get(self.known_visitor_key(visitor_uuid))
+            CACHE_LOOKUPS.inc(cache='known_visitor', result='hit' if known else 'miss')
+            if not known:
+                self.create_visitor(visitor_uuid, ip_address)
         else:
             # Will be set in process_response
             request.new_visitor_uuid = str(uuid.uuid4())
-            Visitor.objects.create(
-                uuid=request.new_visitor_uuid,
-                ip_address=ip_address,
-                location=location
-            )
+            self.create_visitor(request.new_visitor_uuid, ip_address)
 
-    def process_response(self, request, response):
-        if hasattr(request, 'new_visitor_uuid'):
-            response.set_cookie('visitor_id', request.new_visitor_uuid, max_age=31536000)  # 1 year
-        return response
+    async def atrack_visitor(self, request):
+        ip_address = self.get_client_ip(request)
+        visitor_uuid = request.visitor_id
+
+        if visitor_uuid:
+            known = await cache.aget(self.known_visitor_key(visitor_uuid))
+            CACHE_LOOKUPS.inc(cache='known_visitor', result='hit' if known else 'miss')
+            if not known:
+                await self.acreate_visitor(visitor_uuid, ip_address)
+        else:
+            request.new_visitor_uuid = str(uuid.uuid4())
+            await self.acreate_visitor(request.new_visitor_uuid, ip_address)
+
+    def create_visitor(self, visitor_uuid, ip_address):
+        """Insert the visitor unless its uuid already exists, in a single query."""
+        # Only local (offline) backends may answer on the request path; anything
+        # they cannot resolve is left pending for the background geolocation workers
+        location = lookup_location(ip_address, network=False) if ip_address else None
+        event = visitor_event(visitor_uuid, ip_address, location or PENDING_LOCATION)
+
+        # In event-log mode compact_events inserts (and counts) the row later
+        # and resolve_locations fills in whatever is still pending
+        if not event_log.append(VISITOR, event):
+            # INSERT ... ON CONFLICT DO NOTHING on the unique uuid, so concurrent
+            # requests carrying the same new cookie cannot race each other. A
+            # returning visitor whose known key expired inserts nothing and is not counted
+            VISITORS_CREATED.inc(insert_visitors([self.new_visitor(visitor_uuid, ip_address, location)]), write='database')
+            if location is None:
+                geolocation_queue.submit(ip_address)
+        cache.set(
+            self.known_visitor_key(visitor_uuid),
+            True,
+            getattr(settings, 'VISITOR_KNOWN_CACHE_TTL', 1800)
+        )
+
+    async def acreate_visitor(self, visitor_uuid, ip_address):
+        """``create_visitor`` with the async cache and ORM; pending locations are resolved on the event loop."""
+        location = (await alookup_locations([ip_address], network=False)).get(ip_address) if ip_address else None
+        event = visitor_event(visitor_uuid, ip_address, location or PENDING_LOCATION)
+
+        if not event_log.append(VISITOR, event):
+            # In the worker thread, whose connection the rowcount is read from
+            inserted = await sync_to_async(insert_visitors)([self.new_visitor(visitor_uuid, ip_address, location)])
+            VISITORS_CREATED.inc(inserted, write='database')
+            if location is None:
+                async_geolocation_queue.submit(ip_address)
+        await cache.aset(
+            self.known_visitor_key(visitor_uuid),
+            True,
+            getattr(settings, 'VISITOR_KNOWN_CACHE_TTL', 1800)
+        )
+
+    def new_visitor(self, visitor_uuid, ip_address, location):
+        return Visitor(
+            uuid=visitor_uuid,
+            ip_address=ip_address,
+            location=location or PENDING_LOCATION
+        )
+
+    def parse_visitor_id(self, value):
+        """Return the cookie value if it is a valid uuid, otherwise None so a new one is issued."""
+        if not value:
+            return None
+        try:
+            return str(uuid.UUID(value))
+        except ValueError:
+            return None
+
+    def known_visitor_key(self, visitor_uuid):
+        return f'visitor:known:{visitor_uuid}'
 
     def get_client_ip(self, request):
-        x_forwarded_for = request.META.get('HTTP_X_FORWARDED_FOR')
-        return x_forwarded_for.split(',')[0] if x_forwarded_for else request.META.get('REMOTE_ADDR')
+        return client_ip(request)
 
     def get_location(self, ip_address):
-        try:
-            response = requests.get(f'http://ip-api.com/json/{ip_address}', timeout=5)
-            data = response.json()
-            if data.get('status') == 'fail':
-                return 'Unknown'
-            return f"{data.get('city')}, {data.get('country')}"
-        except requests.exceptions.RequestException:
-            return 'Unknown'
+        return lookup_location(ip_address)
@@ -0,0 +1,24 @@
+# Generated by Django 5.2.18 on 2026-10-16 23:37
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0003_calltoactionblock_faqitem_footer_herosection_partner_and_more'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='pageinteraction',
+            name='timestamp',
+            field=models.DateTimeField(blank=True, default=django.utils.timezone.now, null=True),
+        ),
+        migrations.AlterField(
+            model_name='visitorsession',
+            name='start_time',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
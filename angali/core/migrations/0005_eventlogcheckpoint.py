@@ -0,0 +1,22 @@
+# Generated by Django 5.2.18 on 2026-10-16 23:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0004_alter_pageinteraction_timestamp_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EventLogCheckpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('segment', models.CharField(blank=True, default='', max_length=100)),
+                ('offset', models.PositiveBigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,67 @@
+# Generated by Django 5.2.18 on 2026-10-16 23:40
+
+import django.utils.timezone
+from django.db import migrations, models
+from django.db.models import Count, Min
+
+
+def clear_duplicate_session_ids(apps, schema_editor):
+    """Keep session_id on the oldest row of each duplicate group so it can become unique."""
+    VisitorSession = apps.get_model('core', 'VisitorSession')
+    duplicates = (
+        VisitorSession.objects.exclude(session_id__isnull=True)
+        .values('session_id')
+        .annotate(rows=Count('id'), first_id=Min('id'))
+        .filter(rows__gt=1)
+    )
+    for duplicate in duplicates.iterator():
+        VisitorSession.objects.filter(session_id=duplicate['session_id']).exclude(
+            id=duplicate['first_id']
+        ).update(session_id=None)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0005_eventlogcheckpoint'),
+    ]
+
+    operations = [
+        migrations.RunPython(clear_duplicate_session_ids, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='pageinteraction',
+            name='timestamp',
+            field=models.DateTimeField(blank=True, db_index=True, default=django.utils.timezone.now, null=True),
+        ),
+        migrations.AlterField(
+            model_name='visitor',
+            name='visit_date',
+            field=models.DateTimeField(blank=True, db_index=True, default=django.utils.timezone.now, null=True),
+        ),
+        migrations.AlterField(
+            model_name='visitorsession',
+            name='session_id',
+            field=models.CharField(blank=True, max_length=100, null=True, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='visitorsession',
+            name='start_time',
+            field=models.DateTimeField(db_index=True, default=django.utils.timezone.now),
+        ),
+        migrations.AddIndex(
+            model_name='pageinteraction',
+            index=models.Index(fields=['section_id', 'timestamp'], name='interaction_section_time_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='pageinteraction',
+            index=models.Index(fields=['session', 'timestamp'], name='interaction_session_time_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='visitor',
+            index=models.Index(fields=['location', 'visit_date'], name='visitor_location_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='visitorsession',
+            index=models.Index(fields=['visitor', 'start_time'], name='session_visitor_start_idx'),
+        ),
+    ]
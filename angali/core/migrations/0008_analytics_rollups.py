@@ -0,0 +1,53 @@
+# Generated by Django 5.2.18 on 2026-10-17 00:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0007_landing_updated_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RollupWatermark',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=50, unique=True)),
+                ('last_id', models.PositiveBigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='DailySectionRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('section_id', models.CharField(blank=True, default='', max_length=255)),
+                ('interactions', models.PositiveIntegerField(default=0)),
+                ('sessions', models.PositiveIntegerField(default=0)),
+                ('total_scroll_depth', models.PositiveBigIntegerField(default=0)),
+                ('scroll_histogram', models.JSONField(default=list)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('day', 'section_id'), name='section_rollup_unique')],
+            },
+        ),
+        migrations.CreateModel(
+            name='DailySessionRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('location', models.CharField(blank=True, default='', max_length=255)),
+                ('referrer_host', models.CharField(blank=True, default='', max_length=255)),
+                ('sessions', models.PositiveIntegerField(default=0)),
+                ('visitors', models.PositiveIntegerField(default=0)),
+                ('total_duration', models.PositiveBigIntegerField(default=0)),
+                ('duration_histogram', models.JSONField(default=list)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('day', 'location', 'referrer_host'), name='session_rollup_unique')],
+            },
+        ),
+    ]
@@ -11,7 +11,13 @@ class Visitor(models.Model):
     uuid = models.UUIDField(unique=True, blank=True, null=True)
     ip_address = models.GenericIPAddressField(blank=True, null=True)
     location = models.CharField(max_length=255, blank=True, null=True)
-    visit_date = models.DateTimeField(default=timezone.now, blank=True, null=True)
+    visit_date = models.DateTimeField(default=timezone.now, blank=True, null=True, db_index=True)
+
+    class Meta:
+        indexes = [
+            # Admin: filter by location, then drill down by date
+            models.Index(fields=['location', 'visit_date'], name='visitor_location_date_idx'),
+        ]
 
     def __str__(self):
         return f"Visitor {self.uuid} ({self.ip_address})"
@@ -19,13 +25,19 @@ class Visitor(models.Model):
 
 class VisitorSession(models.Model):
     visitor = models.ForeignKey(Visitor, on_delete=models.CASCADE)
-    session_id = models.CharField(max_length=100, blank=True, null=True)
+    session_id = models.CharField(max_length=100, unique=True, blank=True, null=True)
     referrer = models.URLField(blank=True, null=True)
     user_agent = models.TextField(blank=True, null=True)
-    start_time = models.DateTimeField(auto_now_add=True)
+    start_time = models.DateTimeField(default=timezone.now, db_index=True)
     end_time = models.DateTimeField(blank=True, null=True)
     duration_seconds = models.PositiveIntegerField(default=0, blank=True, null=True)
 
+    class Meta:
+        indexes = [
+            # Inline on the visitor page and per-visitor session listings
+            models.Index(fields=['visitor', 'start_time'], name='session_visitor_start_idx'),
+        ]
+
     def __str__(self):
         return f"Session {self.session_id} of {self.visitor.ip_address}"
 
@@ -33,13 +45,87 @@ class VisitorSession(models.Model):
 class PageInteraction(models.Model):
     session = models.ForeignKey(VisitorSession, on_delete=models.CASCADE)
     section_id = models.CharField(max_length=255, blank=True, null=True)
-    timestamp = models.DateTimeField(auto_now_add=True, blank=True, null=True)
+    timestamp = models.DateTimeField(default=timezone.now, blank=True, null=True, db_index=True)
     scroll_depth = models.PositiveIntegerField(default=0, blank=True, null=True)  # in %
 
+    class Meta:
+        indexes = [
+            # Admin: filter by section, then drill down by date
+            models.Index(fields=['section_id', 'timestamp'], name='interaction_section_time_idx'),
+            models.Index(fields=['session', 'timestamp'], name='interaction_session_time_idx'),
+        ]
+
     def __str__(self):
         return f"{self.section_id} @ {self.timestamp}"
 
 
+class EventLogCheckpoint(models.Model):
+    """Position up to which the tracking event log has been compacted into the tables above."""
+    segment = models.CharField(max_length=100, blank=True, default='')
+    offset = models.PositiveBigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.segment or 'start'} @ {self.offset}"
+
+
+class DailySessionRollup(models.Model):
+    """Sessions started on a local day, by visitor location and referrer host. Written by `manage.py rollup`."""
+    day = models.DateField()
+    location = models.CharField(max_length=255, blank=True, default='')
+    referrer_host = models.CharField(max_length=255, blank=True, default='')  # '' for direct visits
+    sessions = models.PositiveIntegerField(default=0)
+    visitors = models.PositiveIntegerField(default=0)  # distinct visitors among those sessions
+    total_duration = models.PositiveBigIntegerField(default=0)  # seconds
+    # Sessions per duration band, split at core.rollup.DURATION_EDGES
+    duration_histogram = models.JSONField(default=list)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['day', 'location', 'referrer_host'], name='session_rollup_unique'),
+        ]
+
+    @property
+    def average_duration(self):
+        return self.total_duration / self.sessions if self.sessions else 0
+
+    def __str__(self):
+        return f"{self.day} {self.location or '-'} via {self.referrer_host or 'direct'}: {self.sessions}"
+
+
+class DailySectionRollup(models.Model):
+    """Interactions with a page section on a local day, with a scroll depth histogram. Written by `manage.py rollup`."""
+    day = models.DateField()
+    section_id = models.CharField(max_length=255, blank=True, default='')
+    interactions = models.PositiveIntegerField(default=0)
+    sessions = models.PositiveIntegerField(default=0)  # reach: distinct sessions that saw the section
+    total_scroll_depth = models.PositiveBigIntegerField(default=0)
+    # Interactions per scroll depth decile: [0-9%, 10-19%, ..., 90-99%, 100%]
+    scroll_histogram = models.JSONField(default=list)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['day', 'section_id'], name='section_rollup_unique'),
+        ]
+
+    @property
+    def average_scroll_depth(self):
+        return self.total_scroll_depth / self.interactions if self.interactions else 0
+
+    def __str__(self):
+        return f"{self.day} {self.section_id or '-'}: {self.interactions}"
+
+
+class RollupWatermark(models.Model):
+    """Highest primary key of a tracking table already folded into the rollups."""
+    name = models.CharField(max_length=50, unique=True)
+    last_id = models.PositiveBigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.name} @ {self.last_id}"
+
+
 # END OF VISITOR TRACKING MODELs 👆 ###############################################################################################################
 
 
@@ -67,6 +153,7 @@ class HeroSection(models.Model):
         null=True,
     )
     is_active = models.BooleanField(default=True)
+    updated_at = models.DateTimeField(auto_now=True)
 
     def __str__(self) -> str:
         return self.headline or "Hero Section"
@@ -90,6 +177,7 @@ class SectionContent(models.Model):
     title = models.CharField(max_length=255, blank=True, null=True)
     content = models.TextField(blank=True, null=True)
     image = models.ImageField(upload_to='section_images/', blank=True, null=True)
+    updated_at = models.DateTimeField(auto_now=True)
 
     def __str__(self) -> str:
         return self.title or "Section Content"
@@ -100,6 +188,7 @@ class Footer(models.Model):
     platform_name = models.CharField(max_length=100, blank=True, null=True)
     tagline = models.CharField(max_length=255, blank=True, null=True)
     rights_reserved_text = models.CharField(max_length=255, blank=True, null=True)
+    updated_at = models.DateTimeField(auto_now=True)
 
     def __str__(self) -> str:
         return self.platform_name or "Footer"
@@ -126,6 +215,7 @@ class FooterSection(models.Model):
         blank=True,
         null=True,
     )
+    updated_at = models.DateTimeField(auto_now=True)
 
     def __str__(self) -> str:
         return self.get_title_display() if self.title else "Footer Section"
@@ -143,6 +233,7 @@ class FooterLink(models.Model):
     label = models.CharField(max_length=100, blank=True, null=True)
     url = models.URLField(blank=True, null=True)
     order = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
 
     class Meta:
         ordering = ['order']
@@ -172,6 +263,7 @@ class Testimonial(models.Model):
         null=True,
     )
     show_on_homepage = models.BooleanField(default=True)
+    updated_at = models.DateTimeField(auto_now=True)
 
     def __str__(self) -> str:
         name = self.source_name or "Anonymous"
@@ -184,6 +276,7 @@ class Partner(models.Model):
     name = models.CharField(max_length=100, blank=True, null=True)
     logo = models.ImageField(upload_to='partners/', blank=True, null=True)
     website = models.URLField(blank=True, null=True)
+    updated_at = models.DateTimeField(auto_now=True)
 
     def __str__(self) -> str:
         return self.name or "Partner"
@@ -202,6 +295,7 @@ class CallToActionBlock(models.Model):
         null=True,
     )
     is_active = models.BooleanField(default=True)
+    updated_at = models.DateTimeField(auto_now=True)
 
     def __str__(self) -> str:
         return f"CTA: {self.title or 'Untitled'} @ {self.position or 'Unknown'}"
@@ -212,6 +306,7 @@ class FAQItem(models.Model):
     question = models.CharField(max_length=255, blank=True, null=True)
     answer = models.TextField(blank=True, null=True)
     order = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
 
     class Meta:
         ordering = ['order']
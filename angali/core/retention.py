@@ -0,0 +1,109 @@
+"""
+Retention for the raw tracking tables.
+
+``prune`` deletes ``PageInteraction``, then ``VisitorSession``, then
+``Visitor`` rows from before a cutoff. It works in primary key batches,
+selected through the tables' date indexes. Each batch commits on its own,
+with a pause between batches, so a long run never holds locks for long, and
+an interrupted run simply continues when started again. Rows are only
+pruned once ``manage.py rollup`` has folded them in (they are at or below
+its watermarks), so the daily rollups and the dashboard keep their history.
+A session is only pruned once all of its interactions are, and a visitor
+once all of its sessions are. Each batch's ids are selected inside its
+transaction and the DELETE repeats the conditions they were selected by, so
+a row that gained a child in between is left for a later run.
+"""
+import datetime
+import gzip
+import json
+import os
+import time
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models import Exists, OuterRef, Q
+from django.utils import timezone
+
+from .models import PageInteraction, RollupWatermark, Visitor, VisitorSession
+from .rollup import day_range
+
+
+def cutoff_for(days):
+    """Start of the local day ``days`` days ago, so whole days are pruned."""
+    return day_range(timezone.localdate() - datetime.timedelta(days=days))[0]
+
+
+def rolled_up_to(name):
+    watermark = RollupWatermark.objects.filter(name=name).first()
+    return watermark.last_id if watermark else 0
+
+
+def archive(rows, archive_dir, table, name):
+    """Write rows as gzipped JSON lines; a rerun of the same batch overwrites its file."""
+    directory = os.path.join(archive_dir, table)
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f'{name}.jsonl.gz')
+    with gzip.open(path + '.tmp', 'wt', encoding='utf-8') as f:
+        for row in rows:
+            f.write(json.dumps(row, cls=DjangoJSONEncoder) + '\n')
+    os.replace(path + '.tmp', path)
+
+
+def delete_batch(rows, archive_dir, name):
+    """Archive and delete ``rows``; returns ``{model label: rows deleted}``."""
+    if archive_dir:
+        archive(rows.values().order_by('pk').iterator(), archive_dir, rows.model._meta.db_table, name)
+    # Interactions have no cascades or signal receivers, so Django deletes them in
+    # one query; sessions and visitors only cascade to rows that are already gone
+    return rows.delete()[1]
+
+
+def prune(cutoff, batch_size=1000, sleep=0.1, archive_dir=None, progress=None):
+    """
+    Delete raw tracking rows from before ``cutoff``, children first.
+
+    Returns ``{model label: rows deleted}``. With ``archive_dir`` every batch
+    is first written to ``<archive_dir>/<table>/<first pk>-<last pk>.jsonl.gz``.
+    """
+    interactions_mark = rolled_up_to('interactions')
+    sessions_mark = rolled_up_to('sessions')
+    deleted = dict.fromkeys([PageInteraction._meta.label, VisitorSession._meta.label, Visitor._meta.label], 0)
+
+    def tally(counts):
+        for label, count in counts.items():
+            deleted[label] = deleted.get(label, 0) + count
+
+    def batches(queryset):
+        while True:
+            # The caller's loop body runs inside this transaction
+            with transaction.atomic():
+                ids = list(queryset.order_by('pk').values_list('pk', flat=True)[:batch_size])
+                if ids:
+                    yield queryset.filter(pk__in=ids), f'{ids[0]}-{ids[-1]}'
+            if not ids:
+                return
+            if progress:
+                progress(deleted)
+            time.sleep(sleep)
+
+    old_interactions = PageInteraction.objects.filter(timestamp__lt=cutoff, pk__lte=interactions_mark)
+    for rows, name in batches(old_interactions):
+        tally(delete_batch(rows, archive_dir, name))
+
+    # A session stays while any of its interactions is newer than the cutoff or the rollups
+    old_sessions = VisitorSession.objects.filter(start_time__lt=cutoff, pk__lte=sessions_mark).exclude(
+        Exists(PageInteraction.objects.filter(
+            Q(timestamp__gte=cutoff) | Q(pk__gt=interactions_mark), session=OuterRef('pk'),
+        ))
+    )
+    for sessions, name in batches(old_sessions):
+        tally(delete_batch(PageInteraction.objects.filter(session__in=sessions), archive_dir, f'session-{name}'))
+        tally(delete_batch(sessions, archive_dir, name))
+
+    # Visitors who came back after the cutoff still have sessions and are kept
+    old_visitors = Visitor.objects.filter(visit_date__lt=cutoff).exclude(
+        Exists(VisitorSession.objects.filter(visitor=OuterRef('pk')))
+    )
+    for visitors, name in batches(old_visitors):
+        tally(delete_batch(visitors, archive_dir, name))
+    return deleted
@@ -0,0 +1,126 @@
+"""
+Daily analytics rollups.
+
+``refresh`` folds ``VisitorSession`` and ``PageInteraction`` into
+``DailySessionRollup`` and ``DailySectionRollup``. Each local day is
+recomputed whole from an index range scan on its raw rows, so a rerun is
+idempotent. Only the days holding rows above the ``RollupWatermark`` (by
+primary key, so late inserts from the write-behind buffer or the event log
+are caught) are recomputed, plus the last ``ROLLUP_SETTLE_DAYS`` days, whose
+sessions may still be getting end beacons and resolved locations.
+"""
+import bisect
+import datetime
+from collections import defaultdict
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, ExpressionWrapper, IntegerField, Max, Sum, Value
+from django.db.models.functions import Coalesce, Least, TruncDate
+from django.utils import timezone
+
+from .models import DailySectionRollup, DailySessionRollup, PageInteraction, RollupWatermark, VisitorSession
+
+HISTOGRAM_BUCKETS = 11  # scroll depth deciles, plus 100%
+# Session duration bands in seconds: under 10s, 10-30s, 30s-1m, 1-3m, 3-10m and longer
+DURATION_EDGES = (10, 30, 60, 180, 600)
+
+
+def day_range(day):
+    """Start and end of a local day as aware datetimes."""
+    start = timezone.make_aware(datetime.datetime.combine(day, datetime.time.min))
+    return start, timezone.make_aware(datetime.datetime.combine(day + datetime.timedelta(days=1), datetime.time.min))
+
+
+def referrer_host(referrer):
+    try:
+        return (urlsplit(referrer).hostname or '')[:255] if referrer else ''
+    except ValueError:
+        return ''
+
+
+def rollup_sessions(day):
+    """``DailySessionRollup`` rows for one day, computed from its sessions."""
+    start, end = day_range(day)
+    groups = defaultdict(lambda: [0, set(), 0, [0] * (len(DURATION_EDGES) + 1)])
+    rows = (
+        VisitorSession.objects.filter(start_time__gte=start, start_time__lt=end).order_by()
+        .values_list('visitor__location', 'referrer', 'visitor_id', 'duration_seconds')
+    )
+    # Referrer hosts are parsed in Python; SQL has no portable URL functions
+    for location, referrer, visitor_id, duration in rows.iterator(chunk_size=5000):
+        group = groups[(location or '')[:255], referrer_host(referrer)]
+        group[0] += 1
+        group[1].add(visitor_id)
+        group[2] += duration or 0
+        group[3][bisect.bisect_right(DURATION_EDGES, duration or 0)] += 1
+    return [
+        DailySessionRollup(
+            day=day, location=location, referrer_host=host, sessions=sessions,
+            visitors=len(visitors), total_duration=duration, duration_histogram=histogram,
+        )
+        for (location, host), (sessions, visitors, duration, histogram) in groups.items()
+    ]
+
+
+def rollup_sections(day):
+    """``DailySectionRollup`` rows for one day, computed from its interactions."""
+    start, end = day_range(day)
+    interactions = PageInteraction.objects.filter(timestamp__gte=start, timestamp__lt=end).order_by()
+    depth = Coalesce('scroll_depth', 0)
+    totals = interactions.values('section_id').annotate(
+        interactions=Count('pk'), sessions=Count('session', distinct=True), total_scroll_depth=Sum(depth),
+    )
+    bucket = Least(ExpressionWrapper(depth / 10, output_field=IntegerField()), Value(HISTOGRAM_BUCKETS - 1))
+    histograms = defaultdict(lambda: [0] * HISTOGRAM_BUCKETS)
+    for row in interactions.values('section_id', bucket=bucket).annotate(count=Count('pk')):
+        histograms[row['section_id'] or ''][row['bucket']] += row['count']
+    rollups = {}
+    for row in totals:
+        section_id = row['section_id'] or ''
+        # NULL and '' sections fold into one row
+        rollup = rollups.setdefault(section_id, DailySectionRollup(
+            day=day, section_id=section_id, scroll_histogram=histograms[section_id],
+        ))
+        rollup.interactions += row['interactions']
+        rollup.sessions += row['sessions']
+        rollup.total_scroll_depth += row['total_scroll_depth'] or 0
+    return list(rollups.values())
+
+
+# Rollup model, raw model, the raw model's day field, and the function computing one day
+ROLLUPS = {
+    'sessions': (DailySessionRollup, VisitorSession, 'start_time', rollup_sessions),
+    'interactions': (DailySectionRollup, PageInteraction, 'timestamp', rollup_sections),
+}
+
+
+def dirty_days(model, field, after_id, up_to_id):
+    """Local days holding rows with a primary key in ``(after_id, up_to_id]``."""
+    return set(
+        model.objects.filter(pk__gt=after_id, pk__lte=up_to_id, **{f'{field}__isnull': False})
+        .annotate(day=TruncDate(field)).order_by().values_list('day', flat=True).distinct()
+    )
+
+
+def refresh(full=False):
+    """Recompute the days with new rows and the settle window. Returns ``{name: days recomputed}``."""
+    today = timezone.localdate()
+    settle = {today - datetime.timedelta(days=n) for n in range(getattr(settings, 'ROLLUP_SETTLE_DAYS', 1) + 1)}
+    recomputed = {}
+    for name, (rollup_model, model, field, compute) in ROLLUPS.items():
+        watermark, _ = RollupWatermark.objects.get_or_create(name=name)
+        after_id = 0 if full else watermark.last_id
+        up_to_id = model.objects.aggregate(last=Max('pk'))['last'] or 0
+        # Days whose raw rows have been pruned are never dirty, so their rollups are kept
+        days = dirty_days(model, field, after_id, up_to_id) | settle
+        for day in sorted(days):
+            with transaction.atomic():
+                rollup_model.objects.filter(day=day).delete()
+                rollup_model.objects.bulk_create(compute(day))
+        # Advanced last: an interrupted run recomputes the same days again
+        watermark.last_id = up_to_id
+        watermark.save()
+        recomputed[name] = len(days)
+    return recomputed
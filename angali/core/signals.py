@@ -0,0 +1,67 @@
+from django.db import close_old_connections
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from .landing import FRAGMENT_MODELS, fragments_for_model, invalidate_content_version, invalidate_fragments
+from .images import delete_thumbnails, generate_after_commit, instance_sources, model_image_fields
+from .snapshot import publish, schedule_publish
+
+LANDING_MODELS = {model for models in FRAGMENT_MODELS.values() for model in models}
+
+
+def landing_receiver(*signals):
+    """
+    ``@receiver`` for each landing model as sender.
+
+    A receiver without a sender would make Django collect every deleted
+    row of every model (the tracking tables included) to send it signals,
+    instead of deleting them with one fast query.
+    """
+    def connect(func):
+        for model in LANDING_MODELS:
+            receiver(list(signals), sender=model)(func)
+        return func
+    return connect
+
+
+@landing_receiver(post_save, post_delete)
+def invalidate_landing_fragments(sender, **kwargs):
+    """Give the changed model's fragments a new version and republish the snapshot."""
+    invalidate_content_version()
+    schedule_publish(using=kwargs.get('using'))
+
+
+@landing_receiver(post_save)
+def generate_landing_image_derivatives(sender, instance, **kwargs):
+    """Resize uploads in the background; the section is re-rendered once their derivatives exist."""
+    paths = instance_sources(instance)
+    if not paths:
+        return
+
+    def refresh():
+        invalidate_fragments(fragments_for_model(sender))
+        try:
+            publish()
+        finally:
+            close_old_connections()
+
+    generate_after_commit(paths, on_done=refresh)
+
+
+@landing_receiver(pre_save)
+def drop_replaced_thumbnails(sender, instance, raw=False, **kwargs):
+    """Remove the admin thumbnails of files an ImageField is about to stop pointing at."""
+    fields = model_image_fields(sender)
+    if raw or not fields or instance.pk is None:
+        return
+    previous = sender._default_manager.filter(pk=instance.pk).values(*[field.attname for field in fields]).first()
+    for field in fields:
+        old_name = (previous or {}).get(field.attname)
+        if old_name and old_name != getattr(instance, field.attname).name:
+            delete_thumbnails(old_name)
+
+
+@landing_receiver(post_delete)
+def drop_deleted_thumbnails(sender, instance, **kwargs):
+    for field in model_image_fields(sender):
+        delete_thumbnails(getattr(instance, field.attname).name)
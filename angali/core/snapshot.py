@@ -0,0 +1,171 @@
+"""
+Prebuilt homepage snapshot.
+
+``publish`` renders files/index.html once and writes it to
+``LANDING_SNAPSHOT_DIR`` together with a gzip copy and, when the ``brotli``
+package is installed, a brotli copy. Every file is written under a temporary
+name and renamed into place, so a reader only ever sees a whole page. The
+home view streams the best encoding the client accepts and only renders live
+when no snapshot has been published.
+
+The fingerprint of the templates and static manifest the page was rendered
+with is saved next to it. A snapshot published before a deploy changed either
+is rebuilt by the first request that finds it, so the page body never lags
+behind the ETag.
+"""
+import gzip
+import logging
+import os
+import tempfile
+
+from django.conf import settings
+from django.db import transaction
+from django.template.loader import render_to_string
+
+from .landing import FRAGMENT_MODELS, invalidate_fragments, landing_context, template_fingerprint
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_NAME = 'index.html'
+FINGERPRINT_SUFFIX = '.fingerprint'
+# Precompressed variants, most preferred first
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+
+def snapshot_dir():
+    directory = getattr(settings, 'LANDING_SNAPSHOT_DIR', None)
+    return str(directory) if directory else None
+
+
+def snapshot_path():
+    directory = snapshot_dir()
+    return os.path.join(directory, SNAPSHOT_NAME) if directory else None
+
+
+def _write_atomic(path, data):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.' + os.path.basename(path))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+def _remove(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+def unpublish():
+    """Remove the snapshot so the homepage is rendered live again."""
+    path = snapshot_path()
+    if path:
+        _remove(path + FINGERPRINT_SUFFIX)
+        for _, suffix in ENCODINGS:
+            _remove(path + suffix)
+        _remove(path)
+
+
+def publish():
+    """Render the homepage and write it with its precompressed copies. Returns the path, or None when disabled."""
+    path = snapshot_path()
+    if path is None:
+        return None
+    fingerprint = template_fingerprint()[0]
+    try:
+        # Start from fresh fragments: the cache may be per process and stale elsewhere
+        invalidate_fragments(FRAGMENT_MODELS)
+        html = render_to_string('files/index.html', landing_context()).encode('utf-8')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # mtime=0 keeps the gzip bytes identical for identical pages
+        _write_atomic(path + '.gz', gzip.compress(html, compresslevel=9, mtime=0))
+        if brotli is not None:
+            _write_atomic(path + '.br', brotli.compress(html, quality=11))
+        else:
+            _remove(path + '.br')
+        _write_atomic(path, html)
+        # Written last: a reader that sees the new fingerprint sees the new page
+        _write_atomic(path + FINGERPRINT_SUFFIX, fingerprint.encode('ascii'))
+    except Exception:
+        # A stale snapshot would hide the change, so fall back to live rendering
+        unpublish()
+        raise
+    return path
+
+
+def schedule_publish(using=None):
+    """Publish once the current transaction commits, at most once per transaction."""
+    connection = transaction.get_connection(using)
+    if any(entry[1] is publish for entry in connection.run_on_commit):
+        return
+    transaction.on_commit(publish, using=using, robust=True)
+
+
+def accepted_encodings(header):
+    """Content codings named in an Accept-Encoding header, leaving out those with q=0."""
+    accepted = set()
+    for part in header.split(','):
+        coding, _, params = part.partition(';')
+        coding = coding.strip().lower()
+        quality = params.strip().lower()
+        if quality.startswith('q='):
+            try:
+                if float(quality[2:]) == 0:
+                    continue
+            except ValueError:
+                continue
+        if coding:
+            accepted.add(coding)
+    return accepted
+
+
+def published_fingerprint(path):
+    try:
+        with open(path + FINGERPRINT_SUFFIX, 'rb') as f:
+            return f.read().decode('ascii')
+    except (FileNotFoundError, UnicodeDecodeError):
+        return None
+
+
+def open_snapshot(accept_encoding=''):
+    """
+    Open the best published variant for an Accept-Encoding header.
+
+    Returns ``(file, content_encoding)``; ``content_encoding`` is None for the
+    plain HTML and ``file`` is None when nothing has been published. A
+    snapshot rendered from other templates or static files is republished
+    first; if that fails the page is rendered live.
+    """
+    path = snapshot_path()
+    if path is None or not os.path.exists(path):
+        return None, None
+    if published_fingerprint(path) != template_fingerprint()[0]:
+        try:
+            publish()
+        except Exception:
+            logger.exception("Could not republish the stale homepage snapshot")
+            return None, None
+    accepted = accepted_encodings(accept_encoding)
+    for encoding, suffix in ENCODINGS:
+        if encoding in accepted:
+            try:
+                return open(path + suffix, 'rb'), encoding
+            except FileNotFoundError:
+                continue
+    try:
+        return open(path, 'rb'), None
+    except FileNotFoundError:
+        return None, None
@@ -0,0 +1,91 @@
+import functools
+import gzip
+import os
+
+from django.conf import settings
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage
+
+from .images import generate_many, is_raster
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Text formats worth precompressing; images and fonts are compressed already
+COMPRESSIBLE_EXTENSIONS = ('.css', '.js', '.svg', '.json', '.txt', '.xml', '.html', '.ico', '.map')
+# Below this size the compressed copy is not worth a second file
+MIN_COMPRESS_SIZE = 512
+
+
+def without_source_maps(patterns):
+    """Drop the sourceMappingURL rewrites, whose targets are not collected."""
+    return tuple(
+        (extension, tuple(
+            pattern for pattern in extension_patterns
+            if 'sourceMappingURL' not in (pattern[0] if isinstance(pattern, (tuple, list)) else pattern)
+        ))
+        for extension, extension_patterns in patterns
+    )
+
+
+class CompressedManifestStaticFilesStorage(ManifestStaticFilesStorage):
+    """
+    Manifest storage that also writes ``.gz`` and ``.br`` siblings.
+
+    collectstatic stores every file under a content-hashed name, so the
+    hashed files can be cached forever. Each compressible hashed file then
+    gets a gzip copy and, when the ``brotli`` package is installed, a brotli
+    copy, which ``core.views.static_asset`` serves according to Accept-Encoding.
+    Source maps are only collected with ``STATIC_SOURCE_MAPS``. Images under
+    ``RESPONSIVE_IMAGE_STATIC_PREFIXES`` get their responsive derivatives.
+    """
+
+    def __init__(self, *args, **kwargs):
+        if not getattr(settings, 'STATIC_SOURCE_MAPS', False):
+            self.patterns = without_source_maps(self.patterns)
+        super().__init__(*args, **kwargs)
+
+    @functools.cached_property
+    def immutable_names(self):
+        """The hashed names from the manifest, which never change content."""
+        return frozenset(self.hashed_files.values())
+
+    def post_process(self, paths, dry_run=False, **options):
+        yield from super().post_process(paths, dry_run=dry_run, **options)
+        if dry_run:
+            return
+        for name in sorted(set(self.hashed_files.values())):
+            for compressed_name in self.compress(name):
+                yield name, compressed_name, True
+        # Responsive derivatives are keyed by content, so only new images cost anything
+        prefixes = tuple(getattr(settings, 'RESPONSIVE_IMAGE_STATIC_PREFIXES', ()))
+        generate_many([self.path(name) for name in paths if name.startswith(prefixes) and is_raster(name)])
+
+    def compress(self, name):
+        """Write the precompressed siblings of ``name`` that are missing. Returns their names."""
+        if not name.endswith(COMPRESSIBLE_EXTENSIONS):
+            return []
+        path = self.path(name)
+        with open(path, 'rb') as f:
+            data = f.read()
+        if len(data) < MIN_COMPRESS_SIZE:
+            return []
+
+        written = []
+        compressors = [('.gz', lambda data: gzip.compress(data, compresslevel=9, mtime=0))]
+        if brotli is not None:
+            compressors.append(('.br', lambda data: brotli.compress(data, quality=11)))
+        for suffix, compress in compressors:
+            # Hashed names are content addressed: an existing sibling is already current
+            if os.path.exists(path + suffix):
+                continue
+            compressed = compress(data)
+            if len(compressed) >= len(data):
+                continue
+            # Written under a temporary name so an interrupted run leaves no partial sibling
+            with open(path + suffix + '.tmp', 'wb') as f:
+                f.write(compressed)
+            os.replace(path + suffix + '.tmp', path + suffix)
+            written.append(name + suffix)
+        return written
@@ -0,0 +1,25 @@
+from django import template
+from django.utils.html import format_html_join
+
+from core.images import FORMATS, derivatives
+
+register = template.Library()
+
+
+@register.simple_tag
+def responsive_sources(image, sizes='100vw'):
+    """
+    ``<source>`` elements for a ``<picture>``, best format first.
+
+    ``image`` is an ImageField file or a static path. Renders nothing until
+    derivatives exist, leaving the ``<img>`` inside the ``<picture>`` to load
+    the original.
+    """
+    return format_html_join(
+        '',
+        '<source type="{}" srcset="{}" sizes="{}">',
+        (
+            (FORMATS[name][0], ', '.join(f'{url} {width}w' for width, url in entries), sizes)
+            for name, entries in derivatives(image).items()
+        ),
+    )
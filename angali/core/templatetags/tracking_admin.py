@@ -0,0 +1,88 @@
+import datetime
+
+from django import template
+from django.contrib.admin.templatetags.admin_list import date_hierarchy
+from django.utils import formats
+from django.utils.text import capfirst
+from django.utils.translation import gettext as _
+
+from core.changelist import day_counts
+
+register = template.Library()
+
+
+@register.inclusion_tag('admin/date_hierarchy.html')
+def cached_date_hierarchy(cl):
+    """
+    The admin's date drilldown, built from the cached per-day counts.
+
+    Only an unfiltered list can use them; with a filter or a search the admin's
+    own drilldown over the filtered rows is shown.
+    """
+    field = cl.date_hierarchy
+    prefix = f'{field}__'
+    year_field, month_field, day_field = f'{prefix}year', f'{prefix}month', f'{prefix}day'
+    if cl.query or set(cl.get_filters_params()) - {year_field, month_field, day_field}:
+        return date_hierarchy(cl)
+
+    try:
+        year = int(cl.params.get(year_field) or 0)
+        month = int(cl.params.get(month_field) or 0)
+        day = int(cl.params.get(day_field) or 0)
+    except ValueError:
+        return date_hierarchy(cl)
+    days = sorted(day_counts(cl.model, field))
+
+    def link(filters):
+        return cl.get_query_string(filters, [prefix])
+
+    # Like the admin, start at the narrowest level that holds every row
+    if not year and days:
+        if days[0].year == days[-1].year:
+            year = days[0].year
+            if days[0].month == days[-1].month:
+                month = days[0].month
+
+    if year and month and day:
+        date = datetime.date(year, month, day)
+        return {
+            'show': True,
+            'back': {
+                'link': link({year_field: year, month_field: month}),
+                'title': capfirst(formats.date_format(date, 'YEAR_MONTH_FORMAT')),
+            },
+            'choices': [{'title': capfirst(formats.date_format(date, 'MONTH_DAY_FORMAT'))}],
+        }
+    if year and month:
+        return {
+            'show': True,
+            'back': {'link': link({year_field: year}), 'title': str(year)},
+            'choices': [
+                {
+                    'link': link({year_field: year, month_field: month, day_field: date.day}),
+                    'title': capfirst(formats.date_format(date, 'MONTH_DAY_FORMAT')),
+                }
+                for date in days if (date.year, date.month) == (year, month)
+            ],
+        }
+    if year:
+        months = sorted({date.replace(day=1) for date in days if date.year == year})
+        return {
+            'show': True,
+            'back': {'link': link({}), 'title': _('All dates')},
+            'choices': [
+                {
+                    'link': link({year_field: year, month_field: date.month}),
+                    'title': capfirst(formats.date_format(date, 'YEAR_MONTH_FORMAT')),
+                }
+                for date in months
+            ],
+        }
+    return {
+        'show': True,
+        'back': None,
+        'choices': [
+            {'link': link({year_field: str(y)}), 'title': str(y)}
+            for y in sorted({date.year for date in days})
+        ],
+    }
@@ -1,12 +1,77 @@
-from django.test import TestCase, Client
+from asgiref.sync import sync_to_async
+from django.test import AsyncRequestFactory, TestCase, Client, RequestFactory, override_settings
+from django.http import FileResponse, HttpResponse
 from django.urls import reverse
 from django.utils import timezone
-from .models import Visitor, VisitorSession, PageInteraction
+from django.core.cache import cache
+from .models import (
+    Visitor, VisitorSession, PageInteraction, HeroSection, Testimonial, FAQItem, Footer, FooterSection, FooterLink,
+    Partner, DailySectionRollup, DailySessionRollup, RollupWatermark,
+)
+from .geolocation import (
+    PENDING_LOCATION, UNKNOWN_LOCATION, IPApiBackend, _load_backends, alookup_locations, apply_locations,
+    location_cache, lookup_locations, resolve_batch,
+)
+from .geoip import RangeDatabase, compile_ranges, read_ranges
+from .buffer import EventBuffer
+from .eventlog import EventLogWriter, read_segment
+from .ingest import END, START, VISITOR
+from .snapshot import accepted_encodings, publish, published_fingerprint, snapshot_path
+from .instrumentation import timed
+from .metrics import (
+    Counter, Histogram, MetricsRegistry, MmapValues, fold_dead_files, read_file, registry, sample_key,
+)
+from .middleware import VisitorTrackingMiddleware
+from .views import atrack_end, atrack_start, static_asset
+from .landing import invalidate_content_version
+from .critical import (
+    build_critical_css, drop_unused_custom_properties, extract_rules, output_path, selector_used, size_budget,
+    used_selectors,
+)
+from .images import derivatives, generate_many, thumbnail
+from .rollup import refresh
+from .retention import delete_batch
+from .changelist import day_counts, table_estimate
+from django.contrib.auth.models import User
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.template import Context, Template
+from django.templatetags.static import static
+from PIL import Image
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.core.management import CommandError, call_command
+from django.db import IntegrityError, OperationalError, connection, transaction
+from django.db.models import Sum
+from django.db.models.deletion import Collector
+from django.test.utils import CaptureQueriesContext
+from unittest import skipUnless
 import json
 from unittest.mock import patch
 import uuid
+import datetime
+import gzip
+from types import SimpleNamespace
+import io
+import os
+import stat
+import tempfile
+import time
+import requests
 
 
+def setUpModule():
+    # Counters incremented by any test go to a scratch directory, not BASE_DIR/metrics
+    global _metrics_dir, _metrics_settings
+    _metrics_dir = tempfile.TemporaryDirectory()
+    _metrics_settings = override_settings(METRICS_DIR=_metrics_dir.name)
+    _metrics_settings.enable()
+
+
+def tearDownModule():
+    _metrics_settings.disable()
+    _metrics_dir.cleanup()
+
+
+@override_settings(VISITOR_GEOLOCATION_WORKERS=0)
 class VisitorTrackingTests(TestCase):
     def setUp(self):
         # Create a test client for simulating HTTP requests
@@ -170,4 +235,1649 @@ class VisitorTrackingTests(TestCase):
         self.assertEqual(session.session_id, 'test-session-id')
         self.assertEqual(str(session.visitor.uuid), self.visitor_uuid_str)
         self.assertEqual(session.referrer, 'https://example.com')
-        self.assertEqual(session.user_agent, 'Mozilla/5.0')
\ No newline at end of file
+        self.assertEqual(session.user_agent, 'Mozilla/5.0')
+
+
+@override_settings(VISITOR_GEOLOCATION_WORKERS=0)
+class GeolocationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        location_cache.clear()
+
+    @patch('requests.get')
+    def test_new_visitor_location_is_pending(self, mock_get):
+        response = self.client.get('/')
+
+        # No network call on the request path
+        mock_get.assert_not_called()
+        visitor = Visitor.objects.get(uuid=response.cookies['visitor_id'].value)
+        self.assertEqual(visitor.location, PENDING_LOCATION)
+
+    @patch('requests.post')
+    def test_resolve_batch_updates_pending_visitors(self, mock_post):
+        mock_post.return_value.json.return_value = [
+            {'status': 'success', 'city': 'Nairobi', 'country': 'Kenya', 'query': '41.90.0.1'},
+            {'status': 'fail', 'query': '10.0.0.1'},
+        ]
+        Visitor.objects.create(uuid=uuid.uuid4(), ip_address='41.90.0.1', location=PENDING_LOCATION)
+        Visitor.objects.create(uuid=uuid.uuid4(), ip_address='41.90.0.1', location=PENDING_LOCATION)
+        Visitor.objects.create(uuid=uuid.uuid4(), ip_address='10.0.0.1', location=PENDING_LOCATION)
+
+        updated = resolve_batch(['41.90.0.1', '10.0.0.1'])
+
+        self.assertEqual(updated, 3)
+        self.assertEqual(mock_post.call_count, 1)
+        self.assertEqual(Visitor.objects.filter(location='Nairobi, Kenya').count(), 2)
+        self.assertEqual(Visitor.objects.filter(location=UNKNOWN_LOCATION).count(), 1)
+
+    def test_location_updates_stay_within_the_parameter_limit(self):
+        locations = {f'41.90.{n // 256}.{n % 256}': 'Nairobi, Kenya' for n in range(400)}
+        Visitor.objects.bulk_create(
+            Visitor(uuid=uuid.uuid4(), ip_address=ip_address, location=PENDING_LOCATION) for ip_address in locations
+        )
+
+        with patch.object(connection.features, 'max_query_params', 999), CaptureQueriesContext(connection) as queries:
+            updated = apply_locations(locations)
+
+        self.assertEqual(updated, 400)
+        self.assertEqual(len(queries), 2)
+
+    @patch('requests.post', side_effect=requests.exceptions.ConnectTimeout)
+    def test_failed_lookup_leaves_visitors_pending(self, mock_post):
+        Visitor.objects.create(uuid=uuid.uuid4(), ip_address='41.90.0.1', location=PENDING_LOCATION)
+
+        self.assertEqual(resolve_batch(['41.90.0.1']), 0)
+
+        self.assertTrue(Visitor.objects.filter(location=PENDING_LOCATION).exists())
+
+    @patch('core.geolocation.IP_API_BATCH_LIMIT', 1)
+    @patch('requests.post')
+    def test_rate_limited_lookup_stops_and_backs_off(self, mock_post):
+        mock_post.return_value.status_code = 429
+        mock_post.return_value.headers = {'X-Rl': '0', 'X-Ttl': '30'}
+        backend = IPApiBackend()
+
+        self.assertEqual(backend.lookup_many(['41.90.0.1', '41.90.0.2']), {})
+        # The second batch is not sent into the rate limit
+        self.assertEqual(mock_post.call_count, 1)
+
+        mock_post.return_value.status_code = 200
+        mock_post.return_value.headers = {'X-Rl': '44', 'X-Ttl': '60'}
+        mock_post.return_value.json.return_value = [
+            {'status': 'success', 'city': 'Nairobi', 'country': 'Kenya', 'query': '41.90.0.1'},
+        ]
+        with patch('core.geolocation.time.sleep') as sleep:
+            self.assertEqual(backend.lookup_many(['41.90.0.1']), {'41.90.0.1': 'Nairobi, Kenya'})
+        self.assertAlmostEqual(sleep.call_args.args[0], 30, delta=1)
+
+    def test_locations_are_applied_in_one_update(self):
+        for ip_address in ('41.90.0.1', '41.90.0.2', '41.90.0.3'):
+            Visitor.objects.create(uuid=uuid.uuid4(), ip_address=ip_address, location=PENDING_LOCATION)
+        Visitor.objects.create(uuid=uuid.uuid4(), ip_address='41.90.0.1', location='Resolved, Earlier')
+
+        with self.assertNumQueries(1):
+            updated = apply_locations({'41.90.0.1': 'Nairobi, Kenya', '41.90.0.2': 'Kisumu, Kenya'})
+
+        self.assertEqual(updated, 2)
+        self.assertEqual(
+            dict(Visitor.objects.values_list('ip_address', 'location').exclude(location='Resolved, Earlier')),
+            {'41.90.0.1': 'Nairobi, Kenya', '41.90.0.2': 'Kisumu, Kenya', '41.90.0.3': PENDING_LOCATION},
+        )
+
+
+class RangeDatabaseTests(TestCase):
+    RANGES_CSV = (
+        "network,city,country\n"
+        "41.90.0.0/16,Nairobi,Kenya\n"
+        "102.0.0.0/15,Mombasa,Kenya\n"
+        "2c0f:fe38::/32,Kisumu,Kenya\n"
+    )
+
+    def setUp(self):
+        cache.clear()
+        location_cache.clear()
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.path = os.path.join(tmp_dir.name, 'ranges.bin')
+        compile_ranges(read_ranges(io.StringIO(self.RANGES_CSV)), self.path)
+
+    def test_lookup_ipv4_and_ipv6(self):
+        database = RangeDatabase(self.path)
+        self.addCleanup(database.close)
+
+        self.assertEqual(database.lookup('41.90.12.34'), 'Nairobi, Kenya')
+        self.assertEqual(database.lookup('102.1.255.255'), 'Mombasa, Kenya')
+        self.assertEqual(database.lookup('2c0f:fe38:1::1'), 'Kisumu, Kenya')
+        self.assertEqual(database.lookup('::ffff:41.90.0.1'), 'Nairobi, Kenya')
+        self.assertIsNone(database.lookup('8.8.8.8'))
+        self.assertIsNone(database.lookup('not-an-ip'))
+
+    def test_nested_ranges_win_over_the_ranges_around_them(self):
+        ranges = (
+            "network,city,country\n"
+            "10.0.0.0/8,Nairobi,Kenya\n"
+            "10.1.0.0/16,Kisumu,Kenya\n"
+            "10.1.2.0/24,Eldoret,Kenya\n"
+            "10.0.255.0/24,Nakuru,Kenya\n"
+            "10.1.0.0/16,Duplicate,Kenya\n"
+        )
+        # The duplicate is the only range dropped
+        self.assertEqual(compile_ranges(read_ranges(io.StringIO(ranges)), self.path), (6, 0, 1))
+        database = RangeDatabase(self.path)
+        self.addCleanup(database.close)
+
+        self.assertEqual(database.lookup('10.0.0.1'), 'Nairobi, Kenya')
+        self.assertEqual(database.lookup('10.0.255.9'), 'Nakuru, Kenya')
+        self.assertEqual(database.lookup('10.1.0.1'), 'Kisumu, Kenya')
+        self.assertEqual(database.lookup('10.1.2.3'), 'Eldoret, Kenya')
+        self.assertEqual(database.lookup('10.1.3.0'), 'Kisumu, Kenya')
+        self.assertEqual(database.lookup('10.255.255.255'), 'Nairobi, Kenya')
+        self.assertEqual(stat.S_IMODE(os.stat(self.path).st_mode), 0o644)
+
+    @patch('requests.post')
+    def test_backend_chain_falls_back_to_http(self, mock_post):
+        mock_post.return_value.json.return_value = [
+            {'status': 'success', 'city': 'Mountain View', 'country': 'United States', 'query': '8.8.8.8'},
+        ]
+        Visitor.objects.create(uuid=uuid.uuid4(), ip_address='41.90.0.1', location=PENDING_LOCATION)
+        Visitor.objects.create(uuid=uuid.uuid4(), ip_address='8.8.8.8', location=PENDING_LOCATION)
+
+        _load_backends.cache_clear()
+        self.addCleanup(_load_backends.cache_clear)
+        with override_settings(GEOIP_DATABASE_PATH=self.path):
+            resolve_batch(['41.90.0.1', '8.8.8.8'])
+
+        # Only the IP missing from the local database goes over the network
+        self.assertEqual(mock_post.call_args.kwargs['json'], ['8.8.8.8'])
+        self.assertTrue(Visitor.objects.filter(ip_address='41.90.0.1', location='Nairobi, Kenya').exists())
+        self.assertTrue(Visitor.objects.filter(ip_address='8.8.8.8', location='Mountain View, United States').exists())
+
+
+class LocationCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        location_cache.clear()
+
+    @patch('requests.post')
+    def test_repeat_lookups_are_served_from_cache(self, mock_post):
+        mock_post.return_value.json.return_value = [
+            {'status': 'success', 'city': 'Nairobi', 'country': 'Kenya', 'query': '41.90.0.1'},
+            {'status': 'fail', 'query': '10.0.0.1'},
+        ]
+
+        lookup_locations(['41.90.0.1', '10.0.0.1'])
+        locations = lookup_locations(['41.90.0.1', '10.0.0.1'])
+
+        # Negative results are cached as well
+        self.assertEqual(mock_post.call_count, 1)
+        self.assertEqual(locations, {'41.90.0.1': 'Nairobi, Kenya', '10.0.0.1': UNKNOWN_LOCATION})
+        stats = location_cache.stats()
+        self.assertEqual(stats['local_hits'], 2)
+        self.assertEqual(stats['misses'], 2)
+
+    @patch('requests.post', side_effect=requests.exceptions.ConnectTimeout)
+    def test_failed_lookups_are_not_cached(self, mock_post):
+        lookup_locations(['41.90.0.1'])
+        lookup_locations(['41.90.0.1'])
+
+        self.assertEqual(mock_post.call_count, 2)
+        self.assertEqual(lookup_locations(['41.90.0.1']), {})
+        self.assertEqual(location_cache.get_many(['41.90.0.1']), {})
+
+    def test_shared_tier_refills_local_tier(self):
+        location_cache.set_many({'41.90.0.1': 'Nairobi, Kenya'})
+        location_cache.clear()
+
+        self.assertEqual(location_cache.get_many(['41.90.0.1']), {'41.90.0.1': 'Nairobi, Kenya'})
+        self.assertEqual(location_cache.stats()['shared_hits'], 1)
+
+    @override_settings(VISITOR_GEOLOCATION_CACHE_SIZE=2, VISITOR_GEOLOCATION_CACHE_ALIAS='dummy', CACHES={
+        'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+        'dummy': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'},
+    })
+    def test_local_tier_is_bounded(self):
+        location_cache.set_many({'1.1.1.1': 'A, B', '2.2.2.2': 'C, D'})
+        location_cache.get_many(['1.1.1.1'])  # 2.2.2.2 is now least recently used
+        location_cache.set_many({'3.3.3.3': 'E, F'})
+
+        self.assertEqual(location_cache.stats()['size'], 2)
+        self.assertEqual(set(location_cache.get_many(['1.1.1.1', '2.2.2.2', '3.3.3.3'])), {'1.1.1.1', '3.3.3.3'})
+
+
+@override_settings(VISITOR_GEOLOCATION_WORKERS=0)
+class VisitorUpsertTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        location_cache.clear()
+
+    def test_cookie_visitor_is_inserted_once_then_cached(self):
+        Client().get('/')  # warm the homepage fragments so only tracking queries remain
+        visitor_uuid = str(uuid.uuid4())
+        self.client.cookies['visitor_id'] = visitor_uuid
+
+        with self.assertNumQueries(1):
+            self.client.get('/')
+        with self.assertNumQueries(0):
+            self.client.get('/')
+
+        self.assertEqual(Visitor.objects.filter(uuid=visitor_uuid).count(), 1)
+
+    def test_existing_visitor_is_not_duplicated(self):
+        visitor = Visitor.objects.create(uuid=uuid.uuid4(), ip_address='192.168.0.1', location='Test City, Test Country')
+        self.client.cookies['visitor_id'] = str(visitor.uuid)
+
+        self.client.get('/')
+
+        self.assertEqual(Visitor.objects.filter(uuid=visitor.uuid).count(), 1)
+        visitor.refresh_from_db()
+        self.assertEqual(visitor.location, 'Test City, Test Country')
+
+    def test_invalid_cookie_gets_a_new_visitor_id(self):
+        self.client.cookies['visitor_id'] = 'not-a-uuid'
+
+        response = self.client.get('/')
+
+        new_uuid = response.cookies['visitor_id'].value
+        self.assertNotEqual(new_uuid, 'not-a-uuid')
+        self.assertTrue(Visitor.objects.filter(uuid=new_uuid).exists())
+
+    def test_start_recreates_a_visitor_the_cache_still_knows(self):
+        visitor_uuid = str(uuid.uuid4())
+        self.client.cookies['visitor_id'] = visitor_uuid
+        self.client.get('/')
+        Visitor.objects.filter(uuid=visitor_uuid).delete()  # pruned while visitor:known is cached
+
+        self.client.get('/')
+        response = self.client.post(
+            reverse('track_start'), data=json.dumps({'session_id': 'after-prune'}), content_type='application/json',
+        )
+
+        self.assertEqual(response.status_code, 200)
+        visitor = Visitor.objects.get(uuid=visitor_uuid)
+        self.assertEqual(visitor.location, PENDING_LOCATION)
+        self.assertEqual(visitor.ip_address, '127.0.0.1')
+        self.assertEqual(VisitorSession.objects.get(session_id='after-prune').visitor, visitor)
+
+
+@override_settings(VISITOR_GEOLOCATION_WORKERS=0)
+class TrackingScopeTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_excluded_paths_are_not_tracked(self):
+        # Only the view's own session lookup, no tracking work
+        with self.assertNumQueries(1):
+            response = self.client.post(
+                reverse('track_end'),
+                data=json.dumps({'session_id': 'missing', 'sections': [], 'max_scroll': 0}),
+                content_type='application/json'
+            )
+        self.client.get('/admin/login/')
+
+        self.assertNotIn('visitor_id', response.cookies)
+        self.assertFalse(Visitor.objects.exists())
+
+    @override_settings(VISITOR_TRACKING_EXCLUDE_PATHS=[], VISITOR_TRACKING_HTML_ONLY=True)
+    def test_html_only_skips_non_html_responses(self):
+        response = self.client.post(
+            reverse('track_end'),
+            data=json.dumps({'session_id': 'missing', 'sections': [], 'max_scroll': 0}),
+            content_type='application/json'
+        )
+
+        self.assertNotIn('visitor_id', response.cookies)
+        self.assertFalse(Visitor.objects.exists())
+
+    @override_settings(VISITOR_TRACKING_EXCLUDE_PATHS=[], VISITOR_TRACKING_HTML_ONLY=True)
+    def test_html_only_skips_error_pages(self):
+        response = self.client.get('/no-such-page/')
+
+        self.assertEqual(response.status_code, 404)
+        self.assertNotIn('visitor_id', response.cookies)
+        self.assertFalse(Visitor.objects.exists())
+
+    @override_settings(VISITOR_TRACKING_INCLUDE_PATHS=['/landing/'])
+    def test_include_paths_limit_tracking(self):
+        response = self.client.get('/')
+
+        self.assertNotIn('visitor_id', response.cookies)
+        self.assertFalse(Visitor.objects.exists())
+
+
+class BatchedTrackEndTests(TestCase):
+    def setUp(self):
+        visitor = Visitor.objects.create(uuid=uuid.uuid4(), ip_address='192.168.0.1')
+        for session_id in ('session-a', 'session-b'):
+            VisitorSession.objects.create(visitor=visitor, session_id=session_id)
+
+    def test_batched_payload_uses_bulk_queries(self):
+        events = [
+            {
+                'session_id': session_id,
+                'end_time': timezone.now().isoformat(),
+                'duration_seconds': 30,
+                'sections': ['hero', 'service', 'testimonial'],
+                'max_scroll': 90
+            }
+            for session_id in ('session-a', 'session-b', 'unknown-session')
+        ]
+
+        # SELECT sessions, SAVEPOINT, UPDATE, INSERT, RELEASE
+        with self.assertNumQueries(5):
+            response = self.client.post(
+                reverse('track_end'),
+                data=json.dumps({'events': events}),
+                content_type='application/json'
+            )
+
+        self.assertJSONEqual(str(response.content, 'utf8'), {"status": "ended", "sessions": 2})
+        self.assertEqual(PageInteraction.objects.count(), 6)
+        self.assertEqual(VisitorSession.objects.filter(duration_seconds=30).count(), 2)
+
+    def test_session_ended_twice_in_a_batch_keeps_its_last_event(self):
+        events = [
+            {'session_id': 'session-a', 'duration_seconds': seconds, 'sections': sections, 'max_scroll': 50}
+            for seconds, sections in ((10, ['hero']), (25, ['hero', 'faq']))
+        ]
+        response = self.client.post(
+            reverse('track_end'), data=json.dumps({'events': events}), content_type='application/json'
+        )
+
+        self.assertJSONEqual(str(response.content, 'utf8'), {"status": "ended", "sessions": 1})
+        self.assertEqual(VisitorSession.objects.get(session_id='session-a').duration_seconds, 25)
+        self.assertEqual(sorted(PageInteraction.objects.values_list('section_id', flat=True)), ['faq', 'hero'])
+
+
+@override_settings(TRACKING_WRITE_BEHIND=True, TRACKING_BUFFER_SIZE=2, TRACKING_BUFFER_PUT_TIMEOUT=0)
+class WriteBehindTests(TestCase):
+    def setUp(self):
+        self.visitor = Visitor.objects.create(uuid=uuid.uuid4(), ip_address='192.168.0.1')
+        self.client.cookies['visitor_id'] = str(self.visitor.uuid)
+        # Flush by hand instead of from the background thread
+        self.buffer = EventBuffer()
+        patcher = patch.object(self.buffer, '_start_flusher', return_value=object())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch('core.views.event_buffer', self.buffer)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # Write leftovers into the test database, not at exit into the real one
+        self.addCleanup(self.buffer.flush)
+
+    def post(self, name, data):
+        return self.client.post(reverse(name), data=json.dumps(data), content_type='application/json')
+
+    def test_beacons_are_acknowledged_then_flushed(self):
+        start = self.post('track_start', {'session_id': 'buffered'})
+        end = self.post('track_end', {
+            'session_id': 'buffered',
+            'end_time': timezone.now().isoformat(),
+            'duration_seconds': 12,
+            'sections': ['hero'],
+            'max_scroll': 40
+        })
+
+        self.assertEqual(start.status_code, 202)
+        self.assertEqual(end.status_code, 202)
+        self.assertFalse(VisitorSession.objects.exists())
+
+        self.assertEqual(self.buffer.flush(), 2)
+        session = VisitorSession.objects.get(session_id='buffered')
+        self.assertEqual(session.duration_seconds, 12)
+        self.assertEqual(session.pageinteraction_set.count(), 1)
+
+    def test_bad_payloads_are_refused_before_they_are_queued(self):
+        self.assertEqual(self.post('track_start', {'referrer': 'https://example.com'}).status_code, 400)
+        self.assertEqual(self.post('track_end', {'session_id': 'x', 'duration_seconds': 'long'}).status_code, 400)
+        self.assertEqual(self.post('track_end', {'events': [{'session_id': 'x', 'sections': 'hero'}]}).status_code, 400)
+        self.assertEqual(self.post('track_end', ['not', 'an', 'object']).status_code, 400)
+
+        self.assertEqual(self.buffer.flush(), 0)
+
+    def test_batch_is_held_while_the_database_is_locked(self):
+        self.post('track_start', {'session_id': 'locked'})
+
+        with patch('core.buffer.write_events', side_effect=OperationalError('database is locked')), \
+                self.assertLogs('core.buffer', 'WARNING'):
+            self.assertEqual(self.buffer.flush(), 0)
+
+        self.assertEqual(self.buffer.flush(), 1)
+        self.assertTrue(VisitorSession.objects.filter(session_id='locked').exists())
+
+    @patch('core.buffer.time.sleep')
+    def test_shutdown_retries_a_locked_database(self, sleep):
+        self.post('track_start', {'session_id': 'late'})
+
+        with patch('core.buffer.write_events', side_effect=[OperationalError('database is locked'), []]), \
+                self.assertLogs('core.buffer', 'WARNING'):
+            self.buffer.close()
+
+        self.assertEqual(sleep.call_count, 1)
+        self.assertEqual(self.buffer._held, [])
+
+    def test_a_bad_event_does_not_cost_the_rest_of_the_batch(self):
+        self.post('track_start', {'session_id': 'good'})
+        self.buffer.offer(END, {'session_id': 'good'})  # queued without end_event, no duration_seconds
+
+        with self.assertLogs('core.ingest', 'ERROR'):
+            self.assertEqual(self.buffer.flush(), 1)
+        self.assertTrue(VisitorSession.objects.filter(session_id='good').exists())
+
+    def test_full_buffer_writes_synchronously(self):
+        self.post('track_start', {'session_id': 'one'})
+        self.post('track_start', {'session_id': 'two'})
+        response = self.post('track_start', {'session_id': 'three'})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(list(VisitorSession.objects.values_list('session_id', flat=True)), ['three'])
+
+        self.buffer.close()
+        self.assertEqual(VisitorSession.objects.count(), 3)
+
+
+class EventLogTests(TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.log_dir = tmp_dir.name
+        settings_override = override_settings(TRACKING_EVENT_LOG=True, EVENT_LOG_DIR=self.log_dir)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.writer = EventLogWriter()
+        patcher = patch.object(self.writer, '_start_flusher', return_value=object())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def write_sealed_segment(self, events):
+        for kind, event in events:
+            self.writer.append(kind, event)
+        self.writer.flush()
+        # Move the segment back in time so the compactor treats it as sealed
+        [name] = os.listdir(self.log_dir)
+        path = os.path.join(self.log_dir, 'segment-000000000000.log')
+        os.rename(os.path.join(self.log_dir, name), path)
+        return path
+
+    def test_compact_events_loads_segments_once(self):
+        visitor_uuid = str(uuid.uuid4())
+        now = timezone.now().isoformat()
+        self.write_sealed_segment([
+            (VISITOR, {'uuid': visitor_uuid, 'ip_address': '41.90.0.1', 'location': PENDING_LOCATION, 'received_at': now}),
+            (START, {'visitor_id': visitor_uuid, 'session_id': 'logged', 'referrer': '', 'user_agent': '', 'received_at': now}),
+            (END, {'session_id': 'logged', 'end_time': now, 'duration_seconds': 9, 'sections': ['hero', 'faq'], 'max_scroll': 60, 'received_at': now}),
+        ])
+
+        call_command('compact_events', stdout=io.StringIO())
+        call_command('compact_events', stdout=io.StringIO())
+
+        session = VisitorSession.objects.get(session_id='logged')
+        self.assertEqual(str(session.visitor.uuid), visitor_uuid)
+        self.assertEqual(session.duration_seconds, 9)
+        self.assertEqual(PageInteraction.objects.count(), 2)
+
+    def test_reader_stops_at_torn_record(self):
+        visitor_id = str(uuid.uuid4())
+        path = self.write_sealed_segment([
+            (START, {'visitor_id': visitor_id, 'session_id': 'a'}), (START, {'visitor_id': visitor_id, 'session_id': 'b'}),
+        ])
+        with open(path, 'ab') as f:
+            f.write(b'\x00\x00\x01\x00partial')
+
+        records = list(read_segment(path))
+
+        self.assertEqual([event['session_id'] for _, _, event in records], ['a', 'b'])
+        self.assertEqual(records[-1][0], os.path.getsize(path) - len(b'\x00\x00\x01\x00partial'))
+
+    def test_writer_refuses_events_compaction_could_not_write(self):
+        with self.assertRaises(ValueError):
+            self.writer.append(END, {'session_id': 'no-duration'})
+        with self.assertRaises(ValueError):
+            self.writer.append(START, {'visitor_id': 'not-a-uuid', 'session_id': 'x'})
+
+    def test_bad_records_are_quarantined_and_compaction_moves_on(self):
+        now = timezone.now().isoformat()
+        visitor_uuid = str(uuid.uuid4())
+        with patch('core.eventlog.check_event'):  # as written by an older release
+            self.write_sealed_segment([
+                (END, {'session_id': 'broken', 'received_at': now}),
+                (VISITOR, {'uuid': visitor_uuid, 'ip_address': '41.90.0.1', 'location': PENDING_LOCATION, 'received_at': now}),
+            ])
+
+        stderr = io.StringIO()
+        call_command('compact_events', stdout=io.StringIO(), stderr=stderr)
+        call_command('compact_events', stdout=io.StringIO(), stderr=io.StringIO())
+
+        self.assertIn('Skipped 1 bad event(s)', stderr.getvalue())
+        self.assertTrue(Visitor.objects.filter(uuid=visitor_uuid).exists())
+        [(_, kind, event)] = read_segment(os.path.join(self.log_dir, 'quarantine.log'))
+        self.assertEqual((kind, event['session_id']), (END, 'broken'))
+
+    @override_settings(VISITOR_GEOLOCATION_WORKERS=0)
+    def test_start_compacted_before_its_visitor_is_kept(self):
+        visitor_uuid = str(uuid.uuid4())
+        now = timezone.now().isoformat()
+        self.write_sealed_segment([
+            (START, {'visitor_id': visitor_uuid, 'ip_address': '41.90.0.1', 'session_id': 'early', 'received_at': now}),
+            (VISITOR, {'uuid': visitor_uuid, 'ip_address': '41.90.0.1', 'location': PENDING_LOCATION, 'received_at': now}),
+        ])
+
+        call_command('compact_events', '--batch-size=1', stdout=io.StringIO())
+
+        session = VisitorSession.objects.get(session_id='early')
+        self.assertEqual(str(session.visitor.uuid), visitor_uuid)
+        self.assertEqual(session.visitor.ip_address, '41.90.0.1')
+        self.assertEqual(Visitor.objects.count(), 1)
+
+    def test_track_start_refuses_a_malformed_cookie(self):
+        self.client.cookies['visitor_id'] = 'not-a-uuid'
+        with patch('core.views.event_log', self.writer):
+            response = self.client.post(
+                reverse('track_start'), data=json.dumps({'session_id': 'logged'}), content_type='application/json'
+            )
+        self.writer.flush()
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(os.listdir(self.log_dir), [])
+
+    async def test_async_track_start_refuses_a_malformed_cookie(self):
+        request = AsyncRequestFactory().post(
+            reverse('track_start'), data=json.dumps({'session_id': 'logged'}), content_type='application/json'
+        )
+        request.COOKIES['visitor_id'] = 'not-a-uuid'
+        with patch('core.views.event_log', self.writer):
+            response = await atrack_start(request)
+
+        self.assertEqual(response.status_code, 400)
+
+    @override_settings(VISITOR_GEOLOCATION_WORKERS=0)
+    def test_track_views_append_to_the_log(self):
+        with patch('core.views.event_log', self.writer), patch('core.middleware.event_log', self.writer):
+            response = self.client.get('/')
+            start = self.client.post(
+                reverse('track_start'),
+                data=json.dumps({'session_id': 'logged'}),
+                content_type='application/json'
+            )
+        self.writer.flush()
+
+        self.assertEqual(start.status_code, 202)
+        self.assertFalse(Visitor.objects.exists())
+        [name] = os.listdir(self.log_dir)
+        kinds = [kind for _, kind, _ in read_segment(os.path.join(self.log_dir, name))]
+        self.assertEqual(kinds, [VISITOR, START])
+        self.assertIn('visitor_id', response.cookies)
+
+
+@skipUnless(connection.vendor == 'sqlite', "Asserts on SQLite's EXPLAIN QUERY PLAN output")
+@override_settings(VISITOR_GEOLOCATION_WORKERS=0)
+class AsyncTrackingTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        location_cache.clear()
+        self.factory = AsyncRequestFactory()
+
+    def post(self, view, data, visitor=None):
+        request = self.factory.post('/track/', data=json.dumps(data), content_type='application/json')
+        if visitor:
+            request.COOKIES['visitor_id'] = str(visitor.uuid)
+        return view(request)
+
+    async def test_async_client_tracks_new_visitor(self):
+        response = await self.async_client.get('/')
+
+        visitor = await Visitor.objects.aget(uuid=response.cookies['visitor_id'].value)
+        self.assertEqual(visitor.location, PENDING_LOCATION)
+
+    async def test_middleware_is_async_under_asgi(self):
+        async def get_response(request):
+            return HttpResponse()
+        middleware = VisitorTrackingMiddleware(get_response)
+        request = self.factory.get('/')
+        request.COOKIES['visitor_id'] = visitor_uuid = str(uuid.uuid4())
+
+        await middleware(request)
+        # Known for the TTL: no second insert
+        await middleware(request)
+
+        self.assertEqual(await Visitor.objects.filter(uuid=visitor_uuid).acount(), 1)
+        self.assertTrue(await cache.aget(f'visitor:known:{visitor_uuid}'))
+
+    async def test_async_beacons_are_stored(self):
+        visitor = await Visitor.objects.acreate(uuid=uuid.uuid4(), ip_address='192.168.0.1')
+
+        start = await self.post(atrack_start, {'session_id': 'async'}, visitor)
+        end = await self.post(atrack_end, {
+            'session_id': 'async',
+            'end_time': timezone.now().isoformat(),
+            'duration_seconds': 9,
+            'sections': ['hero', 'about'],
+            'max_scroll': 60
+        })
+
+        self.assertJSONEqual(start.content, {"status": "started"})
+        self.assertJSONEqual(end.content, {"status": "ended"})
+        session = await VisitorSession.objects.aget(session_id='async')
+        self.assertEqual(session.duration_seconds, 9)
+        self.assertEqual(await PageInteraction.objects.filter(session=session).acount(), 2)
+
+    # A blocking put would sit out the whole timeout on the event loop
+    @override_settings(TRACKING_WRITE_BEHIND=True, TRACKING_BUFFER_SIZE=1, TRACKING_BUFFER_PUT_TIMEOUT=30)
+    async def test_async_beacon_never_waits_on_a_full_buffer(self):
+        visitor = await Visitor.objects.acreate(uuid=uuid.uuid4(), ip_address='192.168.0.1')
+        buffer = EventBuffer()
+        with patch.object(buffer, '_start_flusher', return_value=object()), patch('core.views.event_buffer', buffer):
+            accepted = await self.post(atrack_start, {'session_id': 'one'}, visitor)
+            started = time.monotonic()
+            written = await self.post(atrack_start, {'session_id': 'two'}, visitor)
+
+        self.assertLess(time.monotonic() - started, 5)
+        self.assertEqual(accepted.status_code, 202)
+        self.assertEqual(written.status_code, 200)
+        self.assertEqual([s async for s in VisitorSession.objects.values_list('session_id', flat=True)], ['two'])
+        # Flushed here, or the atexit hook would write it into the real database
+        self.assertEqual(await sync_to_async(buffer.flush)(), 1)
+
+    @patch('core.geolocation.httpx', None)
+    @patch('requests.post')
+    async def test_async_lookup_without_httpx_uses_a_thread(self, mock_post):
+        mock_post.return_value.json.return_value = [
+            {'status': 'success', 'city': 'Nairobi', 'country': 'Kenya', 'query': '41.90.0.1'},
+            {'status': 'fail', 'query': '10.0.0.1'},
+        ]
+
+        locations = await alookup_locations(['41.90.0.1', '10.0.0.1'])
+
+        self.assertEqual(locations, {'41.90.0.1': 'Nairobi, Kenya', '10.0.0.1': UNKNOWN_LOCATION})
+        self.assertEqual(mock_post.call_count, 1)
+        # Answered from the cache the second time
+        self.assertEqual(await alookup_locations(['41.90.0.1']), {'41.90.0.1': 'Nairobi, Kenya'})
+        self.assertEqual(mock_post.call_count, 1)
+
+
+@override_settings(INSTRUMENTATION_SAMPLE_RATE=1.0, VISITOR_GEOLOCATION_WORKERS=0, LANDING_SNAPSHOT_DIR=None)
+class InstrumentationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        location_cache.clear()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        settings_override = override_settings(METRICS_DIR=directory.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def request_samples(self):
+        return {key: value for key, value in registry.collect().items() if key[0].startswith('angali_request_')}
+
+    def timings(self, response):
+        entries = {}
+        for entry in response['Server-Timing'].split(', '):
+            name, *params = entry.split(';')
+            entries[name] = dict(param.split('=', 1) for param in params)
+        return entries
+
+    def test_sampled_request_reports_its_queries_and_phases(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/')
+
+        timings = self.timings(response)
+        self.assertEqual(timings['db']['desc'], f'"{len(queries)} queries"')
+        self.assertIn('geo', timings)  # the new visitor's local lookup
+        self.assertIn('template', timings)
+        self.assertGreaterEqual(float(timings['total']['dur']), float(timings['template']['dur']))
+
+        samples = self.request_samples()
+        self.assertEqual(samples['angali_request_seconds_count', (('phase', 'total'), ('view', 'home'))], 1)
+        self.assertEqual(samples['angali_request_seconds_count', (('phase', 'template'), ('view', 'home'))], 1)
+        self.assertEqual(samples['angali_request_queries_sum', (('view', 'home'),)], len(queries))
+
+    async def test_async_request_counts_queries_in_the_worker_thread(self):
+        response = await self.async_client.get('/')
+
+        self.assertNotEqual(self.timings(response)['db']['desc'], '"0 queries"')
+
+    @override_settings(INSTRUMENTATION_SAMPLE_RATE=0)
+    def test_disabled_instrumentation_leaves_responses_alone(self):
+        response = self.client.get('/')
+
+        self.assertNotIn('Server-Timing', response)
+        self.assertEqual(self.request_samples(), {})
+
+    def test_timed_outside_a_sampled_request_records_nothing(self):
+        with timed('geo'):
+            pass
+        self.assertEqual(self.request_samples(), {})
+
+
+@override_settings(VISITOR_GEOLOCATION_WORKERS=0, LANDING_SNAPSHOT_DIR=None)
+class MetricsTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        location_cache.clear()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        settings_override = override_settings(METRICS_DIR=self.directory)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def scrape(self):
+        with self.assertNumQueries(0):
+            response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        return response.content.decode()
+
+    def test_tracking_paths_are_counted(self):
+        visitor = Visitor.objects.create(uuid=uuid.uuid4(), ip_address='192.168.0.1')
+        self.client.get('/')
+        self.client.cookies['visitor_id'] = str(visitor.uuid)
+        self.client.post(reverse('track_start'), data=json.dumps({'session_id': 'm'}), content_type='application/json')
+        self.client.post(reverse('track_end'), data=json.dumps({
+            'session_id': 'm', 'end_time': timezone.now().isoformat(), 'duration_seconds': 5,
+            'sections': ['hero', 'about'], 'max_scroll': 30,
+        }), content_type='application/json')
+
+        text = self.scrape()
+        self.assertIn('angali_visitors_created_total{write="database"} 1.0', text)
+        self.assertIn('angali_sessions_started_total{write="database"} 1.0', text)
+        self.assertIn('angali_sessions_ended_total{write="database"} 1.0', text)
+        self.assertIn('angali_interactions_inserted_total 2.0', text)
+        self.assertIn('angali_cache_lookups_total{cache="homepage_snapshot",result="miss"} 1.0', text)
+        self.assertIn('angali_render_seconds_count{view="home"} 1.0', text)
+        self.assertIn('angali_render_seconds_bucket{view="home",le="+Inf"} 1.0', text)
+
+    def test_scrape_sums_every_process_file(self):
+        registry.inc(sample_key('angali_interactions_inserted_total', {}), 3)
+        # Another worker's file
+        other = MmapValues(os.path.join(self.directory, 'metrics-999999.db'))
+        other.inc(sample_key('angali_interactions_inserted_total', {}), 4)
+        other.close()
+
+        self.assertIn('angali_interactions_inserted_total 7.0', self.scrape())
+
+    def test_returning_visitors_are_not_counted_as_created(self):
+        visitor = Visitor.objects.create(uuid=uuid.uuid4(), ip_address='192.168.0.1')
+        self.client.cookies['visitor_id'] = str(visitor.uuid)
+        self.client.get('/')  # known-visitor cache miss, but the row is there
+
+        self.assertNotIn('angali_visitors_created_total{', self.scrape())
+
+    def test_files_of_exited_processes_are_folded_into_the_archive(self):
+        dead = MmapValues(os.path.join(self.directory, 'metrics-999999.db'))
+        dead.inc(sample_key('angali_interactions_inserted_total', {}), 4)
+        dead.close()
+        alive = MmapValues(os.path.join(self.directory, f'metrics-{os.getppid()}.db'))
+        alive.close()
+
+        self.assertEqual(fold_dead_files(self.directory), 1)
+        self.assertEqual(
+            sorted(name for name in os.listdir(self.directory) if name.endswith('.db')),
+            sorted(['metrics-archive.db', f'metrics-{os.getppid()}.db']),
+        )
+        self.assertIn('angali_interactions_inserted_total 4.0', self.scrape())
+
+    def test_histogram_buckets_are_cumulative(self):
+        test_registry = MetricsRegistry()
+        with patch('core.metrics.registry', test_registry):
+            histogram = Histogram('test_seconds', 'Test.', buckets=(0.1, 1))
+            Counter('test_total', 'Test.', ['kind']).inc(kind='a "quoted" kind')
+            for value in (0.05, 0.5, 5):
+                histogram.observe(value)
+
+        lines = test_registry.render().splitlines()
+        self.assertIn('test_seconds_bucket{le="0.1"} 1.0', lines)
+        self.assertIn('test_seconds_bucket{le="1.0"} 2.0', lines)
+        self.assertIn('test_seconds_bucket{le="+Inf"} 3.0', lines)
+        self.assertIn('test_seconds_sum 5.55', lines)
+        self.assertIn('test_total{kind="a \\"quoted\\" kind"} 1.0', lines)
+
+    def test_file_grows_and_reopens_with_its_values(self):
+        path = os.path.join(self.directory, 'metrics-1.db')
+        values = MmapValues(path)
+        for n in range(5000):
+            values.inc(sample_key('test_total', {'n': n}), n)
+        values.close()
+
+        reopened = MmapValues(path)
+        reopened.inc(sample_key('test_total', {'n': 4999}), 1)
+        reopened.close()
+        samples = read_file(path)
+        self.assertEqual(len(samples), 5000)
+        self.assertEqual(samples[sample_key('test_total', {'n': 4999})], 5000.0)
+
+    @override_settings(METRICS_ALLOWED_IPS=['10.0.0.1'])
+    def test_scrape_can_be_limited_to_some_addresses(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 404)
+        self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='10.0.0.1').status_code, 200)
+
+    def test_scrape_is_limited_to_loopback_by_default(self):
+        self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='10.0.0.1').status_code, 404)
+        self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='::1').status_code, 200)
+
+    def test_proxied_requests_are_not_treated_as_local(self):
+        self.assertEqual(self.client.get('/metrics', HTTP_X_FORWARDED_FOR='203.0.113.9').status_code, 404)
+
+    @override_settings(METRICS_TOKEN='s3cret')
+    def test_scrape_requires_the_token_when_one_is_set(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 404)
+        self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer wrong').status_code, 404)
+        response = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer s3cret', HTTP_X_FORWARDED_FOR='203.0.113.9')
+        self.assertEqual(response.status_code, 200)
+
+
+class TrackingIndexTests(TestCase):
+    """The hot lookups must be index searches, not table scans."""
+
+    def assertUsesIndex(self, queryset, index_name):
+        plan = queryset.explain()
+        self.assertIn(f'USING INDEX {index_name}', plan)
+        self.assertNotIn('SCAN', plan)
+
+    def test_session_lookup_by_session_id(self):
+        # The unique constraint's index
+        self.assertUsesIndex(
+            VisitorSession.objects.filter(session_id='abc'),
+            'sqlite_autoindex_core_visitorsession'
+        )
+
+    def test_date_hierarchy_ranges(self):
+        since = timezone.now() - timezone.timedelta(days=1)
+        self.assertUsesIndex(Visitor.objects.filter(visit_date__gte=since), 'core_visitor_visit_date')
+        self.assertUsesIndex(VisitorSession.objects.filter(start_time__gte=since), 'core_visitorsession_start_time')
+        self.assertUsesIndex(PageInteraction.objects.filter(timestamp__gte=since), 'core_pageinteraction_timestamp')
+
+    def test_admin_filter_combinations(self):
+        since = timezone.now() - timezone.timedelta(days=1)
+        self.assertUsesIndex(
+            Visitor.objects.filter(location='Nairobi, Kenya', visit_date__gte=since),
+            'visitor_location_date_idx'
+        )
+        self.assertUsesIndex(
+            PageInteraction.objects.filter(section_id='hero', timestamp__gte=since),
+            'interaction_section_time_idx'
+        )
+
+    def test_interactions_are_fast_deleted(self):
+        # No delete signal receivers listen to the tracking tables
+        self.assertTrue(Collector(using='default').can_fast_delete(PageInteraction))
+
+    def test_session_id_is_unique(self):
+        visitor = Visitor.objects.create(uuid=uuid.uuid4())
+        VisitorSession.objects.create(visitor=visitor, session_id='dup')
+        with self.assertRaises(IntegrityError):
+            with transaction.atomic():
+                VisitorSession.objects.create(visitor=visitor, session_id='dup')
+
+
+# Tracking is switched off so only the page's own queries are counted
+@override_settings(VISITOR_TRACKING_INCLUDE_PATHS=[], VISITOR_GEOLOCATION_WORKERS=0, LANDING_SNAPSHOT_DIR=None)
+class LandingPageTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_sections_render_from_cms_models(self):
+        HeroSection.objects.create(headline='Explore Kenya', cta_text='Start now', cta_link='https://example.com/start')
+        Testimonial.objects.create(source_name='Amina', content='Loved it')
+        FAQItem.objects.create(question='Is it free?', answer='Yes.')
+        footer = Footer.objects.create(platform_name='Angali', rights_reserved_text='All rights reserved Angali')
+        section = FooterSection.objects.create(footer=footer, title='company')
+        FooterLink.objects.create(section=section, label='Careers', url='https://example.com/careers')
+
+        response = self.client.get('/')
+
+        for text in ('Explore Kenya', 'Start now', 'Loved it', 'Is it free?', 'Careers', 'All rights reserved Angali'):
+            self.assertContains(response, text)
+
+    @override_settings(STATIC_URL='https://cdn.example.com/static/')
+    def test_hero_background_goes_through_staticfiles(self):
+        response = self.client.get('/')
+
+        self.assertContains(response, "background-image:url('%s')" % static('assets/img/hero/hero-bg.svg'))
+
+    def test_warm_page_runs_no_queries(self):
+        footer = Footer.objects.create(platform_name='Angali')
+        for title in ('company', 'contact'):
+            section = FooterSection.objects.create(footer=footer, title=title)
+            FooterLink.objects.create(section=section, label=title, url='https://example.com')
+
+        # The content version, then one query per section; the footer is three
+        # however many sections and links it has
+        with self.assertNumQueries(10):
+            self.client.get('/')
+        with self.assertNumQueries(0):
+            self.client.get('/')
+
+    def test_saving_a_model_only_invalidates_its_fragment(self):
+        self.client.get('/')
+        FAQItem.objects.create(question='How do I book?', answer='Online.')
+
+        # Only the content version and the FAQ fragment are rebuilt
+        with self.assertNumQueries(2):
+            response = self.client.get('/')
+        self.assertContains(response, 'How do I book?')
+
+    def test_change_from_another_worker_shows_once_the_version_expires(self):
+        item = FAQItem.objects.create(question='How do I book?', answer='Online.')
+        self.client.get('/')
+        # Saved elsewhere: this process's fragments were not dropped
+        FAQItem.objects.filter(pk=item.pk).update(question='How do I pay?', updated_at=timezone.now())
+        invalidate_content_version()  # as LANDING_VERSION_TTL running out does
+
+        with self.assertNumQueries(2):
+            response = self.client.get('/')
+        self.assertContains(response, 'How do I pay?')
+
+
+@override_settings(VISITOR_GEOLOCATION_WORKERS=0, LANDING_SNAPSHOT_DIR=None)
+class ConditionalGetTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        FAQItem.objects.create(question='Is it free?', answer='Yes.')
+
+    def test_matching_etag_is_answered_with_304_without_queries(self):
+        response = self.client.get('/')
+        self.assertTrue(response['ETag'].startswith('W/'))
+        self.assertIn('Last-Modified', response)
+
+        with self.assertNumQueries(0):
+            response = self.client.get('/', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+
+    def test_if_modified_since(self):
+        last_modified = self.client.get('/')['Last-Modified']
+        response = self.client.get('/', HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 304)
+
+    def test_changes_and_deletions_give_a_new_etag(self):
+        etag = self.client.get('/')['ETag']
+        item = FAQItem.objects.create(question='How do I book?', answer='Online.')
+        changed = self.client.get('/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(changed.status_code, 200)
+
+        # Deleting leaves no timestamp behind, but the row count moves back
+        item.delete()
+        response = self.client.get('/', HTTP_IF_NONE_MATCH=changed['ETag'])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['ETag'], etag)
+
+    def test_304_counts_as_a_page_view(self):
+        etag = self.client.get('/')['ETag']
+        self.client.cookies.clear()
+
+        response = self.client.get('/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertIn('visitor_id', response.cookies)
+        self.assertEqual(Visitor.objects.count(), 2)
+
+
+@override_settings(VISITOR_TRACKING_INCLUDE_PATHS=[], VISITOR_GEOLOCATION_WORKERS=0)
+class HomepageSnapshotTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.settings_override = override_settings(LANDING_SNAPSHOT_DIR=self.tmp.name)
+        self.settings_override.enable()
+        self.addCleanup(self.settings_override.disable)
+
+    def test_renders_live_until_published(self):
+        response = self.client.get('/')
+        self.assertNotIsInstance(response, FileResponse)
+        self.assertEqual(response.status_code, 200)
+
+    def test_serves_published_snapshot_without_queries(self):
+        HeroSection.objects.create(headline='Explore Kenya', cta_text='Start now', cta_link='https://example.com')
+        publish()
+        self.client.get('/')  # caches the content version
+
+        with self.assertNumQueries(0):
+            response = self.client.get('/')
+        self.assertIsInstance(response, FileResponse)
+        self.assertEqual(response['Content-Type'], 'text/html; charset=utf-8')
+        self.assertNotIn('Content-Disposition', response)
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertIn(b'Explore Kenya', b''.join(response.streaming_content))
+
+    def test_serves_gzip_when_accepted(self):
+        publish()
+        plain = b''.join(self.client.get('/').streaming_content)
+
+        response = self.client.get('/', HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response['Vary'])
+        self.assertEqual(gzip.decompress(b''.join(response.streaming_content)), plain)
+
+        response = self.client.get('/', HTTP_ACCEPT_ENCODING='gzip;q=0')
+        self.assertFalse(response.has_header('Content-Encoding'))
+
+    def test_saving_a_landing_model_republishes_on_commit(self):
+        publish()
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            FAQItem.objects.create(question='How do I book?', answer='Online.')
+            FAQItem.objects.create(question='Is it free?', answer='Yes.')
+        self.assertEqual(len(callbacks), 1)
+
+        response = self.client.get('/')
+        self.assertIn(b'How do I book?', b''.join(response.streaming_content))
+
+    def test_snapshot_from_before_a_deploy_is_rebuilt(self):
+        publish()
+        FAQItem.objects.bulk_create([FAQItem(question='Deployed since?', answer='Yes.')])  # no signal
+
+        with patch('core.snapshot.template_fingerprint', return_value=('deployed', timezone.now())):
+            response = self.client.get('/')
+
+        self.assertIn(b'Deployed since?', b''.join(response.streaming_content))
+        self.assertEqual(published_fingerprint(snapshot_path()), 'deployed')
+
+    def test_accepted_encodings(self):
+        self.assertEqual(accepted_encodings('br;q=1.0, gzip;q=0, identity'), {'br', 'identity'})
+        self.assertEqual(accepted_encodings(''), set())
+
+
+class StaticPipelineTests(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.settings_override = override_settings(
+            STATIC_ROOT=self.tmp.name,
+            STATIC_SOURCE_MAPS=False,
+            RESPONSIVE_IMAGE_STATIC_PREFIXES=[],
+            STORAGES={
+                'default': {'BACKEND': 'django.core.files.storage.FileSystemStorage'},
+                'staticfiles': {'BACKEND': 'core.storage.CompressedManifestStaticFilesStorage'},
+            },
+        )
+        self.settings_override.enable()
+        self.addCleanup(self.settings_override.disable)
+        call_command('collectstatic', interactive=False, verbosity=0)
+        self.hashed_css = staticfiles_storage.stored_name('assets/css/theme.css')
+
+    def test_collects_hashed_and_precompressed_files_without_source_maps(self):
+        self.assertRegex(self.hashed_css, r'^assets/css/theme\.[0-9a-f]{12}\.css$')
+        path = os.path.join(self.tmp.name, self.hashed_css)
+        with open(path, 'rb') as f, gzip.open(path + '.gz') as compressed:
+            self.assertEqual(compressed.read(), f.read())
+        collected = [name for _, _, names in os.walk(self.tmp.name) for name in names]
+        self.assertFalse([name for name in collected if '.map' in name])
+
+    def test_serves_hashed_files_precompressed_with_far_future_headers(self):
+        request = RequestFactory().get('/static/' + self.hashed_css, HTTP_ACCEPT_ENCODING='gzip')
+        response = static_asset(request, self.hashed_css)
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(response['Content-Type'], 'text/css')
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertIn('max-age=31536000', response['Cache-Control'])
+
+        response = static_asset(RequestFactory().get('/static/assets/css/theme.css'), 'assets/css/theme.css')
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertNotIn('immutable', response['Cache-Control'])
+
+    def test_rejects_paths_outside_static_root(self):
+        with self.assertRaises(Exception):
+            static_asset(RequestFactory().get('/static/x'), '../settings.py')
+
+
+class CriticalCSSTests(TestCase):
+    def test_committed_critical_css_is_in_sync_with_the_templates(self):
+        with open(output_path(), encoding='utf-8') as f:
+            committed = f.read()
+        self.assertEqual(
+            committed, build_critical_css(),
+            "files/critical.css is stale; run manage.py extract_critical_css",
+        )
+
+    def test_selector_matching(self):
+        used = used_selectors(['<nav class="navbar {{ extra }}" id="top"><a class="nav-link" href="#">x</a></nav>'])
+        self.assertTrue(selector_used('.navbar .nav-link:hover', used))
+        self.assertTrue(selector_used('#top > a', used))
+        self.assertTrue(selector_used(':root', used))
+        self.assertFalse(selector_used('.modal .nav-link', used))
+        self.assertFalse(selector_used('table.navbar', used))
+
+    def test_hidden_components_and_interaction_states_are_left_out(self):
+        used = used_selectors(['<div class="modal fade"><div class="modal-dialog"><div class="modal-content"></div></div></div><p class="lead">x</p>'])
+        self.assertEqual(used.classes, {'modal', 'fade', 'lead'})
+
+        rules = extract_rules('.lead{color:red}.lead:hover{color:blue}.modal{display:none}.modal-dialog{margin:0}', used)
+        self.assertEqual(rules, [('.lead', 'color:red'), ('.modal', 'display:none')])
+
+    def test_after_paint_declarations_and_unread_custom_properties_are_left_out(self):
+        used = used_selectors(['<p class="lead">x</p>'])
+        css = (
+            ':root{--bs-blue:#00f;--bs-unused:red;--bs-link:var(--bs-blue)}'
+            '.lead{color:var(--bs-link);transition:color .2s;-webkit-transition:color .2s;cursor:pointer}'
+            '@media (prefers-reduced-motion:reduce){.lead{transition:none}}'
+        )
+
+        rules = drop_unused_custom_properties(extract_rules(css, used))
+
+        self.assertEqual(rules, [(':root', '--bs-blue:#00f;--bs-link:var(--bs-blue)'), ('.lead', 'color:var(--bs-link)')])
+
+    def test_committed_critical_css_is_within_its_budget(self):
+        self.assertLessEqual(os.path.getsize(output_path()), size_budget())
+
+    @override_settings(CRITICAL_CSS_BUDGET=1024)
+    def test_extraction_fails_over_budget(self):
+        with self.assertRaisesMessage(CommandError, 'over the 1024 byte budget'):
+            call_command('extract_critical_css', '--check', stdout=io.StringIO())
+
+    @override_settings(VISITOR_TRACKING_INCLUDE_PATHS=[], LANDING_SNAPSHOT_DIR=None)
+    def test_page_inlines_critical_css_and_loads_the_theme_asynchronously(self):
+        response = self.client.get('/')
+        self.assertRegex(response.content.decode(), r'<style>[^<]*\.navbar\{')
+        self.assertContains(response, 'rel="preload"')
+        self.assertNotContains(response, '{% static')
+
+
+class ResponsiveImageTests(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.settings_override = override_settings(
+            MEDIA_ROOT=os.path.join(self.tmp.name, 'media'),
+            RESPONSIVE_IMAGE_ROOT=os.path.join(self.tmp.name, 'responsive'),
+            RESPONSIVE_IMAGE_URL='/media/responsive/',
+            RESPONSIVE_IMAGE_WIDTHS=[320, 640, 1280],
+            RESPONSIVE_IMAGE_FORMATS=['webp'],
+        )
+        self.settings_override.enable()
+        self.addCleanup(self.settings_override.disable)
+        self.source = os.path.join(self.tmp.name, 'photo.png')
+        Image.new('RGB', (800, 400), 'orange').save(self.source)
+
+    def test_generates_breakpoints_up_to_the_source_width(self):
+        self.assertEqual(generate_many([self.source], workers=1), 3)
+        found = derivatives(SimpleNamespace(path=self.source))
+        self.assertEqual([width for width, _ in found['webp']], [320, 640, 800])
+        _, url = found['webp'][1]
+        with Image.open(os.path.join(self.tmp.name, 'responsive', url.split('/media/responsive/')[1])) as image:
+            self.assertEqual((image.format, image.size), ('WEBP', (640, 320)))
+
+        # Keyed by content: running again writes nothing
+        self.assertEqual(generate_many([self.source], workers=1), 0)
+
+    def test_template_tag_emits_srcset_once_derivatives_exist(self):
+        template = Template("{% load responsive_images %}{% responsive_sources image sizes='50vw' %}")
+        image = SimpleNamespace(path=self.source)
+        self.assertEqual(template.render(Context({'image': image})), '')
+
+        generate_many([self.source], workers=1)
+        html = template.render(Context({'image': image}))
+        self.assertIn('<source type="image/webp" srcset="/media/responsive/', html)
+        self.assertIn('/320.webp 320w, ', html)
+        self.assertIn('sizes="50vw"', html)
+
+    def test_uploads_are_resized_after_commit(self):
+        with open(self.source, 'rb') as f:
+            upload = SimpleUploadedFile('hero.png', f.read(), content_type='image/png')
+        with patch('core.signals.generate_after_commit') as generate:
+            hero = HeroSection.objects.create(headline='Hero', background_image=upload)
+        paths, = generate.call_args.args
+        self.assertEqual(paths, [hero.background_image.path])
+
+
+# Tracking is switched off so only the admin's own queries are counted
+@override_settings(VISITOR_TRACKING_INCLUDE_PATHS=[], VISITOR_GEOLOCATION_WORKERS=0)
+class TrackingAdminTests(TestCase):
+    def setUp(self):
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'password'))
+
+    def add_visitor(self, sessions, interactions=0):
+        visitor = Visitor.objects.create(uuid=uuid.uuid4())
+        for _ in range(sessions):
+            session = VisitorSession.objects.create(
+                visitor=visitor, session_id=str(uuid.uuid4()), referrer='', user_agent='test'
+            )
+            PageInteraction.objects.bulk_create(
+                PageInteraction(session=session, section_id='hero') for _ in range(interactions)
+            )
+        return visitor
+
+    def changelist_queries(self, name):
+        cache.clear()  # the date drilldown's day counts
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse(f'admin:core_{name}_changelist'))
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_changelist_queries_do_not_grow_with_rows(self):
+        self.add_visitor(sessions=1, interactions=1)
+        visitor_queries = self.changelist_queries('visitor')
+        session_queries = self.changelist_queries('visitorsession')
+        for _ in range(5):
+            self.add_visitor(sessions=3, interactions=2)
+        self.assertEqual(self.changelist_queries('visitor'), visitor_queries)
+        self.assertEqual(self.changelist_queries('visitorsession'), session_queries)
+
+    def test_keyset_pages_skip_the_offset_query_and_count_without_grouping(self):
+        for _ in range(30):
+            self.add_visitor(sessions=1)
+        cache.clear()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('admin:core_visitor_changelist'))
+
+        self.assertTrue(response.context['cl'].keyset)
+        self.assertEqual(response.context['cl'].result_count, 30)
+        self.assertFalse(any('OFFSET' in q['sql'] for q in queries))
+        counts = [q['sql'] for q in queries if 'COUNT(*)' in q['sql']]
+        self.assertEqual(len(counts), 1)
+        self.assertNotIn('GROUP BY', counts[0])
+
+    def test_visitor_changelist_has_no_date_drilldown(self):
+        self.add_visitor(sessions=1)
+        with patch('core.templatetags.tracking_admin.day_counts') as counts:
+            response = self.client.get(reverse('admin:core_visitor_changelist'))
+
+        self.assertIsNone(response.context['cl'].date_hierarchy)
+        self.assertNotContains(response, 'visit_date__year=')
+        counts.assert_not_called()
+
+    def test_count_columns_are_annotated_and_sortable(self):
+        self.add_visitor(sessions=1)
+        busy = self.add_visitor(sessions=3)
+        # session_count is the fifth column
+        response = self.client.get(reverse('admin:core_visitor_changelist') + '?o=-5')
+        visitors = list(response.context['cl'].result_list)
+        self.assertEqual(visitors[0], busy)
+        self.assertEqual([v.visitorsession__count for v in visitors], [3, 1])
+        self.assertContains(response, '<b style="color: green;">3</b>', html=True)
+
+        self.add_visitor(sessions=1, interactions=4)
+        # interaction_count is the seventh column
+        response = self.client.get(reverse('admin:core_visitorsession_changelist') + '?o=-7')
+        self.assertEqual(response.context['cl'].result_list[0].pageinteraction__count, 4)
+
+
+# Tracking is switched off so only the admin's own queries are counted
+@override_settings(VISITOR_TRACKING_INCLUDE_PATHS=[], VISITOR_GEOLOCATION_WORKERS=0)
+class TrackingChangelistTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'password'))
+        visitor = Visitor.objects.create(uuid=uuid.uuid4())
+        self.session = VisitorSession.objects.create(visitor=visitor, session_id='s', referrer='', user_agent='test')
+        self.start = timezone.now() - timezone.timedelta(hours=1)
+
+    def add_interactions(self, count, section='hero'):
+        return PageInteraction.objects.bulk_create(
+            PageInteraction(session=self.session, section_id=section, timestamp=self.start + timezone.timedelta(minutes=i % 20))
+            for i in range(count)
+        )
+
+    def changelist(self, query=''):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('admin:core_pageinteraction_changelist') + query)
+        self.assertEqual(response.status_code, 200)
+        return response, [q['sql'] for q in queries]
+
+    def test_pages_by_cursor_not_offset(self):
+        # Repeated timestamps: the primary key breaks the ties
+        self.add_interactions(60)
+        expected = list(PageInteraction.objects.order_by('-timestamp', '-pk'))
+        seen = []
+        response, queries = self.changelist()
+        while True:
+            self.assertFalse(any('OFFSET' in sql for sql in queries))
+            seen.extend(response.context['cl'].result_list)
+            if not response.context['cl'].older_url:
+                break
+            response, queries = self.changelist(response.context['cl'].older_url)
+        self.assertEqual(seen, expected)
+
+        # Back up: the page before the last is the second, and short pages snap to the newest
+        response, _ = self.changelist(response.context['cl'].newer_url)
+        self.assertEqual(list(response.context['cl'].result_list), expected[25:50])
+        response, _ = self.changelist(response.context['cl'].newer_url)
+        self.assertEqual(list(response.context['cl'].result_list), expected[:25])
+        self.assertIsNone(response.context['cl'].newer_url)
+
+    def test_sorting_by_another_column_uses_numbered_pages(self):
+        self.add_interactions(30)
+        response, _ = self.changelist('?o=4&p=2')
+        self.assertFalse(response.context['cl'].keyset)
+        self.assertEqual(len(response.context['cl'].result_list), 5)
+
+    def test_invalid_cursor_is_rejected(self):
+        self.add_interactions(30)
+        response = self.client.get(reverse('admin:core_pageinteraction_changelist') + '?after=nonsense')
+        self.assertRedirects(response, reverse('admin:core_pageinteraction_changelist') + '?e=1')
+
+    @override_settings(ADMIN_ESTIMATED_COUNT_THRESHOLD=40)
+    def test_large_unfiltered_lists_show_the_table_estimate(self):
+        self.add_interactions(50)
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+        self.add_interactions(10, section='footer')
+
+        response, queries = self.changelist()
+        self.assertEqual(response.context['cl'].result_count, 50)
+        self.assertContains(response, '~50 page interactions')
+        self.assertFalse(any('COUNT(*)' in sql for sql in queries))
+
+        # Filtered lists, and tables below the threshold, are counted exactly
+        response, _ = self.changelist('?section_id=footer')
+        self.assertEqual(response.context['cl'].result_count, 10)
+        with self.settings(ADMIN_ESTIMATED_COUNT_THRESHOLD=100):
+            response, _ = self.changelist()
+        self.assertEqual(response.context['cl'].result_count, 60)
+
+    def test_rollup_command_analyzes_the_tracking_tables(self):
+        self.add_interactions(3)
+        call_command('rollup', stdout=io.StringIO())
+
+        self.assertIsNotNone(table_estimate(PageInteraction, 'default'))
+        self.assertIsNotNone(table_estimate(Visitor, 'default'))
+
+    def test_date_drilldown_reads_cached_day_counts(self):
+        now = timezone.now()
+        self.add_interactions(2)
+        PageInteraction.objects.create(session=self.session, timestamp=now - timezone.timedelta(days=800))
+        response, queries = self.changelist()
+        years = {str((now - timezone.timedelta(days=800)).year), str(timezone.localtime(self.start).year)}
+        self.assertContains(response, 'timestamp__year=')
+        for year in years:
+            self.assertContains(response, f'timestamp__year={year}')
+
+        # Cached: new rows show up after ADMIN_DATE_HIERARCHY_TTL and no GROUP BY runs again
+        PageInteraction.objects.create(session=self.session, timestamp=now - timezone.timedelta(days=2000))
+        response, queries = self.changelist()
+        self.assertFalse(any('GROUP BY' in sql for sql in queries))
+        self.assertNotContains(response, f'timestamp__year={(now - timezone.timedelta(days=2000)).year}')
+
+        year = timezone.localtime(self.start)
+        response, _ = self.changelist(f'?timestamp__year={year.year}&timestamp__month={year.month}')
+        self.assertContains(response, f'timestamp__day={year.day}')
+
+    def test_day_counts_come_from_the_rollups(self):
+        old = PageInteraction.objects.create(session=self.session, timestamp=timezone.now() - timezone.timedelta(days=800))
+        refresh()
+        self.add_interactions(2)
+
+        with CaptureQueriesContext(connection) as queries:
+            days = day_counts(PageInteraction, 'timestamp')
+
+        self.assertEqual(days, {timezone.localdate(old.timestamp): 1, timezone.localdate(self.start): 2})
+        # Only the rows the rollup has not seen yet are grouped by day
+        [scan] = [q['sql'] for q in queries if 'GROUP BY' in q['sql'] and 'core_pageinteraction' in q['sql']]
+        self.assertIn(f'"core_pageinteraction"."id" > {old.pk}', scan)
+
+
+@override_settings(VISITOR_GEOLOCATION_WORKERS=0, ROLLUP_SETTLE_DAYS=1)
+class RollupTests(TestCase):
+    def setUp(self):
+        self.day = datetime.date(2025, 3, 1)
+        self.nairobi = Visitor.objects.create(uuid=uuid.uuid4(), location='Nairobi, Kenya')
+        self.mombasa = Visitor.objects.create(uuid=uuid.uuid4(), location='Mombasa, Kenya')
+
+    def at(self, day, hour):
+        return timezone.make_aware(datetime.datetime.combine(day, datetime.time(hour)))
+
+    def add_session(self, visitor, day, referrer=None, duration=0, depths=()):
+        session = VisitorSession.objects.create(
+            visitor=visitor, session_id=str(uuid.uuid4()), referrer=referrer,
+            start_time=self.at(day, 23), duration_seconds=duration,
+        )
+        for depth in depths:
+            PageInteraction.objects.create(session=session, section_id='hero', timestamp=self.at(day, 23), scroll_depth=depth)
+        return session
+
+    def test_rollup_groups_by_day_location_and_referrer_host(self):
+        self.add_session(self.nairobi, self.day, 'https://www.google.com/search?q=safari', 100, depths=[5, 50])
+        self.add_session(self.nairobi, self.day, 'https://www.google.com/', 50, depths=[100])
+        self.add_session(self.mombasa, self.day, None, 30, depths=[55])
+        self.add_session(self.mombasa, self.day + datetime.timedelta(days=1), None, 10)
+        call_command('rollup', stdout=io.StringIO())
+
+        google = DailySessionRollup.objects.get(day=self.day, location='Nairobi, Kenya')
+        self.assertEqual(
+            (google.referrer_host, google.sessions, google.visitors, google.total_duration, google.average_duration),
+            ('www.google.com', 2, 1, 150, 75),
+        )
+        self.assertEqual(google.duration_histogram, [0, 0, 1, 1, 0, 0])
+        direct = DailySessionRollup.objects.filter(location='Mombasa, Kenya', referrer_host='')
+        self.assertEqual([(r.day, r.sessions) for r in direct.order_by('day')], [(self.day, 1), (self.day + datetime.timedelta(days=1), 1)])
+
+        hero = DailySectionRollup.objects.get(day=self.day, section_id='hero')
+        self.assertEqual((hero.interactions, hero.sessions, hero.average_scroll_depth), (4, 3, 52.5))
+        self.assertEqual(hero.scroll_histogram, [1, 0, 0, 0, 0, 2, 0, 0, 0, 0, 1])
+
+    def test_rerun_only_recomputes_days_with_new_rows(self):
+        self.add_session(self.nairobi, self.day, depths=[10])
+        call_command('rollup', stdout=io.StringIO())
+        settle_days = {'sessions': 2, 'interactions': 2}
+        self.assertEqual(refresh(), settle_days)
+
+        # A late row for an old day, e.g. compacted from the event log, makes that day dirty again
+        self.add_session(self.mombasa, self.day, depths=[20])
+        self.assertEqual(refresh(), {'sessions': 3, 'interactions': 3})
+        self.assertEqual(DailySessionRollup.objects.filter(day=self.day).aggregate(total=Sum('sessions'))['total'], 2)
+        self.assertEqual(DailySectionRollup.objects.get(day=self.day).interactions, 2)
+        self.assertEqual(
+            RollupWatermark.objects.get(name='sessions').last_id, VisitorSession.objects.latest('pk').pk,
+        )
+
+    def test_rollups_outlive_pruned_raw_rows(self):
+        self.add_session(self.nairobi, self.day, depths=[10])
+        call_command('rollup', stdout=io.StringIO())
+        VisitorSession.objects.all().delete()
+        call_command('rollup', '--full', stdout=io.StringIO())
+        self.assertEqual(DailySessionRollup.objects.get(day=self.day).sessions, 1)
+        self.assertEqual(DailySectionRollup.objects.get(day=self.day).interactions, 1)
+
+
+# Tracking is switched off so only the dashboard's own queries are counted
+@override_settings(VISITOR_TRACKING_INCLUDE_PATHS=[], VISITOR_GEOLOCATION_WORKERS=0)
+class PruneTrackingTests(TestCase):
+    def setUp(self):
+        self.old = timezone.now() - datetime.timedelta(days=40)
+        self.recent = timezone.now() - datetime.timedelta(days=2)
+
+    def add_visitor(self, visit_date, *session_starts):
+        visitor = Visitor.objects.create(uuid=uuid.uuid4(), location='Nairobi, Kenya', visit_date=visit_date)
+        for start in session_starts:
+            session = VisitorSession.objects.create(visitor=visitor, session_id=str(uuid.uuid4()), start_time=start)
+            PageInteraction.objects.bulk_create(
+                PageInteraction(session=session, section_id=section, timestamp=start) for section in ('hero', 'faq')
+            )
+        return visitor
+
+    def prune(self, **options):
+        call_command('prune_tracking', older_than=30, sleep=0, stdout=io.StringIO(), **options)
+
+    def test_old_rows_are_pruned_and_rollups_kept(self):
+        gone = self.add_visitor(self.old, self.old, self.old)
+        returning = self.add_visitor(self.old, self.old, self.recent)
+        recent = self.add_visitor(self.recent, self.recent)
+        refresh(full=True)
+        rollups = list(DailySessionRollup.objects.values_list('day', 'sessions').order_by('day'))
+
+        self.prune(batch_size=2)
+
+        self.assertEqual(set(Visitor.objects.all()), {returning, recent})
+        self.assertEqual(VisitorSession.objects.filter(start_time__lt=self.recent).count(), 0)
+        self.assertEqual(PageInteraction.objects.count(), 4)
+        self.assertFalse(PageInteraction.objects.filter(session__visitor=gone).exists())
+        self.assertEqual(list(DailySessionRollup.objects.values_list('day', 'sessions').order_by('day')), rollups)
+        refresh()
+        self.assertEqual(list(DailySessionRollup.objects.values_list('day', 'sessions').order_by('day')), rollups)
+
+    def test_rows_not_yet_rolled_up_are_kept(self):
+        refresh()
+        visitor = self.add_visitor(self.old, self.old)
+
+        self.prune()
+
+        self.assertTrue(Visitor.objects.filter(pk=visitor.pk).exists())
+        self.assertEqual(PageInteraction.objects.count(), 2)
+
+    def test_batches_are_archived_before_deletion(self):
+        self.add_visitor(self.old, self.old, self.old)
+        refresh()
+        with tempfile.TemporaryDirectory() as archive_dir:
+            self.prune(batch_size=1, archive=archive_dir)
+
+            archived = {}
+            for table in os.listdir(archive_dir):
+                for name in os.listdir(os.path.join(archive_dir, table)):
+                    with gzip.open(os.path.join(archive_dir, table, name), 'rt') as f:
+                        archived.setdefault(table, []).extend(json.loads(line) for line in f)
+        self.assertEqual({table: len(rows) for table, rows in archived.items()}, {
+            'core_pageinteraction': 4, 'core_visitorsession': 2, 'core_visitor': 1,
+        })
+        self.assertEqual({row['section_id'] for row in archived['core_pageinteraction']}, {'hero', 'faq'})
+
+    def test_interactions_are_deleted_without_loading_them(self):
+        self.add_visitor(self.old, self.old, self.old)
+        refresh()
+        with CaptureQueriesContext(connection) as queries:
+            self.prune()
+
+        self.assertFalse(Visitor.objects.exists())
+        self.assertFalse(PageInteraction.objects.exists())
+        # Fast delete: the rows are never selected for the deletion collector
+        self.assertFalse(any('"core_pageinteraction"."section_id"' in q['sql'] for q in queries))
+
+    def test_session_that_gains_an_interaction_mid_batch_is_kept(self):
+        visitor = self.add_visitor(self.old, self.old)
+        session = visitor.visitorsession_set.get()
+        refresh()
+
+        def racing_delete_batch(rows, archive_dir, name):
+            if name.startswith('session-'):
+                PageInteraction.objects.create(session=session, section_id='pricing', timestamp=self.recent)
+            return delete_batch(rows, archive_dir, name)
+
+        with patch('core.retention.delete_batch', racing_delete_batch):
+            self.prune()
+
+        self.assertTrue(VisitorSession.objects.filter(pk=session.pk).exists())
+        self.assertEqual(list(PageInteraction.objects.values_list('section_id', flat=True)), ['pricing'])
+
+    def test_old_session_with_a_recent_interaction_is_kept(self):
+        visitor = self.add_visitor(self.old, self.old)
+        session = visitor.visitorsession_set.get()
+        late = PageInteraction.objects.create(session=session, section_id='pricing', timestamp=self.recent)
+        refresh()
+
+        self.prune()
+
+        self.assertTrue(VisitorSession.objects.filter(pk=session.pk).exists())
+        self.assertTrue(Visitor.objects.filter(pk=visitor.pk).exists())
+        self.assertEqual(list(PageInteraction.objects.all()), [late])
+
+    def test_retention_must_outlast_the_rollup_settle_window(self):
+        with self.assertRaises(CommandError):
+            call_command('prune_tracking', older_than=1, stdout=io.StringIO())
+
+
+class AnalyticsDashboardTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.today = timezone.localdate()
+        yesterday = self.today - datetime.timedelta(days=1)
+        DailySessionRollup.objects.bulk_create([
+            DailySessionRollup(day=yesterday, location='Nairobi, Kenya', referrer_host='www.google.com',
+                               sessions=6, visitors=4, total_duration=600, duration_histogram=[1, 1, 2, 2, 0, 0]),
+            DailySessionRollup(day=self.today, location='Nairobi, Kenya', sessions=2, visitors=2,
+                               total_duration=100, duration_histogram=[0, 0, 1, 1, 0, 0]),
+            DailySessionRollup(day=self.today, location='Mombasa, Kenya', sessions=2, visitors=1,
+                               total_duration=20, duration_histogram=[2, 0, 0, 0, 0, 0]),
+            # Older than the 30 days shown
+            DailySessionRollup(day=self.today - datetime.timedelta(days=40), location='Kisumu, Kenya', sessions=50),
+        ])
+        DailySectionRollup.objects.bulk_create([
+            DailySectionRollup(day=yesterday, section_id='hero', interactions=10, sessions=8, total_scroll_depth=500,
+                               scroll_histogram=[0, 0, 0, 0, 5, 5, 0, 0, 0, 0, 0]),
+            DailySectionRollup(day=self.today, section_id='hero', interactions=2, sessions=2, total_scroll_depth=200,
+                               scroll_histogram=[0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 2]),
+            DailySectionRollup(day=self.today, section_id='faq', interactions=1, sessions=1, total_scroll_depth=90,
+                               scroll_histogram=[0, 0, 0, 0, 0, 0, 0, 0, 0, 1, 0]),
+        ])
+        self.url = reverse('analytics_dashboard')
+
+    def test_staff_only(self):
+        self.assertRedirects(self.client.get(self.url), f"{reverse('admin:login')}?next={self.url}")
+        self.client.force_login(User.objects.create_user('visitor', password='password'))
+        self.assertEqual(self.client.get(self.url).status_code, 302)
+
+    def test_figures_come_from_the_rollups_and_are_cached(self):
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'password'))
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.url)
+        sql = ' '.join(q['sql'] for q in queries)
+        self.assertNotIn('core_visitorsession', sql)
+        self.assertNotIn('core_pageinteraction', sql)
+
+        context = response.context
+        self.assertEqual((context['total_sessions'], context['total_visitors'], context['average_duration']), (10, 7, 72))
+        self.assertEqual(len(context['daily']), 30)
+        self.assertEqual(context['daily'][-1], {'day': self.today, 'sessions': 4, 'visitors': 3, 'share': 67})
+        self.assertEqual([row['location'] for row in context['locations']], ['Nairobi, Kenya', 'Mombasa, Kenya'])
+        self.assertEqual([row['sessions'] for row in context['durations']], [3, 1, 3, 3, 0, 0])
+        self.assertEqual(context['durations'][0]['label'], '< 10s')
+
+        hero, faq = context['funnel']
+        self.assertEqual((hero['section_id'], hero['sessions'], hero['reach'], hero['average_scroll']), ('hero', 10, 100.0, 58))
+        self.assertEqual(hero['percentiles'], [46, 52, 58, 100])
+        self.assertEqual((faq['reach'], faq['percentiles']), (10.0, [92, 95, 98, 99]))
+        self.assertContains(response, 'Section funnel')
+
+        # Served from the cache until ANALYTICS_DASHBOARD_TTL runs out
+        DailySessionRollup.objects.all().delete()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.url)
+        self.assertFalse(any('core_dailysessionrollup' in q['sql'] for q in queries))
+        self.assertEqual(response.context['total_sessions'], 10)
+
+        response = self.client.get(self.url + '?days=7')
+        self.assertEqual((response.context['days'], response.context['total_sessions']), (7, 0))
+
+
+class AdminThumbnailTests(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.settings_override = override_settings(
+            MEDIA_ROOT=self.tmp.name,
+            THUMBNAIL_ROOT=os.path.join(self.tmp.name, 'thumbnails'),
+            THUMBNAIL_URL='/media/thumbnails/',
+        )
+        self.settings_override.enable()
+        self.addCleanup(self.settings_override.disable)
+
+    def upload(self, name, size=(1600, 900)):
+        data = io.BytesIO()
+        Image.new('RGB', size, 'teal').save(data, format='JPEG')
+        return SimpleUploadedFile(name, data.getvalue(), content_type='image/jpeg')
+
+    def thumbnail_files(self):
+        return [name for _, _, names in os.walk(os.path.join(self.tmp.name, 'thumbnails')) for name in names]
+
+    def test_thumbnail_is_generated_once_at_twice_the_box(self):
+        hero = HeroSection.objects.create(background_image=self.upload('hero.jpg'))
+        url = thumbnail(hero.background_image, 200, 80)
+        self.assertTrue(url.startswith('/media/thumbnails/') and url.endswith('-200x80.webp'))
+        with Image.open(os.path.join(self.tmp.name, 'thumbnails', url.split('/media/thumbnails/')[1])) as image:
+            self.assertEqual(image.size, (284, 160))
+        self.assertEqual(thumbnail(hero.background_image, 200, 80), url)
+        self.assertEqual(len(self.thumbnail_files()), 1)
+
+    def test_changelist_uses_lazy_thumbnails(self):
+        Partner.objects.create(name='Huawei', logo=self.upload('logo.jpg'))
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'password'))
+        response = self.client.get(reverse('admin:core_partner_changelist'))
+        self.assertContains(response, 'loading="lazy"')
+        self.assertContains(response, '/media/thumbnails/')
+        self.assertNotContains(response, 'src="/media/partners/')
+
+    def test_replacing_or_deleting_the_file_drops_its_thumbnails(self):
+        hero = HeroSection.objects.create(background_image=self.upload('hero.jpg'))
+        thumbnail(hero.background_image, 200, 80)
+        hero.background_image = self.upload('hero2.jpg')
+        hero.save()
+        self.assertEqual(self.thumbnail_files(), [])
+
+        thumbnail(hero.background_image, 200, 80)
+        hero.delete()
+        self.assertEqual(self.thumbnail_files(), [])
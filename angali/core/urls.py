@@ -1,8 +1,14 @@
+from django.conf import settings
 from django.urls import path
 from .views import *
 
+# Under ASGI the async beacon views run on the event loop instead of a thread
+if getattr(settings, 'TRACKING_ASYNC_VIEWS', False):
+    track_start, track_end = atrack_start, atrack_end
+
 urlpatterns = [
     path('track/start/', track_start, name='track_start'),
     path('track/end/', track_end, name='track_end'),
+    path('metrics', metrics, name='metrics'),
     path('', home, name='home'),
 ]
\ No newline at end of file
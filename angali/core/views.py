@@ -1,48 +1,235 @@
 from django.views.decorators.csrf import csrf_exempt
-from django.http import JsonResponse
+from django.contrib import admin
+from django.contrib.admin.views.decorators import staff_member_required
+from django.conf import settings
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseNotModified, JsonResponse
+import hmac
 import json
+import mimetypes
+import os
 from .models import *
+from .ingest import (
+    END, START, arecord_session_ends, arecord_session_starts, client_ip, end_events, record_session_ends,
+    record_session_starts, start_event,
+)
+from .buffer import event_buffer
+from .eventlog import event_log
+from .landing import content_version, landing_context
+from .analytics import PERIODS, dashboard
+from .instrumentation import timed
+from .metrics import CACHE_LOOKUPS, CONTENT_TYPE, RENDER_SECONDS, SESSIONS_ENDED, SESSIONS_STARTED, registry
+from .snapshot import ENCODINGS, accepted_encodings, open_snapshot
 from django.shortcuts import render
+from django.utils._os import safe_join
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.utils.http import http_date
+from django.views.static import was_modified_since
+from django.views.decorators.http import condition
 
 
 
+def landing_etag(request):
+    return content_version()[0]
+
+
+def landing_last_modified(request):
+    return content_version()[1]
+
+
+# Answers If-None-Match / If-Modified-Since with a 304 from the cached version alone
+@condition(etag_func=landing_etag, last_modified_func=landing_last_modified)
 def home(request):
-    return render(request, 'files/index.html')
+    # Stream the published snapshot when there is one; render live otherwise
+    snapshot, encoding = open_snapshot(request.headers.get('Accept-Encoding', ''))
+    CACHE_LOOKUPS.inc(cache='homepage_snapshot', result='miss' if snapshot is None else 'hit')
+    if snapshot is None:
+        with timed('template'), RENDER_SECONDS.time(view='home'):
+            return render(request, 'files/index.html', landing_context())
+
+    response = FileResponse(snapshot, content_type='text/html; charset=utf-8')
+    del response['Content-Disposition']  # FileResponse names the file; this is a page
+    if encoding:
+        response['Content-Encoding'] = encoding
+    patch_vary_headers(response, ['Accept-Encoding'])
+    return response
+
+
+def queue_event(kind, event, block=True):
+    """Hand the event to the event log or the write-behind buffer; returns which took it, or None."""
+    if event_log.append(kind, event):
+        return 'event_log'
+    if event_buffer.offer(kind, event, block=block):
+        return 'buffer'
+    return None
+
+
+def queue_end_events(events, block=True):
+    """Queue end events as ``queue_event`` does; returns those left to write now."""
+    refused = []
+    for event in events:
+        write = queue_event(END, event, block=block)
+        if write:
+            SESSIONS_ENDED.inc(write=write)
+        else:
+            refused.append(event)
+    return refused
 
 
 @csrf_exempt
 def track_start(request):
-    data = json.loads(request.body)
     visitor_id = request.COOKIES.get('visitor_id')
 
     if not visitor_id:
         return JsonResponse({"error": "Missing visitor ID"}, status=400)
 
-    visitor = Visitor.objects.filter(uuid=visitor_id).first()
-    if visitor:
-        VisitorSession.objects.create(
-            visitor=visitor,
-            session_id=data['session_id'],
-            referrer=data.get('referrer', ''),
-            user_agent=data.get('user_agent', '')
-        )
+    # Refused here, a bad payload can never fail a buffered or logged batch later
+    try:
+        event = start_event(json.loads(request.body), visitor_id, client_ip(request))
+    except ValueError as exc:
+        return JsonResponse({"error": str(exc)}, status=400)
+    write = queue_event(START, event)
+    if write:
+        SESSIONS_STARTED.inc(write=write)
+        return JsonResponse({"status": "accepted"}, status=202)
+
+    SESSIONS_STARTED.inc(record_session_starts([event]), write='database')
     return JsonResponse({"status": "started"})
 
 
 @csrf_exempt
 def track_end(request):
-    data = json.loads(request.body)
-    session = VisitorSession.objects.filter(session_id=data['session_id']).first()
-
-    if session:
-        session.end_time = data['end_time']
-        session.duration_seconds = data['duration_seconds']
-        session.save()
-
-        for section_id in data['sections']:
-            PageInteraction.objects.create(
-                session=session,
-                section_id=section_id,
-                scroll_depth=data['max_scroll']
-            )
+    try:
+        data = json.loads(request.body)
+        events = end_events(data)
+    except ValueError as exc:
+        return JsonResponse({"error": str(exc)}, status=400)
+    # Batched payload: {"events": [<end event>, ...]} for several sessions in one POST
+    batched = isinstance(data, dict) and 'events' in data
+
+    # Whatever neither the event log nor the write-behind buffer takes is written now
+    refused = queue_end_events(events)
+    if events and not refused:
+        return JsonResponse({"status": "accepted"}, status=202)
+
+    ended = record_session_ends(refused)
+    SESSIONS_ENDED.inc(ended, write='database')
+    if batched:
+        return JsonResponse({"status": "ended", "sessions": ended})
+    return JsonResponse({"status": "ended"})
+
+
+@csrf_exempt
+async def atrack_start(request):
+    """``track_start`` for ASGI: never blocks the event loop on a full buffer or a database write."""
+    visitor_id = request.COOKIES.get('visitor_id')
+
+    if not visitor_id:
+        return JsonResponse({"error": "Missing visitor ID"}, status=400)
+
+    # Refused here, a bad payload can never fail a buffered or logged batch later
+    try:
+        event = start_event(json.loads(request.body), visitor_id, client_ip(request))
+    except ValueError as exc:
+        return JsonResponse({"error": str(exc)}, status=400)
+    write = queue_event(START, event, block=False)
+    if write:
+        SESSIONS_STARTED.inc(write=write)
+        return JsonResponse({"status": "accepted"}, status=202)
+
+    SESSIONS_STARTED.inc(await arecord_session_starts([event]), write='database')
+    return JsonResponse({"status": "started"})
+
+
+@csrf_exempt
+async def atrack_end(request):
+    """``track_end`` for ASGI."""
+    try:
+        data = json.loads(request.body)
+        events = end_events(data)
+    except ValueError as exc:
+        return JsonResponse({"error": str(exc)}, status=400)
+    batched = isinstance(data, dict) and 'events' in data
+
+    refused = queue_end_events(events, block=False)
+    if events and not refused:
+        return JsonResponse({"status": "accepted"}, status=202)
+
+    ended = await arecord_session_ends(refused)
+    SESSIONS_ENDED.inc(ended, write='database')
+    if batched:
+        return JsonResponse({"status": "ended", "sessions": ended})
     return JsonResponse({"status": "ended"})
+
+
+def static_asset(request, path):
+    """
+    Serve a collected static file, preferring a precompressed sibling the client accepts.
+
+    Files stored under a content-hashed name never change, so they are
+    cacheable for a year; anything else only for STATIC_MAX_AGE.
+    """
+    fullpath = safe_join(settings.STATIC_ROOT, path)
+    if not os.path.isfile(fullpath):
+        raise Http404("Static file not found")
+
+    variant, encoding = fullpath, None
+    accepted = accepted_encodings(request.headers.get('Accept-Encoding', ''))
+    for name, suffix in ENCODINGS:
+        if name in accepted and os.path.isfile(fullpath + suffix):
+            variant, encoding = fullpath + suffix, name
+            break
+
+    if path in getattr(staticfiles_storage, 'immutable_names', ()):
+        cache_control = {'max_age': getattr(settings, 'STATIC_IMMUTABLE_MAX_AGE', 60 * 60 * 24 * 365), 'immutable': True}
+    else:
+        cache_control = {'max_age': getattr(settings, 'STATIC_MAX_AGE', 60 * 60)}
+
+    mtime = os.stat(variant).st_mtime
+    if not was_modified_since(request.headers.get('If-Modified-Since'), mtime):
+        response = HttpResponseNotModified()
+    else:
+        content_type, _ = mimetypes.guess_type(fullpath)
+        response = FileResponse(open(variant, 'rb'), content_type=content_type or 'application/octet-stream')
+        del response['Content-Disposition']
+        response['Last-Modified'] = http_date(mtime)
+        if encoding:
+            response['Content-Encoding'] = encoding
+    patch_vary_headers(response, ['Accept-Encoding'])
+    patch_cache_control(response, public=True, **cache_control)
+    return response
+
+
+@staff_member_required
+def analytics_dashboard(request):
+    """Visitors, locations, session durations and the section funnel, from the daily rollups."""
+    try:
+        days = int(request.GET.get('days', 30))
+    except ValueError:
+        days = 30
+    if days not in PERIODS:
+        days = 30
+    context = {
+        **admin.site.each_context(request),
+        **dashboard(days),
+        'title': 'Analytics',
+        'periods': PERIODS,
+    }
+    with timed('template'):
+        return render(request, 'admin/core/analytics.html', context)
+
+
+def metrics(request):
+    """Counters and histograms from core.metrics, summed over every worker process, without touching the database."""
+    token = getattr(settings, 'METRICS_TOKEN', None)
+    if token:
+        supplied = request.headers.get('Authorization', '')
+        if not hmac.compare_digest(supplied.encode(), f'Bearer {token}'.encode()):
+            raise Http404
+    else:
+        allowed = getattr(settings, 'METRICS_ALLOWED_IPS', ['127.0.0.1', '::1'])
+        # A request forwarded by the reverse proxy only looks local
+        forwarded = 'HTTP_X_FORWARDED_FOR' in request.META
+        if allowed is not None and (forwarded or request.META.get('REMOTE_ADDR') not in allowed):
+            raise Http404
+    return HttpResponse(registry.render(), content_type=CONTENT_TYPE)